@@ -9,6 +9,7 @@ import os
 
 from flask import Flask
 from flask import g
+from flask import request
 from flask import url_for
 from flask_autoindex import AutoIndex
 from flask_babel import Babel
@@ -17,7 +18,10 @@ from flask_themes2 import Themes
 from flask_themes2 import theme_paths_loader
 
 from . import config as CFG
+from .util import metrics
+from .util import walltime
 from .util.decorators import guest_or_login_required
+from .util.locks import lock_monitor
 from .util.templates import css_escape
 from .util.templates import convert_time_to_string
 from .util.templates import DynamicJs
@@ -26,6 +30,7 @@ from .util.templates import number_of_rows
 from .util.templates import message as message_template
 from .util.templates import render_template
 from .util.templates import join_max
+from .util.tracing import cell_tracer
 
 from .blueprints.admin import admin
 from .blueprints.authentication import authentication
@@ -36,6 +41,16 @@ from .blueprints.worksheet_listing import worksheet_listing
 from .blueprints.worksheet import worksheet
 
 
+def bind_metrics(notebook):
+    """
+    Compute the gauges of :mod:`.util.metrics` from ``notebook``.
+    """
+    metrics.worksheets_loaded.function = lambda: len(notebook.loaded_wsts)
+    metrics.kernels.function = notebook.kernel_registry.counts
+    metrics.queued_cells.function = lambda: sum(
+        len(W.queue) for W in notebook.loaded_wsts)
+
+
 def create_app(notebook, startup_token=None, debug=False):
     """
     This is the main method to create a running notebook. This is
@@ -53,11 +68,26 @@ def create_app(notebook, startup_token=None, debug=False):
         })
 
     dynamic_javascript = DynamicJs(debug=debug)
+    lock_monitor.enabled = notebook.conf['lock_stats']
+    cell_tracer.resize(notebook.conf['cell_traces'])
 
     @app.before_request
     def set_notebook_object():
         g.notebook = notebook
         g.dynamic_javascript = dynamic_javascript
+        g.request_start = walltime()
+
+    @app.after_request
+    def record_request(response):
+        endpoint = request.endpoint or 'none'
+        metrics.http_requests.inc(
+            endpoint=endpoint, method=request.method,
+            status=response.status_code)
+        metrics.request_duration.observe(
+            walltime(g.request_start), endpoint=endpoint)
+        return response
+
+    bind_metrics(notebook)
 
     # Handles all uncaught exceptions if not debug activated
     @app.errorhandler(500)
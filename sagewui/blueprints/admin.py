@@ -4,6 +4,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from flask import Blueprint
+from flask import Response
 from flask import current_app
 from flask import flash
 from flask import g
@@ -17,13 +18,20 @@ from .. import config as CFG
 from ..util.auth import random_password
 from ..util.decorators import admin_required
 from ..util.decorators import login_required
-from ..util.decorators import with_lock
+from ..util.decorators import with_read_lock
+from ..util.decorators import with_write_lock
+from ..util.locks import conf_lock
+from ..util.locks import lock_monitor
+from ..util.locks import users_lock
+from ..util.locks import worksheet_locks
+from ..util.metrics import registry
 from ..util.templates import message as message_template
 from ..util.templates import render_template
 from ..util.templates import encode_response
 from ..util.text import is_valid_email
 from ..util.text import is_valid_password
 from ..util.text import is_valid_username
+from ..util.tracing import cell_tracer
 
 _ = gettext
 
@@ -32,7 +40,7 @@ admin = Blueprint('admin', __name__)
 
 @admin.route('/settings', methods=['GET', 'POST'])
 @login_required
-@with_lock
+@with_write_lock(users_lock)
 def settings_page():
     error = None
     redirect_to_home = None
@@ -114,7 +122,7 @@ def settings_page():
 
 @admin.route('/users')
 @admin_required
-@with_lock
+@with_read_lock(users_lock)
 def users():
     template_dict = {}
     template_dict['sage_version'] = CFG.SAGE_VERSION
@@ -132,7 +140,7 @@ def users():
 
 @admin.route('/users/reset/<user>')
 @admin_required
-@with_lock
+@with_write_lock(users_lock)
 def reset_user(user):
     try:
         U = g.notebook.user_manager[user]
@@ -148,7 +156,7 @@ def reset_user(user):
 
 @admin.route('/users/suspend/<user>')
 @admin_required
-@with_lock
+@with_write_lock(users_lock)
 def suspend_user(user):
     try:
         U = g.notebook.user_manager[user]
@@ -161,11 +169,11 @@ def suspend_user(user):
 
 @admin.route('/users/delete/<user>')
 @admin_required
-@with_lock
+@with_write_lock(users_lock)
 def del_user(user):
     if user != CFG.UN_ADMIN:
         try:
-            del g.notebook.user_manager[user]
+            g.notebook.delete_user(user)
         except KeyError:
             pass
     return redirect(url_for("admin.users"))
@@ -173,7 +181,7 @@ def del_user(user):
 
 @admin.route('/users/toggleadmin/<user>')
 @admin_required
-@with_lock
+@with_write_lock(users_lock)
 def toggle_admin(user):
     try:
         U = g.notebook.user_manager[user]
@@ -189,7 +197,7 @@ def toggle_admin(user):
 
 @admin.route('/adduser', methods=['GET', 'POST'])
 @admin_required
-@with_lock
+@with_write_lock(users_lock)
 def add_user():
     template_url = 'html/settings/admin_add_user.html'
     template_dict = {
@@ -225,7 +233,7 @@ def add_user():
 # New UI
 @admin.route('/reset_user_password', methods=['POST'])
 @admin_required
-@with_lock
+@with_write_lock(users_lock)
 def reset_user_password():
     user = request.values['username']
     password = random_password()
@@ -245,7 +253,7 @@ def reset_user_password():
 
 @admin.route('/suspend_user', methods=['POST'])
 @admin_required
-@with_lock
+@with_write_lock(users_lock)
 def suspend_user_nui():
     user = request.values['username']
     try:
@@ -263,7 +271,7 @@ def suspend_user_nui():
 
 @admin.route('/add_user', methods=['POST'])
 @admin_required
-@with_lock
+@with_write_lock(users_lock)
 def add_user_nui():
     username = request.values['username']
     password = random_password()
@@ -292,11 +300,13 @@ def add_user_nui():
 
 @admin.route('/notebooksettings', methods=['GET', 'POST'])
 @admin_required
-@with_lock
+@with_write_lock(conf_lock)
 def notebook_settings():
     updated = {}
     if 'form' in request.values:
         updated = g.notebook.conf.update_from_form(request.values)
+        lock_monitor.enabled = g.notebook.conf['lock_stats']
+        cell_tracer.resize(g.notebook.conf['cell_traces'])
 
     # Changes theme
     if 'theme' in request.values:
@@ -319,3 +329,129 @@ def notebook_settings():
 
     return render_template(
         'html/settings/notebook_settings.html', **template_dict)
+
+
+@admin.route('/lock_stats')
+@admin_required
+def lock_stats():
+    """
+    Lock contention statistics, see :mod:`sagewui.util.locks`.
+    """
+    return render_template(
+        'html/settings/lock_stats.html',
+        stats=lock_monitor.basic,
+        admin=True,
+        username=g.username,
+        sage_version=CFG.SAGE_VERSION)
+
+
+@admin.route('/lock_stats.json')
+@admin_required
+def lock_stats_json():
+    return encode_response(lock_monitor.basic)
+
+
+@admin.route('/lock_stats/reset', methods=['POST'])
+@admin_required
+def reset_lock_stats():
+    lock_monitor.reset()
+    return redirect(url_for('admin.lock_stats'))
+
+
+@admin.route('/cell_traces')
+@admin_required
+def cell_traces():
+    """
+    Timings of the last cell evaluations, of all the worksheets or of the
+    ``worksheet`` argument. See :mod:`sagewui.util.tracing`.
+    """
+    return render_template(
+        'html/settings/cell_traces.html',
+        traces=cell_tracer.basic(request.args.get('worksheet')),
+        admin=True,
+        username=g.username,
+        sage_version=CFG.SAGE_VERSION)
+
+
+@admin.route('/cell_traces.json')
+@admin_required
+def cell_traces_json():
+    return encode_response(cell_tracer.basic(
+        request.args.get('worksheet'),
+        recent=request.args.get('recent', 100, type=int)))
+
+
+@admin.route('/cell_traces/reset', methods=['POST'])
+@admin_required
+def reset_cell_traces():
+    cell_tracer.reset()
+    return redirect(url_for('admin.cell_traces'))
+
+
+@admin.route('/kernels')
+@admin_required
+def kernels():
+    """
+    The running worksheet processes, with actions to interrupt or kill
+    them.
+    """
+    return render_template(
+        'html/settings/kernels.html',
+        kernels=sorted(g.notebook.kernels(),
+                       key=lambda k: -(k['cpu_percent'] or 0)),
+        admin=True,
+        username=g.username,
+        sage_version=CFG.SAGE_VERSION)
+
+
+@admin.route('/kernels.json')
+@admin_required
+def kernels_json():
+    return encode_response(g.notebook.kernels())
+
+
+@admin.route('/kernels/<username>/<id>/<any(interrupt, kill):action>',
+             methods=['POST'])
+@admin_required
+def kernel_action(username, id, action):
+    filename = '{}/{}'.format(username, id)
+    for kernel in g.notebook.kernel_registry.kernels:
+        W = kernel.worksheet
+        if W.filename == filename:
+            break
+    else:
+        return message_template(
+            gettext('The worksheet %(w)s has no running process',
+                    w=filename),
+            url_for('admin.kernels'), username=g.username), 404
+
+    with worksheet_locks[filename]:
+        if action == 'interrupt':
+            if kernel.process is None or kernel.dead:
+                return message_template(
+                    gettext('The process of %(w)s is not running',
+                            w=filename),
+                    url_for('admin.kernels'), username=g.username), 409
+            # Don't wait for the computation to stop: the kernels page
+            # shows whether it did
+            if W.interrupt(timeout=0):
+                flash(gettext('The process of %(w)s has been interrupted',
+                              w=filename))
+            else:
+                flash(gettext('The process of %(w)s has been sent an '
+                              'interrupt', w=filename))
+        else:
+            W.quit()
+            flash(gettext('The process of %(w)s has been killed',
+                          w=filename))
+    return redirect(url_for('admin.kernels'))
+
+
+@admin.route('/metrics')
+@admin_required
+def metrics():
+    """
+    Server metrics in the Prometheus text format.
+    """
+    return Response(registry.render(),
+                    mimetype='text/plain; version=0.0.4')
@@ -29,7 +29,8 @@ from ..util.text import is_valid_email
 from ..util.text import is_valid_password
 from ..util.text import is_valid_username
 
-from ..util.decorators import with_lock
+from ..util.decorators import with_write_lock
+from ..util.locks import users_lock
 
 _ = gettext
 
@@ -125,7 +126,7 @@ waiting = {}
 
 
 @authentication.route('/register', methods=['GET', 'POST'])
-@with_lock
+@with_write_lock(users_lock)
 def register():
     if not g.notebook.conf['accounts']:
         return redirect(url_for('base.index'))
@@ -275,7 +276,7 @@ def register():
 
 
 @authentication.route('/confirm')
-@with_lock
+@with_write_lock(users_lock)
 def confirm():
     if not g.notebook.conf['email']:
         return message_template(_('The confirmation system is not active.'))
@@ -301,7 +302,7 @@ def confirm():
 
 
 @authentication.route('/forgotpass')
-@with_lock
+@with_write_lock(users_lock)
 def forgot_pass():
     if not g.notebook.conf['email']:
         return message_template(
@@ -9,30 +9,27 @@ from future.moves.urllib.request import urlopen
 from future.moves.urllib.parse import urlparse
 
 import base64
-import bz2
 import os
 import re
-import threading
 import time
 from html import escape
-from collections import defaultdict
 from functools import wraps
 
 from flask import Blueprint
+from flask import Response
 from flask import make_response
 from flask import url_for
 from flask import request
 from flask import redirect
 from flask import g
 from flask import current_app
+from flask import stream_with_context
 from flask_babel import gettext
-from flask.helpers import send_file
 from flask.helpers import send_from_directory
 from jinja2.exceptions import TemplateNotFound
 from werkzeug.utils import secure_filename
 
 from .. import config as CFG
-from ..util import tmp_filename
 from ..util.docHTMLProcessor import SphinxHTMLProcessor
 # New UI
 from ..util.newui import extended_wst_basic
@@ -44,11 +41,12 @@ from ..util.templates import render_template
 
 from ..util.decorators import guest_or_login_required
 from ..util.decorators import login_required
+from ..util.locks import worksheet_locks
+from ..util.tracing import cell_tracer
 
 _ = gettext
 
 worksheet = Blueprint('worksheet', __name__)
-worksheet_locks = defaultdict(threading.Lock)
 
 base_url = 'html/notebook/{}.html'
 
@@ -103,6 +101,20 @@ def url_for_worksheet(worksheet):
                    id=str(worksheet.id_number))
 
 
+def send_worksheet_file(directory, filename):
+    """
+    Returns the file ``filename`` of the worksheet ``directory`` (cells or
+    data), with the hash of its contents as ETag, so that it is revalidated
+    without transfer whenever the contents didn't change, e.g., for the
+    plots of a reevaluated cell or a published copy.
+    """
+    response = send_from_directory(directory, filename)
+    # send_from_directory has validated the path
+    response.set_etag(g.notebook.wst_file_hash(
+        os.path.join(directory, filename)))
+    return response.make_conditional(request)
+
+
 def get_cell_id():
     """
     Returns the cell ID from the request.
@@ -230,11 +242,10 @@ def html_specific_revision(username, ws, rev):
     - a string - the revision rendered as HTML
     """
     nb = g.notebook
-    t = time.time() - float(rev[:-4])
+    t = time.time() - float(rev)
     time_ago = prettify_time_ago(t)
 
-    filename = ws.snapshot_filename(rev)
-    txt = bz2.decompress(open(filename, 'rb').read()).decode('utf-8')
+    txt = ws.snapshot_body(rev)
     W = nb.scratch_wst
     W.name = 'Revision of ' + ws.name
     W.delete_cells_directory()
@@ -610,7 +621,7 @@ def public_worksheet_cells(id, filename):
         return message_template(
             _("You do not have permission to access this worksheet"),
             username=g.username)
-    return send_from_directory(worksheet.cells_directory, filename)
+    return send_worksheet_file(worksheet.cells_directory, filename)
 
 
 published_commands_allowed = set([
@@ -1057,7 +1068,11 @@ def worksheet_cell_update(worksheet):
     # Compute 'em, if we got 'em.
     worksheet.start_next_comp()
 
-    return encode_response(r)
+    response = encode_response(r)
+    if r['status'] == 'd':
+        # Delivered with the response
+        cell_tracer.finish(cell)
+    return response
 
 
 ########################################################
@@ -1173,15 +1188,14 @@ def worksheet_invite_collab(worksheet):
     # add worksheet to new collaborators
     for u in collaborators - old_collaborators:
         try:
-            user_manager[u].viewable_worksheets.add((owner, id_number))
+            user_manager[u].add_viewable_worksheet(owner, id_number)
         except KeyError:
             # user doesn't exist
             pass
     # remove worksheet from ex-collaborators
     for u in old_collaborators - collaborators:
         try:
-            user_manager[u].viewable_worksheets.discard(
-                (owner, id_number))
+            user_manager[u].discard_viewable_worksheet(owner, id_number)
         except KeyError:
             # user doesn't exist
             pass
@@ -1208,19 +1222,14 @@ def worksheet_revisions(worksheet):
         rev = request.values['rev']
         action = request.values['action']
         if action == 'revert':
+            txt = worksheet.snapshot_body(rev)
             worksheet.save_snapshot(g.username)
-            # XXX: Requires access to filesystem
-            txt = bz2.decompress(
-                open(worksheet.snapshot_filename(rev), 'rb').read()).decode(
-                'utf-8')
             worksheet.delete_cells_directory()
             worksheet.edit_save(txt)
             return redirect(url_for_worksheet(worksheet))
         elif action == 'publish':
             W = g.notebook.publish_wst(worksheet, g.username)
-            txt = bz2.decompress(
-                open(worksheet.snapshot_filename(rev), 'rb').read()).decode(
-                'utf-8')
+            txt = worksheet.snapshot_body(rev)
             W.delete_cells_directory()
             W.edit_save(txt)
             return redirect(url_for_worksheet(W))
@@ -1235,7 +1244,7 @@ def worksheet_revisions(worksheet):
 def worksheet_cells(worksheet, filename):
     # XXX: This requires that the worker filesystem be accessible from
     # the server.
-    return send_from_directory(worksheet.cells_directory, filename)
+    return send_worksheet_file(worksheet.cells_directory, filename)
 
 
 ########################################################
@@ -1327,7 +1336,7 @@ def worksheet_data(worksheet, filename):
     if not os.path.exists(dir):
         return message_template(_('No data files'), username=g.username)
     else:
-        return send_from_directory(worksheet.data_directory, filename)
+        return send_worksheet_file(worksheet.data_directory, filename)
 
 
 @worksheet_command('datafile')
@@ -1582,18 +1591,16 @@ def worksheet_download(worksheet, title):
 
 
 def unconditional_download(worksheet, title):
-    filename = tmp_filename() + '.sws'
-
     if title.endswith('.sws'):
         title = title[:-4]
 
     try:
-        # XXX: Accessing the hard disk.
-        g.notebook.export_wst(worksheet.filename, filename, title)
+        # The sws file is built while it is sent
+        chunks = g.notebook.export_wst_stream(worksheet.filename, title)
     except KeyError:
         return message_template(_('No such worksheet.'))
 
-    return send_file(filename, mimetype='application/sage')
+    return Response(stream_with_context(chunks), mimetype='application/sage')
 
 
 @worksheet_command('restart_sage')
@@ -1692,6 +1699,6 @@ def worksheet_file(path):
 
     # FIXME: For some reason, an extra cell gets added so we
     # remove it here.
-    W.cells.pop()
+    W.pop_cell()
 
     return render_ws_template(ws=W, username=g.username)
@@ -16,14 +16,16 @@ import os
 import re
 import shutil
 import zipfile
+from html import escape
 from html.parser import HTMLParser
 
-from flask import current_app
 from flask import g
 from flask import Blueprint
 from flask import json
 from flask import redirect
 from flask import request
+from flask import Response
+from flask import stream_with_context
 from flask import url_for
 from flask_babel import gettext
 from jinja2.exceptions import TemplateNotFound
@@ -31,12 +33,15 @@ from werkzeug.utils import secure_filename
 
 from .. import config as CFG
 from ..util import tmp_dir
+from ..util import bounded_map
 from ..util import tmp_filename
 from ..util import walltime
+from ..util.archive import ZipStream
 from ..util.decorators import login_required
 from ..util.decorators import guest_or_login_required
 # New UI
 from ..util.newui import extended_wst_basic
+from ..util.newui import pub_entry_basic
 # New UI end
 from ..util.templates import encode_response
 from ..util.templates import message as message_template
@@ -50,6 +55,23 @@ _ = gettext
 worksheet_listing = Blueprint('worksheet_listing', __name__)
 
 
+def pub_catalog_page(args, search=None, sort='last_edited', reverse=False):
+    """
+    Returns the page ``args['page']`` of the published worksheets, served
+    from the catalog without loading the worksheets.
+
+    OUTPUT:
+
+    a tuple (entries, page, pages)
+    """
+    entries = g.notebook.pub_catalog.select(
+        search=search, sort=sort, reverse=reverse)
+    page_size = max(1, g.notebook.conf['pub_page_size'])
+    pages = max(1, -(-len(entries) // page_size))
+    page = min(max(1, args.get('page', 1, type=int)), pages)
+    return entries[(page - 1) * page_size:page * page_size], page, pages
+
+
 def render_ws_list_template(args, pub, username):
     """
     Returns a rendered worksheet listing.
@@ -78,8 +100,8 @@ def render_ws_list_template(args, pub, username):
             worksheets = g.notebook.user_selected_wsts(
                 username, typ=typ, sort=sort, search=search, reverse=reverse)
         else:
-            worksheets = g.notebook.user_selected_wsts(
-                CFG.UN_PUB, sort=sort, search=search, reverse=reverse)
+            worksheets, page, pages = pub_catalog_page(
+                args, search=search, sort=sort, reverse=reverse)
     except ValueError as E:
         # for example, the sort key was not valid
         print("Error displaying worksheet listing: ", E)
@@ -132,10 +154,11 @@ def worksheet_list():
         if not pub:
             worksheets = nb.user_selected_wsts(
                 g.username, typ=typ, sort=sort, search=search, reverse=reverse)
+            r['worksheets'] = [extended_wst_basic(x, nb) for x in worksheets]
         else:
-            worksheets = nb.user_selected_wsts(
-                CFG.UN_PUB, sort=sort, search=search, reverse=reverse)
-        r['worksheets'] = [extended_wst_basic(x, nb) for x in worksheets]
+            entries, r['page'], r['pages'] = pub_catalog_page(
+                request.args, search=search, sort=sort, reverse=reverse)
+            r['worksheets'] = [pub_entry_basic(x) for x in entries]
 
     except ValueError as E:
         # for example, the sort key was not valid
@@ -264,12 +287,6 @@ def pub():
 @worksheet_listing.route('/download_worksheets.zip')
 @login_required
 def download_worksheets():
-    t = walltime()
-    print("Starting zipping a group of worksheets in a separate thread...")
-    zip_filename = tmp_filename() + ".zip"
-
-    # child
-    worksheet_names = set()
     if 'filenames' in request.values:
         filenames = json.loads(request.values['filenames'])
         worksheets = [g.notebook.filename_wst(x.strip())
@@ -277,27 +294,43 @@ def download_worksheets():
     else:
         worksheets = g.notebook.user_selected_wsts(g.username)
 
-    zip = zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_STORED)
-    for worksheet in worksheets:
+    nb = g.notebook
+
+    def export(worksheet):
         sws_filename = tmp_filename() + '.sws'
-        g.notebook.export_wst(worksheet.filename, sws_filename)
-        entry_name = worksheet.name
-        if entry_name in worksheet_names:
-            i = 2
-            while ("%s_%s" % (entry_name, i)) in worksheet_names:
-                i += 1
-            entry_name = "%s_%s" % (entry_name, i)
-        zip.write(sws_filename, entry_name + ".sws")
+        nb.export_wst(worksheet.filename, sws_filename)
+        return sws_filename
+
+    def discard(sws_filename):
         os.unlink(sws_filename)
-    zip.close()
-    r = open(zip_filename, 'rb').read()
-    os.unlink(zip_filename)
-    print("Finished zipping %s worksheets (%s seconds)" % (
-        len(worksheets), walltime(t)))
-
-    response = current_app.make_response(r)
-    response.headers['Content-Type'] = 'application/zip'
-    return response
+
+    def chunks():
+        # The worksheets are exported to temporary files in a bounded pool
+        # of threads, and each one is sent as soon as it is ready.
+        t = walltime()
+        print("Starting zipping a group of worksheets...")
+        worksheet_names = set()
+        Z = ZipStream()
+        for worksheet, sws_filename in bounded_map(
+                export, worksheets, CFG.BULK_WORKERS, discard):
+            entry_name = worksheet.name
+            if entry_name in worksheet_names:
+                i = 2
+                while ("%s_%s" % (entry_name, i)) in worksheet_names:
+                    i += 1
+                entry_name = "%s_%s" % (entry_name, i)
+            worksheet_names.add(entry_name)
+            try:
+                for chunk in Z.add(sws_filename, entry_name + ".sws"):
+                    yield chunk
+            finally:
+                os.unlink(sws_filename)
+        for chunk in Z.close():
+            yield chunk
+        print("Finished zipping %s worksheets (%s seconds)" % (
+            len(worksheets), walltime(t)))
+
+    return Response(stream_with_context(chunks()), mimetype='application/zip')
 
 
 #############
@@ -410,6 +443,85 @@ def parse_link_rel(url, fn):
     return ret
 
 
+def _upload_zip(filename, dir, new_name):
+    """
+    Import the worksheets of a zip file in a bounded pool of threads.
+
+    Returns a response which reports the progress of each file as it is
+    imported, so that large bundles don't time out.
+    """
+    # Mac zip files contain files like __MACOSX/._worksheet.sws
+    # which are metadata files, so we skip those as
+    # well as any other files we won't understand
+    members = []
+    with zipfile.ZipFile(filename) as zip_file:
+        for info in zip_file.infolist():
+            prefix, extension = os.path.splitext(info.filename)
+            if extension in ['.sws', '.html', '.txt', '.rst'] and \
+                    not prefix.startswith('__MACOSX/'):
+                members.append(info)
+            elif not info.filename.endswith('/'):
+                print("Unknown extension, file %s is ignored" % info.filename)
+
+    nb = g.notebook
+    username = g.username
+
+    def import_member(info):
+        # Each member is streamed to a temporary file, which is removed
+        # as soon as it is imported. A ZipFile can't be read by several
+        # threads (before Python 3.5), so each worker opens its own.
+        tmpfilename = tmp_filename() + os.path.splitext(info.filename)[1]
+        try:
+            with zipfile.ZipFile(filename) as zip_file, \
+                    zip_file.open(info) as src, \
+                    open(tmpfilename, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            W = nb.import_wst(tmpfilename, username)
+            if new_name:
+                W.name = "%s - %s" % (new_name, W.name)
+            return W, None
+        except Exception as msg:
+            print('error uploading worksheet', info.filename, msg)
+            return None, msg
+        finally:
+            if os.path.exists(tmpfilename):
+                os.unlink(tmpfilename)
+
+    home = url_for('worksheet_listing.home', username=username)
+    marker = '<!-- progress -->'
+    head, tail = message_template(
+        marker, home, username=username,
+        title=_('Uploading worksheets')).split(marker, 1)
+
+    def progress():
+        errors = 0
+        yield head
+        for i, (info, (W, msg)) in enumerate(bounded_map(
+                import_member, members, CFG.BULK_WORKERS)):
+            if W is None:
+                errors += 1
+                line = _('Error importing %(file)s: %(msg)s',
+                         file=escape(info.filename), msg=escape(str(msg)))
+            else:
+                line = _('Imported %(file)s as <a href="%(url)s">%(name)s</a>',
+                         file=escape(info.filename),
+                         url=url_for_worksheet(W), name=escape(W.name))
+            yield '<div>[%s/%s] %s</div>\n' % (i + 1, len(members), line)
+        if not errors:
+            yield '<script type="text/javascript">' \
+                'window.location.href = %s;</script>\n' % json.dumps(home)
+        yield tail
+
+    def clean_up():
+        os.unlink(filename)
+        if dir:
+            shutil.rmtree(dir)
+
+    response = Response(stream_with_context(progress()), mimetype='text/html')
+    response.call_on_close(clean_up)
+    return response
+
+
 @worksheet_listing.route('/upload_worksheet', methods=['GET', 'POST'])
 @login_required
 def upload_worksheet():
@@ -477,34 +589,11 @@ def upload_worksheet():
     try:
         try:
             if filename.endswith('.zip'):
-                # Extract all the .sws files from a zip file.
-                zip_file = zipfile.ZipFile(filename)
-                for subfilename in zip_file.namelist():
-                    prefix, extension = os.path.splitext(subfilename)
-                    # Mac zip files contain files like __MACOSX/._worksheet.sws
-                    # which are metadata files, so we skip those as
-                    # well as any other files we won't understand
-                    if extension in [
-                            '.sws',
-                            '.html',
-                            '.txt',
-                            '.rst'] and not prefix.startswith('__MACOSX/'):
-                        tmpfilename = os.path.join(dir, "tmp" + extension)
-                        try:
-                            tmpfilename = zip_file.extract(
-                                subfilename, tmpfilename)
-                        except AttributeError:
-                            open(tmpfilename, 'w').write(
-                                zip_file.read(subfilename))
-                        W = g.notebook.import_wst(
-                            tmpfilename, g.username)
-                        if new_name:
-                            W.name = "%s - %s" % (new_name, W.name)
-                    else:
-                        print("Unknown extension, file %s is "
-                              "ignored" % subfilename)
-                return redirect(url_for(
-                    'worksheet_listing.home', username=g.username))
+                # The response streams the progress of the import and
+                # removes the temporary files when it is done.
+                response = _upload_zip(filename, dir, new_name)
+                filename = dir = None
+                return response
 
             else:
                 if url and extension in ['', '.html']:
@@ -535,7 +624,8 @@ def upload_worksheet():
                 username=g.username)
         finally:
             # Clean up the temporarily uploaded filename.
-            os.unlink(filename)
+            if filename:
+                os.unlink(filename)
             # if a temp directory was created, we delete it now.
             if dir:
                 shutil.rmtree(dir)
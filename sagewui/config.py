@@ -106,6 +106,8 @@ SYSTEMS = (('sage', False),
 # and numbers, so don't make this too small.
 MAX_OUTPUT = 32000
 MAX_OUTPUT_LINES = 120
+# Cell outputs longer than this are kept zlib compressed in memory.
+MIN_COMPRESSED_OUTPUT = 1024
 # Used to detect and format tracebacks.
 # See :func:`.util.text.format_exception`.
 TRACEBACK = 'Traceback (most recent call last):'
@@ -118,6 +120,11 @@ WARN_THRESHOLD = 100   # The number of seconds, so if there was no
 # seconds, then editing is considered safe.
 # Used when multiple people are editing the
 # same worksheet.
+# Worker threads used to export (or import) a group of worksheets, e.g.,
+# in /download_worksheets.zip. Each one holds a temporary sws file.
+BULK_WORKERS = 4
+# Number of the locks shared by the worksheets (see util.locks)
+WORKSHEET_LOCK_STRIPES = 256
 
 # themes
 THEME_PATHS = [
@@ -5,6 +5,7 @@ from __future__ import unicode_literals
 from builtins import object
 
 import crypt
+import threading
 
 from .models import User as UserModel
 from .models import Worksheet as WstModel
@@ -20,6 +21,7 @@ class User(object):
         conf = basic.pop('conf')
         conf = UserConfiguration.from_basic(conf)
         new = cls(UserModel(conf=conf, **basic))
+        new.modified = False
         return new
 
     @classmethod
@@ -37,6 +39,9 @@ class User(object):
 
     def __init__(self, data_model):
         self.__data_model = data_model
+        # Whether the user changed since it was stored. The storage only
+        # saves the modified users, and clears the flag.
+        self.modified = True
 
     # Expose model attributes
 
@@ -53,6 +58,7 @@ class User(object):
         set to ''
         """
         self.__data_model.password = encrypt_password(passwd) if passwd else ''
+        self.modified = True
 
     password = property(fset=__set_password)
 
@@ -66,6 +72,7 @@ class User(object):
     @email.setter
     def email(self, email):
         self.__data_model.email = email
+        self.modified = True
 
     @property
     def external_auth(self):
@@ -84,6 +91,7 @@ class User(object):
     @email_confirmed.setter
     def email_confirmed(self, value):
         self.__data_model.email_confirmed = value
+        self.modified = True
 
     @property
     def is_suspended(self):
@@ -95,6 +103,7 @@ class User(object):
     @is_suspended.setter
     def is_suspended(self, value):
         self.__data_model.is_suspended = value
+        self.modified = True
 
     @property
     def viewable_worksheets(self):
@@ -103,6 +112,14 @@ class User(object):
         """
         return self.__data_model.viewable_worksheets
 
+    def add_viewable_worksheet(self, owner, id_number):
+        self.__data_model.viewable_worksheets.add((owner, id_number))
+        self.modified = True
+
+    def discard_viewable_worksheet(self, owner, id_number):
+        self.__data_model.viewable_worksheets.discard((owner, id_number))
+        self.modified = True
+
     # Utility methods
 
     def __eq__(self, other):
@@ -121,6 +138,7 @@ class User(object):
 
     def __setitem__(self, *args):
         self.__data_model.conf.__setitem__(*args)
+        self.modified = True
 
     @property
     def basic(self):
@@ -176,10 +194,12 @@ class User(object):
     def grant_admin(self):
         if not self.is_guest:
             self.__data_model.account_type = CFG.UAT_ADMIN
+            self.modified = True
 
     def revoke_admin(self):
         if not self.is_guest:
             self.__data_model.account_type = CFG.UAT_USER
+            self.modified = True
 
     def check_password(self, password):
         # the empty password is always false
@@ -234,12 +254,49 @@ class UserManager(dict):
                 ldap_timeout=ldap_timeout,
                 ),
         }
+        # Stored users, which are loaded on first access
+        self._stored = set()
+        self._load_user = None
+        self._load_lock = threading.Lock()
+
+    def set_stored_users(self, usernames, load_user):
+        """
+        Register users kept in a storage. Each one is loaded on its first
+        access by calling ``load_user(username)``.
+
+        INPUT:
+
+        - ``usernames`` - iterable of strings
+
+        - ``load_user`` - function which returns the stored user with the
+          given username
+        """
+        self._stored = set(usernames).difference(dict.keys(self))
+        self._load_user = load_user
+
+    @property
+    def loaded_users(self):
+        """
+        Return a dictionary of the users which are already loaded.
+        """
+        return dict(dict.items(self))
 
     def __missing__(self, username):
         """
-        Check all auth methods that are enabled in the notebook's config.
-        If a valid username is found, a new User object will be created.
+        Load the user from the storage if it is a stored one.
+
+        Otherwise check all auth methods that are enabled in the notebook's
+        config. If a valid username is found, a new User object will be
+        created.
         """
+        if username in self._stored:
+            with self._load_lock:
+                if dict.__contains__(self, username):
+                    return dict.__getitem__(self, username)
+                user = self._load_user(username)
+                self[username] = user
+                return user
+
         for a, method in self._auth_methods.items():
             if method.enabled and method.check_user(username):
                 try:
@@ -253,6 +310,37 @@ class UserManager(dict):
 
         raise KeyError('no user {!r}'.format(username))
 
+    def __setitem__(self, username, user):
+        dict.__setitem__(self, username, user)
+        self._stored.discard(username)
+
+    def __delitem__(self, username):
+        with self._load_lock:
+            if dict.__contains__(self, username):
+                dict.__delitem__(self, username)
+            elif username in self._stored:
+                self._stored.discard(username)
+            else:
+                raise KeyError('no user {!r}'.format(username))
+
+    def __contains__(self, username):
+        return dict.__contains__(self, username) or username in self._stored
+
+    def __iter__(self):
+        return iter(list(dict.keys(self)) + list(self._stored))
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._stored)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[username] for username in self]
+
+    def items(self):
+        return [(username, self[username]) for username in self]
+
     def __eq__(self, other):
         """
         EXAMPLES:
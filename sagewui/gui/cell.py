@@ -26,6 +26,7 @@ import re
 import shutil
 import textwrap
 import time
+import zlib
 from html import escape
 from random import randint
 from sys import maxsize
@@ -36,6 +37,7 @@ from ..util import set_restrictive_permissions
 from ..util import word_wrap
 from ..util.templates import render_template
 from ..util.text import format_exception
+from ..util.tracing import cell_tracer
 
 
 # This regexp matches "cell://blah..." in a non-greedy way (the ?), so
@@ -51,6 +53,9 @@ class Cell(object):
     """
     Generic (abstract) cell
     """
+    # Worksheets may hold thousands of cells, so cells have no __dict__.
+    __slots__ = ('__id', '__input', '__output', '__worksheet')
+
     def __init__(self, id, worksheet):
         """
         Creates a new generic cell.
@@ -276,6 +281,7 @@ class TextCell(Cell):
     """
     Text cell
     """
+    __slots__ = ('__input',)
     super_class = Cell
 
     def __init__(self, id, input, worksheet):
@@ -445,11 +451,27 @@ class TextCell(Cell):
         """
         return self.input
 
+    @property
+    def edit_state(self):
+        """
+        Returns a tuple which changes whenever :attr:`edit_text` changes.
+        It is cheaper to compute and compare than the edit text itself.
+        """
+        return (self.input,)
+
 
 class ComputeCell(Cell):
     """
     Compute cell
     """
+    __slots__ = (
+        'version', 'interrupted', 'evaluated', 'has_new_output',
+        'eval_method', '_out_html', '_url_to_self', '_word_being_completed',
+        '__interact_input', '__interact_output', '__changed_input',
+        '__introspect', '__introspect_html', '__input', '__output_data',
+        # cached_property storage of __parsed_input
+        '_____parsed_input___',
+        )
     super_class = Cell
 
     def __init__(self, id, input, output, worksheet):
@@ -496,6 +518,22 @@ class ComputeCell(Cell):
         self.__input = input  # property
         self.__output = output.replace('\r', '')
 
+    # Output storage. Large outputs are kept compressed and only expanded
+    # when they are accessed.
+
+    @property
+    def __output(self):
+        data = self.__output_data
+        if isinstance(data, bytes):
+            return zlib.decompress(data).decode('utf-8')
+        return data
+
+    @__output.setter
+    def __output(self, output):
+        if len(output) > CFG.MIN_COMPRESSED_OUTPUT:
+            output = zlib.compress(output.encode('utf-8'))
+        self.__output_data = output
+
     @property
     def introspect(self):
         return self.__introspect
@@ -1126,6 +1164,14 @@ class ComputeCell(Cell):
         """
         return self.format_text(plain=False)
 
+    @property
+    def edit_state(self):
+        """
+        Returns a tuple which changes whenever :attr:`edit_text` changes.
+        It is cheaper to compute and compare than the edit text itself.
+        """
+        return (self.__input, self.__output_data)
+
     def interrupt(self):
         """
         Sets this compute cell's evaluation as interrupted.
@@ -1561,6 +1607,7 @@ class ComputeCell(Cell):
         self.interrupted = False
         self.evaluated = True
         self.introspect = introspect
+        cell_tracer.start(self, username)
         self.worksheet().enqueue(self, username=username)
         # TODO:  move to storage backend
         self.delete_files()
@@ -1823,6 +1870,9 @@ class ComputeCell(Cell):
             jmol_script = jmol_script.replace(
                 'defaultdirectory "',
                 'defaultdirectory "{0}/'.format(self.url_to_worksheet()))
+            # Replaced, not modified, since cell files may share their
+            # contents (see storage.blobs)
+            os.unlink(jmol_name)
             with open(jmol_name, 'w') as f:
                 f.write(jmol_script)
 
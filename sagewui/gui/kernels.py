@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*
+"""
+Registry of the worksheet processes (kernels).
+
+A worksheet registers its process when it starts it
+(``Worksheet.sage``) and removes it when it quits (``Worksheet.quit``),
+so the registry only holds the running processes. The state of a kernel
+is one of:
+
+- ``starting`` - the process is being spawned
+- ``idle`` - the process is running and the worksheet queue is empty
+- ``busy`` - cells of the worksheet are queued or being computed
+- ``dead`` - the process exited or is stopped; the worksheet is quit on
+  the next check
+
+The periodic checks of ``NotebookUpdater`` call :meth:`~KernelRegistry.
+heartbeat`, which detects the dead kernels, and :meth:`~KernelRegistry.
+apply_policies`, which quits the kernels idle or running for too long.
+The processes which have been quit are reaped, so that they don't stay
+as zombies.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+
+import os
+import threading
+import time
+
+from ..util.locks import worksheet_locks
+from ..util.processes import process_state
+
+STARTING = 'starting'
+IDLE = 'idle'
+BUSY = 'busy'
+DEAD = 'dead'
+STATES = (STARTING, IDLE, BUSY, DEAD)
+
+
+class Kernel(object):
+    def __init__(self, worksheet):
+        """
+        INPUT:
+
+        - ``worksheet`` - the Worksheet whose process is starting
+        """
+        self.worksheet = worksheet
+        self.process = None
+        self.pid = None
+        self.started = time.time()
+        self.last_heartbeat = None
+        self.dead = False
+
+    def __repr__(self):
+        return 'Kernel of {} ({})'.format(self.worksheet.filename, self.state)
+
+    @property
+    def state(self):
+        if self.dead:
+            return DEAD
+        if self.process is None:
+            return STARTING
+        return BUSY if self.worksheet.queue else IDLE
+
+    def uptime(self):
+        return time.time() - self.started
+
+
+class KernelRegistry(object):
+    def __init__(self):
+        # worksheet filename -> Kernel
+        self._kernels = {}
+        # pids of the processes which have been quit, not yet reaped
+        self._unreaped = set()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Registry of {} kernels'.format(len(self))
+
+    def __len__(self):
+        return len(self._kernels)
+
+    def __contains__(self, worksheet):
+        return worksheet.filename in self._kernels
+
+    @property
+    def kernels(self):
+        """
+        The list of the registered kernels.
+        """
+        with self._lock:
+            return list(self._kernels.values())
+
+    def counts(self):
+        """
+        Return a dict which maps the tuples ``(state,)`` to the number of
+        kernels in that state.
+        """
+        counts = dict(((state,), 0) for state in STATES)
+        for kernel in self.kernels:
+            counts[(kernel.state,)] += 1
+        return counts
+
+    def starting(self, worksheet):
+        """
+        Register the process of ``worksheet``, which is being spawned.
+        """
+        with self._lock:
+            # A process which exited is replaced
+            kernel = self._kernels.get(worksheet.filename)
+            if kernel is not None and kernel.pid is not None:
+                self._unreaped.add(kernel.pid)
+            self._kernels[worksheet.filename] = Kernel(worksheet)
+
+    def started(self, worksheet, process):
+        """
+        Register the spawned ``process`` of ``worksheet``.
+        """
+        with self._lock:
+            try:
+                kernel = self._kernels[worksheet.filename]
+            except KeyError:
+                kernel = self._kernels[worksheet.filename] = Kernel(
+                    worksheet)
+            kernel.process = process
+            kernel.pid = process.pid
+            kernel.last_heartbeat = time.time()
+
+    def remove(self, worksheet):
+        """
+        Remove the process of ``worksheet``, which has been quit (or failed
+        to start), and reap it.
+        """
+        with self._lock:
+            kernel = self._kernels.pop(worksheet.filename, None)
+            if kernel is not None and kernel.pid is not None:
+                self._unreaped.add(kernel.pid)
+        self.reap()
+
+    def reap(self):
+        """
+        Reap the processes which have been quit and have exited.
+        """
+        with self._lock:
+            for pid in list(self._unreaped):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                        # still exiting
+                        continue
+                except OSError:
+                    # already reaped (e.g., by pexpect)
+                    pass
+                self._unreaped.discard(pid)
+
+    def _quit(self, kernel, reason):
+        # The checks don't wait for the worksheets in use (see util.locks)
+        lock = worksheet_locks[kernel.worksheet.filename]
+        if not lock.acquire(False):
+            return
+        try:
+            if self._registered(kernel):
+                self._quit_locked(kernel, reason)
+        finally:
+            lock.release()
+
+    def _registered(self, kernel):
+        # False if the process has been quit (and maybe replaced) since
+        # the kernel was listed
+        with self._lock:
+            return self._kernels.get(kernel.worksheet.filename) is kernel
+
+    def _quit_locked(self, kernel, reason):
+        W = kernel.worksheet
+        # worksheet name may contain unicode, so we use %r, which prints
+        # the \xXX form for unicode characters
+        print('Quitting {} worksheet process for {!r}.'.format(
+            reason, W.name))
+        W.quit()
+
+    def heartbeat(self):
+        """
+        Check that the registered processes are alive. The worksheets of
+        the processes which exited or are stopped are quit. The worksheets
+        in use are checked on the next heartbeat.
+        """
+        now = time.time()
+        for kernel in self.kernels:
+            if kernel.process is None:
+                continue
+            # The checks don't wait for the worksheets in use (see
+            # util.locks), and don't probe a process being started or quit
+            lock = worksheet_locks[kernel.worksheet.filename]
+            if not lock.acquire(False):
+                continue
+            try:
+                if not self._registered(kernel):
+                    continue
+                S = kernel.process
+                if not S.is_alive() or \
+                        process_state(kernel.pid) in ('T', 'Z'):
+                    kernel.dead = True
+                    self._quit_locked(kernel, 'dead')
+                else:
+                    kernel.last_heartbeat = now
+            finally:
+                lock.release()
+        self.reap()
+
+    def apply_policies(self, idle_timeout=0, doc_timeout=0, walltime=0):
+        """
+        Quit the worksheet processes idle for more than ``idle_timeout``
+        seconds (``doc_timeout`` for the documentation worksheets), or
+        running for more than ``walltime`` seconds. A timeout of 0 means
+        no limit.
+
+        A worksheet is idle if it has not reported back that it is
+        actually computing, i.e., an ignored worksheet process (since the
+        user closed their browser) is also considered idle, even if code
+        is running.
+        """
+        for kernel in self.kernels:
+            if kernel.process is None:
+                continue
+            W = kernel.worksheet
+            timeout = doc_timeout if W.docbrowser else idle_timeout
+            if timeout > 0 and W.time_idle() > timeout:
+                self._quit(kernel, 'ignored')
+            elif walltime > 0 and kernel.uptime() > walltime:
+                self._quit(kernel, 'long running')
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*
+"""
+Resumable migrations of the notebook data.
+
+A :class:`Migration` applies a change to each user (or other item) of a
+notebook. The items are migrated in a pool of threads, and the migrated
+ones are recorded in a checkpoint of the datastore, so that an
+interrupted migration is resumed where it stopped. An item which fails
+is reported and left out of the checkpoint, without stopping the
+migration; the failed items are migrated again on the next run, and
+the migration is complete (its checkpoint is removed) once all of them
+have been migrated.
+
+A migration defines :meth:`~Migration.migrate`, which is run in the
+worker threads, so it must not change (or fill) the shared state of the
+notebook: it reads the items from the datastore. :meth:`~Migration.apply`
+is run in the calling thread.
+:meth:`~Migration.commit` saves what has been applied, before it is
+recorded in the checkpoint.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+
+import sys
+import traceback
+
+from .. import config as CFG
+from ..util import bounded_map
+from ..util import walltime
+
+
+class Migration(object):
+    name = None
+    title = None
+    # Number of migrated items between checkpoints
+    checkpoint_interval = 100
+
+    def __init__(self, notebook, workers=None):
+        """
+        INPUT:
+
+        - ``notebook`` - a Notebook instance
+
+        - ``workers`` - integer (default: the ``migration_workers`` server
+          option); the number of worker threads
+        """
+        self.notebook = notebook
+        self.storage = notebook._storage
+        self.workers = max(1, workers or notebook.conf['migration_workers'])
+
+    def __repr__(self):
+        return 'Migration {}'.format(self.name)
+
+    def items(self):
+        """
+        Return the list of the items (strings) to migrate.
+        """
+        return self.notebook._wst_usernames
+
+    def migrate(self, item):
+        """
+        Migrate ``item`` and return the result passed to :meth:`apply`.
+        Run in a worker thread.
+        """
+        raise NotImplementedError
+
+    def apply(self, item, result):
+        """
+        Apply the ``result`` of the migration of ``item``. Run in the
+        calling thread.
+        """
+        pass
+
+    def commit(self):
+        """
+        Save the changes applied so far.
+        """
+        pass
+
+    def finish(self):
+        """
+        Called once all the items have been migrated, before the last
+        :meth:`commit`.
+        """
+        pass
+
+    def _migrate(self, item):
+        # Errors are isolated to their items
+        try:
+            return True, self.migrate(item)
+        except Exception:
+            return False, traceback.format_exc()
+
+    def _checkpoint(self, items):
+        self.commit()
+        self.storage.checkpoint_migration(self.name, items)
+
+    def run(self):
+        """
+        Migrate the items not yet migrated, printing the progress.
+
+        OUTPUT:
+
+        - the list of the items which failed; the migration is complete
+          if it is empty
+        """
+        done = self.storage.load_migration_checkpoint(self.name)
+        items = self.items()
+        if done is not None:
+            items = [item for item in items if item not in done]
+            print('{}: resuming, {} items already migrated'.format(
+                self.title, len(done)))
+        total = len(items)
+        step = max(1, min(self.checkpoint_interval, total // 10))
+        failed = []
+        migrated = []
+        t = walltime()
+        for i, (item, (ok, result)) in enumerate(
+                bounded_map(self._migrate, items, self.workers), 1):
+            if ok:
+                self.apply(item, result)
+                migrated.append(item)
+            else:
+                failed.append(item)
+                print('{}: error on {}\n{}'.format(self.title, item, result),
+                      file=sys.stderr)
+            if len(migrated) >= self.checkpoint_interval:
+                self._checkpoint(migrated)
+                migrated = []
+            if i % step == 0 or i == total:
+                elapsed = walltime(t)
+                print('{}: {}/{} ({:.1f} per second, {} errors)'.format(
+                    self.title, i, total, i / elapsed if elapsed else 0,
+                    len(failed)))
+
+        if failed:
+            self._checkpoint(migrated)
+            print('{}: {} items failed, they will be migrated again on the '
+                  'next run'.format(self.title, len(failed)), file=sys.stderr)
+        else:
+            self.finish()
+            self.commit()
+            self.storage.remove_migration_checkpoint(self.name)
+        return failed
+
+
+class SharedWorksheetsMigration(Migration):
+    """
+    Model version 1: cache the worksheets shared with each user in the
+    User object.
+    """
+    name = 'model_1'
+    title = 'Upgrading to model version 1'
+
+    def migrate(self, username):
+        try:
+            return [(w.owner, w.id_number, w.collaborators)
+                    for w in self.storage.worksheets(username)]
+        except (UnicodeEncodeError, OSError):
+            # Catch UnicodeEncodeError because sometimes a username has
+            # a non-ascii character Catch OSError since sometimes when
+            # moving user directories (which happens automatically when
+            # getting user's worksheets), OSError: [Errno 39] Directory
+            # not empty is thrown (we should be using shutil.move
+            # instead, probably) users with these problems won't have
+            # their sharing cached, but they will probably have
+            # problems logging in anyway, so they probably won't notice
+            # not having shared worksheets
+            print('Error on username %s' % username.encode('utf8'),
+                  file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+            return []
+
+    def apply(self, username, shared):
+        user_manager = self.notebook.user_manager
+        for owner, id_number, collaborators in shared:
+            for u in collaborators:
+                try:
+                    user_manager[u].add_viewable_worksheet(owner, id_number)
+                except KeyError:
+                    # user doesn't exist
+                    pass
+
+    def commit(self):
+        self.storage.save_users(self.notebook.user_manager.loaded_users)
+        self.storage.save_server_conf(self.notebook.conf)
+
+    def finish(self):
+        self.notebook.conf['model_version'] = 1
+
+
+class PublishedIdMigration(Migration):
+    """
+    Repair notebooks with the old unpublish method, which left the
+    published id number of worksheets without a published version.
+    """
+    name = 'repair_published_id'
+    title = 'Repairing published worksheets'
+
+    def migrate(self, username):
+        # The published versions are looked up one by one, without
+        # loading them
+        return set(
+            W.id_number for W in self.storage.worksheets(username)
+            if W.published_id_number is not None and
+            not self.storage.worksheet_exists(
+                CFG.UN_PUB, W.published_id_number))
+
+    def apply(self, username, id_numbers):
+        if not id_numbers:
+            return
+        for W in self.notebook.user_wsts(username):
+            if W.id_number in id_numbers:
+                W.published_id_number = None
+                W.save()
@@ -19,7 +19,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
-from builtins import str
 from builtins import object
 from builtins import open
 
@@ -28,20 +27,27 @@ import os
 import re
 import shutil
 import traceback
-import sys
+import threading
 
 from docutils.core import publish_parts
 
 from sagewui_kernels.sage.workers import sage
 from .. import config as CFG
 from ..storage import FilesystemDatastore
+from ..util import bounded_map
 from ..util import cached_property
 from ..util import make_path_relative
 from ..util import makedirs
 from ..util import set_restrictive_permissions
 from ..util import sort_worksheet_list
+from ..util import sync_tree
 from ..util import walltime
-from ..util.decorators import global_lock
+from ..util.locks import conf_lock
+from ..util.locks import InstrumentedLock
+from ..util.locks import users_lock
+from ..util.metrics import save_duration
+from ..util.processes import cpu_sampler
+from ..util.processes import process_group_usage
 from ..util.docHTMLProcessor import docutilsHTMLProcessor
 from ..util.docHTMLProcessor import SphinxHTMLProcessor
 from ..util.notification import logger
@@ -51,7 +57,11 @@ from ..util.text import extract_text
 
 from ..models import ServerConfiguration
 from ..controllers import UserManager
-from .worksheet import update_worksheets
+from .kernels import KernelRegistry
+from .migrations import PublishedIdMigration
+from .migrations import SharedWorksheetsMigration
+from .pub_catalog import PubCatalog
+from .pub_catalog import PubEntry
 
 
 class WorksheetDict(dict):
@@ -88,37 +98,72 @@ class NotebookUpdater(object):
         self.notebook = notebook
         self.save_interval = notebook.conf['save_interval']
         self.idle_interval = notebook.conf['idle_check_interval']
+        self.kernel_interval = notebook.conf['kernel_check_interval']
+        self.collect_interval = notebook.conf['blob_collect_interval']
         self.last_save_time = walltime()
+        self.last_collect_time = walltime()
         self.last_idle_time = walltime()
+        self.last_kernel_time = walltime()
+        # Requests don't wait for a save or a kernel check in progress, they
+        # skip it (see util.locks for the lock ordering)
+        self.save_lock = InstrumentedLock(threading.Lock(), 'save_lock')
+        self.idle_lock = InstrumentedLock(threading.Lock(), 'idle_lock')
 
     def save_check(self):
         t = walltime()
-        if t > self.last_save_time + self.save_interval:
-            with global_lock:
+        if t > self.last_save_time + self.save_interval and \
+                self.save_lock.acquire(False):
+            try:
                 # if someone got the lock before we did, they might have saved,
-                # so we check against the last_save_time again we don't put the
-                # global_lock around the outer loop since we don't need it
-                # unless we are actually thinking about saving.
+                # so we check against the last_save_time again
                 if t > self.last_save_time + self.save_interval:
                     self.notebook.save()
                     self.last_save_time = t
+            finally:
+                self.save_lock.release()
+
+    def collect_check(self):
+        t = walltime()
+        if t > self.last_collect_time + self.collect_interval and \
+                self.save_lock.acquire(False):
+            try:
+                if t > self.last_collect_time + self.collect_interval:
+                    self.notebook.collect_files()
+                    self.last_collect_time = t
+            finally:
+                self.save_lock.release()
 
     def idle_check(self):
         t = walltime()
-        if t > self.last_idle_time + self.idle_interval:
-            with global_lock:
+        if t > self.last_idle_time + self.idle_interval and \
+                self.idle_lock.acquire(False):
+            try:
                 # if someone got the lock before we did, they might have
                 # already idled, so we check against the last_idle_time again
-                # we don't put the global_lock around the outer loop since we
-                # don't need it unless we are actually thinking about quitting
-                # worksheets
                 if t > self.last_idle_time + self.idle_interval:
-                    self.notebook.update_worksheet_processes()
-                    self.notebook.quit_idle_worksheet_processes()
+                    conf = self.notebook.conf
+                    self.notebook.kernel_registry.apply_policies(
+                        conf['idle_timeout'], conf['doc_timeout'],
+                        conf['kernel_walltime'])
                     self.last_idle_time = t
+            finally:
+                self.idle_lock.release()
+
+    def kernel_check(self):
+        t = walltime()
+        if t > self.last_kernel_time + self.kernel_interval and \
+                self.idle_lock.acquire(False):
+            try:
+                if t > self.last_kernel_time + self.kernel_interval:
+                    self.notebook.kernel_registry.heartbeat()
+                    self.last_kernel_time = t
+            finally:
+                self.idle_lock.release()
 
     def update(self):
         self.save_check()
+        self.collect_check()
+        self.kernel_check()
         self.idle_check()
 
 
@@ -137,6 +182,16 @@ class Notebook(object):
 
         S = FilesystemDatastore(dir)
         self._storage = S
+        # Worksheets may be created concurrently, e.g., by bulk imports
+        self._id_number_lock = threading.Lock()
+        self._worksheets_lock = threading.Lock()
+        self._pub_lock = threading.Lock()
+        # The histories are appended to by concurrent requests
+        self._history_lock = threading.Lock()
+        self._user_history = {}
+        # number of entries of each history not yet in the storage
+        self._user_history_unsaved = {}
+        self.kernel_registry = KernelRegistry()
 
         # Now set the configuration, loaded from the datastore.
         try:
@@ -152,6 +207,7 @@ class Notebook(object):
             #  and default values for missing properties
             C['model_version'] = 1
             self.conf = C
+        S.cell_storage = self.conf['cell_storage']
 
         self.user_manager = UserManager(
             auth_ldap=self.conf['auth_ldap'],
@@ -175,23 +231,9 @@ class Notebook(object):
         except IOError:
             pass
 
-        # Set the list of worksheets
-        W = WorksheetDict(S)
-        self.__worksheets = W
-
-        # Store / Refresh public worksheets
-        for id_number in os.listdir(self._storage._abspath(
-                S._user_path(CFG.UN_PUB))):
-            if id_number.isdigit():
-                a = "pub/" + str(id_number)
-                if a not in W:
-                    try:
-                        W[a] = self._storage.load_worksheet(
-                            CFG.UN_PUB, int(id_number))
-                    except Exception:
-                        print("Warning: problem loading %s/%s: %s" % (
-                            CFG.UN_PUB, int(id_number),
-                            traceback.format_exc()))
+        # Set the list of worksheets. They are loaded on demand, the
+        # published ones too (the /pub/ listing uses the pub_catalog).
+        self.__worksheets = WorksheetDict(S)
 
         # Old stuff
         self.updater = NotebookUpdater(self)
@@ -199,15 +241,15 @@ class Notebook(object):
     # Repair broken notebooks. This is for migrations from official notebooks
 
     def repair(self):
+        # Rebuild the index of published worksheets from the published
+        # worksheets themselves
+        self._storage.save_pub_index(self._build_pub_index())
+        del self._pub_index
+        self._storage.save_pub_catalog(self._build_pub_catalog())
+        del self.pub_catalog
         # mynb: repair notebooks with old unpublish method with missing
         # published worksheets
-        for wst in self.all_wsts:
-            if wst.published_id_number is not None:
-                try:
-                    self.filename_wst(wst.published_filename)
-                except KeyError:
-                    wst.published_id_number = None
-                    wst.save()
+        PublishedIdMigration(self).run()
 
     # App controller
 
@@ -241,16 +283,31 @@ class Notebook(object):
         """
         Save this notebook server to disk.
         """
+        t = walltime()
         S = self._storage
-        S.save_users(self.user_manager)
-        S.save_server_conf(self.conf)
+        with users_lock.read():
+            S.save_users(self.user_manager.loaded_users)
+        with conf_lock.read():
+            S.save_server_conf(self.conf)
         # Save the non-doc-browser worksheets.
         for n, W in self.__worksheets.items():
             if not n.startswith('doc_browser'):
                 S.save_worksheet(W)
-        if hasattr(self, '_user_history'):
-            for username, H in self._user_history.items():
-                S.save_user_history(username, H)
+        self.save_user_history()
+        save_duration.observe(walltime(t))
+
+    def collect_files(self):
+        """
+        Remove the stored contents of the worksheet files which were
+        deleted or replaced since the last collection.
+
+        It walks the whole store, so it runs on its own interval
+        (``blob_collect_interval``) rather than with every save.
+        """
+        number, size = self._storage.collect_files()
+        if number:
+            logger.info('Removed %d unused worksheet files (%d bytes)',
+                        number, size)
 
     def logout(self, username):
         r"""
@@ -270,56 +327,46 @@ class Notebook(object):
         """
         model_version = self.conf['model_version']
         if model_version is None or model_version < 1:
-            print("Upgrading model version to version 1")
-            # this uses code from all_wsts()
-            user_manager = self.user_manager
-            num_users = 0
-            for username in self.user_manager:
-                num_users += 1
-                if num_users % 1000 == 0:
-                    print('Upgraded %d users' % num_users)
-                if username in (CFG.UN_SAGE, CFG.UN_PUB):
-                    continue
-                try:
-                    for w in self.user_wsts(username):
-                        owner = w.owner
-                        id_number = w.id_number
-                        collaborators = w.collaborators
-                        for u in collaborators:
-                            try:
-                                user_manager[u].viewable_worksheets.add(
-                                    (owner, id_number))
-                            except KeyError:
-                                # user doesn't exist
-                                pass
-                except (UnicodeEncodeError, OSError):
-                    # Catch UnicodeEncodeError because sometimes a username has
-                    # a non-ascii character Catch OSError since sometimes when
-                    # moving user directories (which happens automatically when
-                    # getting user's worksheets), OSError: [Errno 39] Directory
-                    # not empty is thrown (we should be using shutil.move
-                    # instead, probably) users with these problems won't have
-                    # their sharing cached, but they will probably have
-                    # problems logging in anyway, so they probably won't notice
-                    # not having shared worksheets
-                    print('Error on username %s' % username.encode('utf8'),
-                          file=sys.stderr)
-                    print(traceback.format_exc(), sys.stderr)
-            print('Done upgrading to model version 1')
-            self.conf['model_version'] = 1
+            # Resumed if it was interrupted
+            SharedWorksheetsMigration(self).run()
+
+    def _scan(self, function, items, title=None):
+        """
+        Yield the pairs ``(item, function(item))`` for the ``items``, in
+        order of completion, computing them in ``CFG.BULK_WORKERS``
+        threads. The progress is printed if a ``title`` is given.
+        """
+        items = list(items)
+        step = max(1, len(items) // 10)
+        for i, pair in enumerate(
+                bounded_map(function, items, CFG.BULK_WORKERS), 1):
+            if title is not None and (i % step == 0 or i == len(items)):
+                print('{}: {}/{}'.format(title, i, len(items)))
+            yield pair
+
+    @property
+    def _wst_usernames(self):
+        """
+        The users who own worksheets, i.e., all but the sage and pub
+        users.
+        """
+        return [username for username in self.user_manager
+                if username not in (CFG.UN_SAGE, CFG.UN_PUB)]
 
     # App controller. The notebook history.
 
     def user_history(self, username):
-        if not hasattr(self, '_user_history'):
-            self._user_history = {}
+        maxlen = self.user_manager[username]['max_history_length']
+        with self._history_lock:
+            return self._load_user_history(username, maxlen)
+
+    def _load_user_history(self, username, maxlen):
+        # Called with the history lock
         if username in self._user_history:
             return self._user_history[username]
-        history = []
-        for hunk in self._storage.load_user_history(username):
-            hunk = hunk
-            history.append(hunk)
+        history = self._storage.load_user_history(username, maxlen)
         self._user_history[username] = history
+        self._user_history_unsaved[username] = 0
         return history
 
     def user_history_text(self, username, maxlen=None):
@@ -329,14 +376,40 @@ class Notebook(object):
         return '\n\n'.join([hunk.strip() for hunk in history])
 
     def add_to_user_history(self, entry, username):
-        history = self.user_history(username)
-        history.append(entry)
         maxlen = self.user_manager[username]['max_history_length']
-        while len(history) > maxlen:
-            del history[0]
+        with self._history_lock:
+            history = self._load_user_history(username, maxlen)
+            history.append(entry)
+            self._user_history_unsaved[username] += 1
+            while len(history) > maxlen:
+                del history[0]
+
+    def save_user_history(self):
+        """
+        Append the new entries of the user histories to the storage.
+        """
+        # The new entries are taken under the lock and written without it
+        new_entries = []
+        with self._history_lock:
+            for username, n in self._user_history_unsaved.items():
+                if n:
+                    new_entries.append(
+                        (username, self._user_history[username][-n:]))
+                    self._user_history_unsaved[username] = 0
+        for username, entries in new_entries:
+            maxlen = self.user_manager[username]['max_history_length']
+            self._storage.append_user_history(username, entries, maxlen)
 
     # User query
 
+    def delete_user(self, username):
+        """
+        Delete the user ``username`` from the user manager and from the
+        storage. Raise KeyError if there is no such user.
+        """
+        del self.user_manager[username]
+        self._storage.delete_user(username)
+
     def readonly_user(self, username):
         """
         Returns True if the user is supposed to only be a read-only user.
@@ -356,21 +429,111 @@ class Notebook(object):
     @property
     def _pub_wsts(self):
         path = self._storage._abspath(self._storage._user_path(CFG.UN_PUB))
-        v = []
-        a = ""
-        for id_number in (idn for idn in os.listdir(path) if idn.isdigit()):
-            a = '/'.join((CFG.UN_PUB, id_number))
-            if a not in self.__worksheets:
-                try:
-                    self.__worksheets[a] = self._storage.load_worksheet(
-                        "pub", int(id_number))
-                except Exception:
-                    print('Warning: problem loading {}: {}'.format(
-                        a, traceback.format_exc()))
-                    continue
-
-            v.append(self.__worksheets[a])
-        return v
+        filenames = ['/'.join((CFG.UN_PUB, idn)) for idn in os.listdir(path)
+                     if idn.isdigit()]
+        missing = [a for a in filenames if a not in self.__worksheets]
+        if missing:
+            for a, W in self._scan(self._load_pub_wst, missing,
+                                   'Loaded published worksheets'):
+                if W is not None:
+                    with self._worksheets_lock:
+                        self.__worksheets.setdefault(a, W)
+        return [self.__worksheets[a] for a in filenames
+                if a in self.__worksheets]
+
+    def _load_pub_wst(self, filename):
+        try:
+            return self._storage.load_worksheet(
+                CFG.UN_PUB, int(filename.split('/')[1]))
+        except Exception:
+            print('Warning: problem loading {}: {}'.format(
+                filename, traceback.format_exc()))
+
+    @cached_property()
+    def _pub_index(self):
+        """
+        Dict which maps the filenames of the published worksheets to the
+        id numbers of their published versions. It is saved by the
+        datastore, and built from the published worksheets only once.
+        """
+        index = self._storage.load_pub_index()
+        if index is None:
+            index = self._build_pub_index()
+            self._storage.save_pub_index(index)
+        return index
+
+    def _build_pub_index(self):
+        index = {}
+        for X in self._pub_wsts:
+            owner, id_number = X.worksheet_that_was_published
+            if owner != CFG.UN_PUB:
+                index['{}/{}'.format(owner, id_number)] = X.id_number
+        return index
+
+    def _update_pub_index(self, filename, id_number=None):
+        """
+        Map the worksheet ``filename`` to the published worksheet
+        ``id_number``, or remove it from the index if ``id_number`` is
+        None, and save the index.
+        """
+        with self._pub_lock:
+            if id_number is None:
+                if self._pub_index.pop(filename, None) is None:
+                    return
+            else:
+                self._pub_index[filename] = id_number
+            self._storage.save_pub_index(self._pub_index)
+
+    @cached_property()
+    def pub_catalog(self):
+        """
+        The :class:`~sagewui.gui.pub_catalog.PubCatalog` of the published
+        worksheets. It is saved by the datastore, and built from the
+        published worksheets only once.
+        """
+        catalog = self._storage.load_pub_catalog()
+        if catalog is None:
+            catalog = self._build_pub_catalog()
+            self._storage.save_pub_catalog(catalog)
+        return PubCatalog(PubEntry.from_basic(e) for e in catalog.values())
+
+    def _build_pub_catalog(self):
+        return dict((W.id_number, entry.basic) for W, entry in self._scan(
+            PubEntry.from_worksheet, self._pub_wsts))
+
+    def _update_pub_catalog(self, W, tokens=True):
+        """
+        Update the catalog entry of the published worksheet ``W``. The
+        search tokens are only computed again if ``tokens``.
+        """
+        with self._pub_lock:
+            old = self.pub_catalog.get(W.id_number)
+            entry = PubEntry.from_worksheet(
+                W, None if tokens or old is None else old.tokens)
+            if self.pub_catalog.update(entry):
+                self._storage.update_pub_catalog([entry.basic])
+
+    def _remove_from_pub_catalog(self, id_number):
+        with self._pub_lock:
+            if self.pub_catalog.remove(id_number):
+                self._storage.update_pub_catalog(removed=[id_number])
+
+    def published_wst(self, worksheet):
+        """
+        Return the published version of ``worksheet``, or None if it
+        has not been published.
+        """
+        try:
+            id_number = self._pub_index[worksheet.filename]
+            W = self.id_wst((CFG.UN_PUB, id_number))
+        except KeyError:
+            return None
+        if tuple(W.worksheet_that_was_published) != (
+                worksheet.owner, worksheet.id_number):
+            # Stale entry
+            self._update_pub_index(worksheet.filename)
+            return None
+        return W
 
     def _user_viewable_wsts(self, username):
         r"""
@@ -487,9 +650,9 @@ class Notebook(object):
         """
         We should only call this if the user is admin!
         """
-        return [w for username in self.user_manager
-                if username not in (CFG.UN_SAGE, CFG.UN_PUB)
-                for w in self.user_wsts(username)]
+        return [w for username, worksheets in self._scan(
+                    self.user_wsts, self._wst_usernames)
+                for w in worksheets]
 
     # Worksheet controller
 
@@ -498,12 +661,13 @@ class Notebook(object):
         Find the next worksheet id for the given user.
         """
         u = self.user_manager[username]
-        id_number = u['next_worksheet_id_number']
-        if id_number == -1:  # need to initialize
-            id_numbers = [w.id_number for w in self.user_wsts(username)]
-            id_numbers.append(-1)
-            id_number = max(id_numbers) + 1
-        u['next_worksheet_id_number'] = id_number + 1
+        with self._id_number_lock:
+            id_number = u['next_worksheet_id_number']
+            if id_number == -1:  # need to initialize
+                id_numbers = [w.id_number for w in self.user_wsts(username)]
+                id_numbers.append(-1)
+                id_number = max(id_numbers) + 1
+            u['next_worksheet_id_number'] = id_number + 1
         return id_number
 
     def initialize_wst(self, src, W):
@@ -515,15 +679,19 @@ class Notebook(object):
         - ``src`` - a Worksheet instance; the source
 
         - ``W`` - a new Worksheet instance; the target
+
+        Only the files which changed since the last initialization of
+        ``W`` are copied. Cell files are hard linked, since they are
+        replaced, not modified, when the cells are evaluated. Data files
+        are reflinked or copied, since the worksheet code may modify them.
         """
     # TODO: move to storage backend
-        shutil.rmtree(W.cells_directory, ignore_errors=True)
-        shutil.rmtree(W.data_directory, ignore_errors=True)
+        sync_tree(src.cells_directory, W.cells_directory)
+        sync_tree(src.data_directory, W.data_directory, link=False)
         shutil.rmtree(W.snapshot_directory, ignore_errors=True)
-        shutil.copytree(src.cells_directory, W.cells_directory)
-        shutil.copytree(src.data_directory, W.data_directory)
         makedirs(W.snapshot_directory)
         set_restrictive_permissions(W.snapshot_directory)
+        del W.snapshots
 
         W.edit_save(src.body)
         W.save()
@@ -548,7 +716,8 @@ class Notebook(object):
             W = S.load_worksheet(username, id_number)
         except ValueError:
             W = S.create_worksheet(username, id_number, **kwargs)
-        self.__worksheets[W.filename] = W
+        with self._worksheets_lock:
+            self.__worksheets[W.filename] = W
         return W
 
     @cached_property()
@@ -564,7 +733,8 @@ class Notebook(object):
         W.system = self.user_manager[username]['default_system']
         W.name = worksheet_name
         self.save_worksheet(W)
-        self.__worksheets[W.filename] = W
+        with self._worksheets_lock:
+            self.__worksheets[W.filename] = W
 
         return W
 
@@ -599,6 +769,14 @@ class Notebook(object):
         W.quit()
         shutil.rmtree(W.directory, ignore_errors=False)
 
+        if filename.startswith(CFG.UN_PUB + '/'):
+            source = '{}/{}'.format(*W.worksheet_that_was_published)
+            if self._pub_index.get(source) == W.id_number:
+                self._update_pub_index(source)
+            self._remove_from_pub_catalog(W.id_number)
+        else:
+            self._update_pub_index(filename)
+
     def empty_trash(self, username):
         """
         Empty the trash for the given user.
@@ -627,7 +805,8 @@ class Notebook(object):
             if W.owner is None:
                 self.delete_wst(W.filename)
 
-    def export_wst(self, worksheet_filename, output_filename, title=None):
+    def export_wst(self, worksheet_filename, output_filename, title=None,
+                   compression=None):
         """
         Export a worksheet, creating a sws file on the file system.
 
@@ -639,13 +818,54 @@ class Notebook(object):
 
             - ``title`` - title to use for the exported worksheet (if
                None, just use current title)
+
+            - ``compression`` - the compression of the sws file (if None,
+               use the ``sws_compression`` server option)
+        """
+        S = self._storage
+        W = self.filename_wst(worksheet_filename)
+        S.save_worksheet(W)
+        S.export_worksheet(
+            W.owner, W.id_number, output_filename, title=title,
+            compression=compression or self.conf['sws_compression'])
+
+    def export_wst_stream(self, worksheet_filename, title=None,
+                          compression=None):
+        """
+        Export a worksheet as an iterator of chunks of its sws file, which
+        is built while it is consumed.
+
+        INPUT:
+
+            -  ``worksheet_filename`` - a string e.g., 'username/id_number'
+
+            - ``title`` - title to use for the exported worksheet (if
+               None, just use current title)
+
+            - ``compression`` - the compression of the sws file (if None,
+               use the ``sws_compression`` server option)
         """
         S = self._storage
         W = self.filename_wst(worksheet_filename)
         S.save_worksheet(W)
-        username = W.owner
-        id_number = W.id_number
-        S.export_worksheet(username, id_number, output_filename, title=title)
+        return S.export_worksheet_stream(
+            W.owner, W.id_number, title=title,
+            compression=compression or self.conf['sws_compression'])
+
+    def store_wst_files(self, paths):
+        """
+        Store the cell files (or directories) ``paths`` of worksheets,
+        e.g., those created by an evaluation, so that identical files
+        share their contents.
+        """
+        self._storage.store_files(paths)
+
+    def wst_file_hash(self, path):
+        """
+        Return the hash of the contents of the file ``path`` of a
+        worksheet, which is used as its ETag.
+        """
+        return self._storage.file_hash(path)
 
     def import_wst(self, filename, owner):
         r"""
@@ -722,7 +942,8 @@ class Notebook(object):
         else:
             # We only support txt, sws, html and rst files
             raise ValueError("unknown extension '%s'" % ext)
-        self.__worksheets[W.filename] = W
+        with self._worksheets_lock:
+            self.__worksheets[W.filename] = W
         return W
 
     def _import_wst_txt(self, filename, owner):
@@ -901,8 +1122,7 @@ class Notebook(object):
 
         # FIXME: An extra compute cell is always added to the end.
         # Pop it off.
-        cells = worksheet.cells
-        cells.pop()
+        worksheet.pop_cell()
 
         return worksheet
 
@@ -1091,12 +1311,8 @@ class Notebook(object):
                 'Mark/0'), 'Mark')
             pub/0: [Cell 1: in=, out=]
         """
-        W = None
-
         # Reuse an existing published version
-        for X in self.user_wsts(CFG.UN_PUB):
-            if self.came_from_wst(X) == worksheet:
-                W = X
+        W = self.published_wst(worksheet)
 
         # Or create a new one.
         if W is None:
@@ -1111,16 +1327,24 @@ class Notebook(object):
         worksheet.published_id_number = W.id_number
         W.record_edit(username)
         W.name = worksheet.name
-        self.__worksheets[W.filename] = W
+        with self._worksheets_lock:
+            self.__worksheets[W.filename] = W
         W.save()
+        self._update_pub_index(worksheet.filename, W.id_number)
+        self._update_pub_catalog(W)
         return W
 
     def unpublish_wst(self, worksheet):
         self.delete_wst(worksheet.published_filename)
         worksheet.published_id_number = None
+        self._update_pub_index(worksheet.filename)
 
     def save_worksheet(self, W, conf_only=False):
         self._storage.save_worksheet(W, conf_only=conf_only)
+        if conf_only and W.owner == CFG.UN_PUB and \
+                W.id_number in self.pub_catalog:
+            # e.g., a new rating
+            self._update_pub_catalog(W, tokens=False)
 
     def delete_doc_browser_worksheets(self):
         """Not used"""
@@ -1180,25 +1404,54 @@ class Notebook(object):
         for W in tuple(self.__worksheets.values()):
             W.quit()
 
-    def update_worksheet_processes(self):
-        update_worksheets()
-
-    def quit_idle_worksheet_processes(self):
-        timeout = self.conf['idle_timeout']
-        doc_timeout = self.conf['doc_timeout']
+    @property
+    def loaded_wsts(self):
+        """
+        The list of the worksheets loaded in memory.
+        """
+        return list(self.__worksheets.values())
 
-        for W in self.__worksheets.values():
-            if W.compute_process_has_been_started():
-                if W.docbrowser:
-                    W.quit_if_idle(doc_timeout)
-                else:
-                    W.quit_if_idle(timeout)
+    def kernels(self):
+        """
+        Return the list of the worksheet processes of the kernel registry
+        (see :mod:`.kernels`), as dicts with their worksheet, state,
+        resource usage and activity. The resource usage (see
+        :mod:`sagewui.util.processes`) is None for the processes which run
+        on a remote host.
+        """
+        running = self.kernel_registry.kernels
+        usage = process_group_usage()
+        usage = cpu_sampler.sample(dict(
+            (k.pid, usage[k.pid]) for k in running if k.pid in usage))
+
+        kernels = []
+        for k in running:
+            W = k.worksheet
+            S = k.process
+            host = None if S is None else S.host
+            u = usage.get(k.pid, {}) if host == 'localhost' else {}
+            kernels.append({
+                'worksheet': W.filename,
+                'name': W.name,
+                'owner': W.owner,
+                'state': k.state,
+                'pid': k.pid,
+                'host': host,
+                'uptime': k.uptime(),
+                'last_heartbeat': k.last_heartbeat,
+                'rss': u.get('rss'),
+                'cpu_time': u.get('cpu_time'),
+                'cpu_percent': u.get('cpu_percent'),
+                'processes': u.get('processes'),
+                'computing': S is not None and S.is_computing(),
+                'queue': len(W.queue),
+                'idle': max(0, W.time_idle()),
+                })
+        return kernels
 
     def quit_worksheet(self, W):
-        try:
-            del self.__worksheets[W.filename]
-        except KeyError:
-            pass
+        with self._worksheets_lock:
+            self.__worksheets.pop(W.filename, None)
 
 
 def load_notebook(dir, interface=None, port=None, secure=None,
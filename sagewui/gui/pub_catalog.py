@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*
+"""
+Catalog of the published worksheets.
+
+The listing of published worksheets (``/pub/``) needs only a few
+attributes of each worksheet: its name, publisher, last change and mean
+rating, and the words of its text for searches. The catalog keeps them
+for every published worksheet, so that the listing is sorted, searched
+and paginated without loading the worksheets. It is updated when a
+worksheet is published, rated or unpublished, and saved by the datastore.
+
+:class:`PubEntry` has the attributes and methods of a worksheet used by
+the listing template.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+
+import time
+
+from .. import config as CFG
+from ..util.text import search_keywords
+
+
+def search_tokens(worksheet):
+    """
+    Return the sorted list of the (lowercase) words searched by
+    :meth:`Worksheet.satisfies_search`.
+    """
+    text = ' '.join(
+        [worksheet.owner, worksheet.publisher, worksheet.name,
+         worksheet.saved_body] + worksheet.collaborators)
+    return sorted(set(text.lower().split()))
+
+
+class PubEntry(object):
+    __slots__ = ('id_number', 'name', 'publisher', 'source', 'last_change',
+                 'mean_rating', 'tokens')
+
+    def __init__(self, id_number, name, publisher, source, last_change,
+                 mean_rating, tokens):
+        self.id_number = id_number
+        self.name = name
+        self.publisher = publisher
+        self.source = source
+        self.last_change = last_change
+        self.mean_rating = mean_rating
+        self.tokens = tokens
+
+    def __repr__(self):
+        return 'PubEntry {}: {}'.format(self.filename, self.name)
+
+    def __eq__(self, other):
+        return isinstance(other, PubEntry) and self.basic == other.basic
+
+    def __ne__(self, other):
+        return not self == other
+
+    @classmethod
+    def from_worksheet(cls, W, tokens=None):
+        """
+        Return the entry of the published worksheet ``W``. The search
+        tokens are computed from its text unless they are given.
+        """
+        return cls(W.id_number, W.name, W.publisher,
+                   '{}/{}'.format(*W.worksheet_that_was_published),
+                   tuple(W.last_change), W.rating(),
+                   search_tokens(W) if tokens is None else tokens)
+
+    @property
+    def basic(self):
+        return {
+            'id_number': self.id_number,
+            'name': self.name,
+            'publisher': self.publisher,
+            'source': self.source,
+            'last_change': list(self.last_change),
+            'rating': self.mean_rating,
+            'tokens': self.tokens,
+            }
+
+    @classmethod
+    def from_basic(cls, basic):
+        return cls(basic['id_number'], basic['name'], basic['publisher'],
+                   basic['source'], tuple(basic['last_change']),
+                   basic['rating'], basic['tokens'])
+
+    # Worksheet interface used by the listing
+
+    @property
+    def filename(self):
+        return '{}/{}'.format(CFG.UN_PUB, self.id_number)
+
+    @property
+    def owner(self):
+        return CFG.UN_PUB
+
+    @property
+    def worksheet_that_was_published(self):
+        return tuple(self.source.split('/'))
+
+    def rating(self):
+        return self.mean_rating
+
+    def compute_process_has_been_started(self):
+        # Published worksheets are evaluated in proxy worksheets
+        return False
+
+    @property
+    def last_edited(self):
+        return self.last_change[1]
+
+    @property
+    def last_to_edit(self):
+        return self.last_change[0]
+
+    @property
+    def time_since_last_edited(self):
+        return time.time() - self.last_edited
+
+    def satisfies_search(self, search):
+        """
+        Return True if all the words of ``search`` are in the text of the
+        worksheet, as :meth:`Worksheet.satisfies_search` does, except that
+        the words of quoted phrases may appear anywhere.
+        """
+        for keyword in search_keywords(search):
+            for word in keyword.lower().split():
+                if not any(word in token for token in self.tokens):
+                    return False
+        return True
+
+
+class PubCatalog(object):
+    sort_keys = {
+        'last_edited': lambda e: -e.last_edited,
+        'name': lambda e: (e.name.lower(), -e.last_edited),
+        'owner': lambda e: (e.source.split('/')[0].lower(), -e.last_edited),
+        'rating': lambda e: (e.mean_rating, -e.last_edited),
+        }
+
+    def __init__(self, entries=()):
+        """
+        INPUT:
+
+        - ``entries`` - iterable of :class:`PubEntry`
+        """
+        self.entries = dict((e.id_number, e) for e in entries)
+
+    def __repr__(self):
+        return 'Catalog of {} published worksheets'.format(len(self))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, id_number):
+        return id_number in self.entries
+
+    def get(self, id_number):
+        return self.entries.get(id_number)
+
+    def update(self, entry):
+        """
+        Add or replace the entry of a published worksheet. Return False
+        if it didn't change.
+        """
+        if self.entries.get(entry.id_number) == entry:
+            return False
+        self.entries[entry.id_number] = entry
+        return True
+
+    def remove(self, id_number):
+        """
+        Remove the entry of a published worksheet. Return False if there
+        was none.
+        """
+        return self.entries.pop(id_number, None) is not None
+
+    def select(self, search=None, sort='last_edited', reverse=False):
+        """
+        Return the list of entries which satisfy ``search``, sorted as
+        :func:`~sagewui.util.sort_worksheet_list` sorts worksheets (by
+        the owner of the original worksheet instead of the owner, which is
+        always ``'pub'``).
+        """
+        try:
+            key = self.sort_keys[sort]
+        except KeyError:
+            raise ValueError('Invalid sort key {!r}'.format(sort))
+        v = list(self.entries.values())
+        if search:
+            v = [e for e in v if e.satisfies_search(search)]
+        v.sort(key=key, reverse=reverse)
+        return v
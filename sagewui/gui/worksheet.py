@@ -35,7 +35,6 @@ from builtins import range
 from builtins import object
 from builtins import open
 
-import bz2
 import calendar
 import os
 import re
@@ -43,6 +42,7 @@ import shutil
 import time
 
 from itertools import count
+from itertools import islice
 
 from flask_babel import gettext
 
@@ -56,6 +56,10 @@ from ..util import id_generator
 from ..util import set_default
 from ..util import set_restrictive_permissions
 from ..util import walltime
+from ..util.metrics import kernel_spawn_duration
+from ..util.metrics import storage_read
+from ..util.records import CellRecords
+from ..util.snapshots import SnapshotStore
 from ..util.templates import completions_html
 from ..util.templates import prettify_time_ago
 from ..util.text import best_completion
@@ -63,6 +67,7 @@ from ..util.text import extract_cells
 from ..util.text import ignore_prompts_and_output
 from ..util.text import search_keywords
 from ..util.text import extract_text
+from ..util.tracing import cell_tracer
 
 _ = gettext
 
@@ -70,18 +75,6 @@ _ = gettext
 # given user.
 
 
-all_worksheet_processes = []
-
-
-def update_worksheets():
-    """
-    Iterate through and "update" all the worksheets.  This is needed
-    for things like wall timeouts.
-    """
-    for S in all_worksheet_processes:
-        S.update()
-
-
 def Worksheet_from_basic(obj, notebook_worksheet_directory):
     """
     INPUT:
@@ -202,7 +195,11 @@ class Worksheet(object):
         # self.___cell_id_generator___  cached_property (writable)
         # self.___next_block_id_generator___  cached_property
         # self.___cells___ -> cached_property (writable, invalidates
-        #   cell_id_generator)
+        #   cell_id_generator and the cell indexes)
+        # self.___cell_index___  cached_property (id -> cell)
+        # self.___cell_positions___  cached_property (id -> position)
+        # self.___compute_cells___  cached_property
+        # self.___compute_cell_positions___  cached_property
         self.hidden_cell_id_generator = count(-1, -1)
         self.__filename = os.path.join(owner, str(id_number))  # property ro
         self.__computing = False
@@ -635,18 +632,28 @@ class Worksheet(object):
     def next_block_id_generator(self):
         return self.cell_id_generator_for_cells(self.cells)
 
-    @cached_property(writable=True, invalidate=('cell_id_generator',))
+    @cached_property(writable=True, invalidate=(
+        'cell_id_generator', 'cell_index', 'cell_positions', 'compute_cells'))
     def cells(self):
+        # TODO: move to storage backend
+        records = CellRecords(self.directory)
         worksheet_html = self.worksheet_html_filename
-        if not os.path.exists(worksheet_html):
+        if records.exists:
+            self.reset_interact_state()
+            saved = records.load()
+            cells = self.body_to_cells(records.body(saved))
+            # Bookkeeping of the per cell storage, so that only the cells
+            # modified from now on are written.
+            self._saved_cells = records.saved_state(saved, cells)
+        elif not os.path.exists(worksheet_html):
             cells = []
             for i in range(CFG.INITIAL_NUM_CELLS):
                 cells.append(self._new_cell(i))
         else:
             self.reset_interact_state()
-            # TODO: move to storage backend
             with open(worksheet_html) as f:
                 text = f.read()
+            storage_read.inc(len(text))
             cells = self.body_to_cells(text)
         return cells
 
@@ -778,15 +785,16 @@ class Worksheet(object):
         """
         return os.path.split(self.name)[-1]
 
-    def snapshot_filename(self, basename):
-        return os.path.join(
-            self.snapshot_directory, '{}.bz2'.format(basename))
+    @cached_property()
+    def snapshots(self):
+        return SnapshotStore(self.snapshot_directory)
 
     @property
     def snapshot_names(self):
-        return [
-            os.path.splitext(fname)[0] for fname in sorted(os.listdir(
-                self.snapshot_directory))]
+        return self.snapshots.keys
+
+    def snapshot_body(self, basename):
+        return self.snapshots.body(basename)
 
     # misc
 
@@ -1322,11 +1330,7 @@ class Worksheet(object):
         - a boolean
         """
         # Load the worksheet data file from disk.
-        try:
-            with open(self.worksheet_html_filename) as f:
-                contents = f.read()
-        except IOError:
-            contents = ''
+        contents = self.saved_body
 
         r = ' '.join(
             x.lower()
@@ -1393,12 +1397,12 @@ class Worksheet(object):
         # the last snapshot
         if not self.body_is_loaded:
             return
-        basename = '{:.0f}'.format(time.time())
-
-        with open(self.worksheet_html_filename, 'w') as f:
-            f.write(self.body)
-        with open(self.snapshot_filename(basename), 'wb') as f:
-            f.write(bz2.compress(self.body.encode('utf-8')))
+        self.save()
+        basename = self.snapshots.add('{:.0f}'.format(time.time()),
+                                      self.body)
+        if basename is None:
+            # Same body as the last snapshot
+            return
 
         self.limit_snapshots()
         self.saved_by_info[basename] = user
@@ -1419,12 +1423,7 @@ class Worksheet(object):
     def revert_to_last_saved_state(self):
         # TODO: worksheet_html_filename is useless. Worksheet body is always
         # the last snapshot
-        try:
-            with open(self.worksheet_html_filename) as f:
-                body = f.read()
-        except IOError:
-            body = ''
-        self.edit_save(body)
+        self.edit_save(self.saved_body)
 
     def limit_snapshots(self):
         r"""
@@ -1435,8 +1434,7 @@ class Worksheet(object):
         so this routine will not delete files created prior to this change.
 
         This assumes snapshot names correspond to the ``time.time()``
-        method used to create base filenames in seconds in UTC time,
-        and that there are no other extraneous files in the directory.
+        method used to create base filenames in seconds in UTC time.
         """
 
         # This should be user-configurable with an option like 'max_snapshots'
@@ -1445,10 +1443,12 @@ class Worksheet(object):
             time.strptime("01 May 2009", "%d %b %Y")))
 
         snapshots = self.snapshot_names
-        for snapshot in snapshots[:len(snapshots) - max_snaps]:
-            creation = int(snapshot)
-            if creation > amnesty:
-                os.remove(self.snapshot_filename(snapshot))
+        old = [snapshot for snapshot in snapshots[:len(snapshots) - max_snaps]
+               if int(snapshot) > amnesty]
+        if old:
+            self.snapshots.remove(old)
+            for snapshot in old:
+                self.saved_by_info.pop(snapshot, None)
 
     # Exporting cells in plain text command-line format
 
@@ -1473,6 +1473,22 @@ class Worksheet(object):
         return '\n\n'.join(
             t for t in (C.edit_text.strip() for C in self.cells) if t)
 
+    @property
+    def saved_body(self):
+        """
+        Return the body of this worksheet as it was last saved to disk,
+        either as ``worksheet.html`` or as per cell records.
+        """
+        # TODO: move to storage backend
+        records = CellRecords(self.directory)
+        if records.exists:
+            return records.body(records.load())
+        try:
+            with open(self.worksheet_html_filename) as f:
+                return f.read()
+        except IOError:
+            return ''
+
     @property
     def body_is_loaded(self):
         """
@@ -1480,7 +1496,7 @@ class Worksheet(object):
         """
         return hasattr(self, '___cells___')
 
-    def body_to_cells(self, text, ignore_ids=False):
+    def body_to_cells(self, text, ignore_ids=False, reuse=None):
         r"""
         Set the contents of this worksheet to the worksheet defined by
         the plain text string text, which should be a sequence of HTML
@@ -1493,6 +1509,11 @@ class Worksheet(object):
         -  ``ignore_ids`` - bool (default: False); if True
            ignore all the IDs in the {{{}}} code block.
 
+        -  ``reuse`` - dict (default: None); maps cell ids to existing
+           cells. A parsed cell whose id and contents match one of them
+           is not recreated: the existing cell is returned instead,
+           keeping its cached output HTML and file links.
+
 
         EXAMPLES:
 
@@ -1551,11 +1572,15 @@ class Worksheet(object):
             x[0] for typ, x in data if typ == 'compute' and x[0] is not None))
         used_ids = set()
 
+        reuse = set_default(reuse, {})
+
         cells = []
         for typ, T in data:
             if typ == 'plain':
                 id = next(id_gen)
-                C = self._new_text_cell(T, id=id)
+                C = reuse.get(id)
+                if not (isinstance(C, TextCell) and C.input == T):
+                    C = self._new_text_cell(T, id=id)
             elif typ == 'compute':
                 id, input, output = T
                 if not ignore_ids and id is not None:
@@ -1565,11 +1590,14 @@ class Worksheet(object):
                 else:
                     html = False
                     id = next(id_gen)
-                C = self._new_cell(id)
-                C.input = input
-                C.set_output_text(output, '')
-                if html:
-                    C.update_html_output(output)
+                C = reuse.get(id) if html else None
+                if not (isinstance(C, ComputeCell) and
+                        self._cell_is_unchanged(C, input, output)):
+                    C = self._new_cell(id)
+                    C.input = input
+                    C.set_output_text(output, '')
+                    if html:
+                        C.update_html_output(output)
 
             cells.append(C)
             used_ids.add(id)
@@ -1584,6 +1612,17 @@ class Worksheet(object):
                     c.delete_output()
         return cells
 
+    @staticmethod
+    def _cell_is_unchanged(C, input, output):
+        # Whether the compute cell C already has the input and output parsed
+        # from the worksheet text. Interactive cells are always rebuilt,
+        # since their displayed output is not their stored output. Outputs
+        # are compared without the surrounding newlines, which the parser
+        # drops.
+        return (C.input == input and
+                not C.is_interactive_cell() and
+                C.output_text(raw=True).strip('\n') == output.strip('\n'))
+
     def edit_save_old_format(self, text, username=None):
         text.replace('\r\n', '\n')
 
@@ -1607,6 +1646,10 @@ class Worksheet(object):
         -  ``ignore_ids`` - bool (default: False); if True
            ignore all the IDs in the {{{}}} code block.
 
+        Unless ``ignore_ids`` is True, the cells whose id, input and output
+        are unchanged by the edit are kept, so they don't need to rebuild
+        their output HTML.
+
 
         EXAMPLES:
 
@@ -1659,7 +1702,11 @@ class Worksheet(object):
             3
         """
         self.reset_interact_state()
-        self.cells = self.body_to_cells(text, ignore_ids=ignore_ids)
+        # Cells left untouched by the edit are kept as they are.
+        reuse = (self.cell_index if self.body_is_loaded and not ignore_ids
+                 else None)
+        self.cells = self.body_to_cells(
+            text, ignore_ids=ignore_ids, reuse=reuse)
 
     # Managing cells and groups of cells in this worksheet
 
@@ -1706,14 +1753,80 @@ class Worksheet(object):
         """
         return [C.id for C in self.cells if C.is_interactive_cell()]
 
+    @cached_property()
+    def cell_index(self):
+        """
+        Dictionary mapping the ids of the cells of this worksheet to the
+        cells themselves. It is kept up to date by the methods that insert
+        or delete cells, and rebuilt when the cell list is replaced.
+        """
+        return dict((C.id, C) for C in self.cells)
+
+    @cached_property()
+    def cell_positions(self):
+        """
+        Dictionary mapping the ids of the cells of this worksheet to their
+        positions in the cell list. It is kept up to date by the methods
+        that insert or delete cells, and rebuilt when the cell list is
+        replaced.
+        """
+        return dict((C.id, i) for i, C in enumerate(self.cells))
+
+    @staticmethod
+    def _shift_positions(positions, cells, start):
+        # Positions of the cells from ``start`` on, after a cell has been
+        # inserted or deleted at ``start``.
+        for i in range(start, len(cells)):
+            positions[cells[i].id] = i
+
+    def _build_cell_indexes(self):
+        # The indexes must be built before the cell list changes, they are
+        # then updated by _cell_inserted and _cell_deleted.
+        self.cell_index
+        self.cell_positions
+        self.compute_cell_positions
+
+    def _cell_inserted(self, i):
+        # Update the indexes after a cell has been inserted at position
+        # ``i`` of the cell list.
+        cells = self.cells
+        C = cells[i]
+        self.cell_index[C.id] = C
+        self._shift_positions(self.cell_positions, cells, i)
+        if isinstance(C, ComputeCell):
+            compute_cells = self.compute_cells
+            # The new compute cell goes before the next one
+            positions = self.compute_cell_positions
+            k = len(compute_cells)
+            for D in islice(cells, i + 1, None):
+                if isinstance(D, ComputeCell):
+                    k = positions[D.id]
+                    break
+            compute_cells.insert(k, C)
+            self._shift_positions(positions, compute_cells, k)
+
+    def _cell_deleted(self, i, C):
+        # Update the indexes after the cell ``C`` has been deleted from
+        # position ``i`` of the cell list.
+        del self.cell_index[C.id]
+        positions = self.cell_positions
+        del positions[C.id]
+        self._shift_positions(positions, self.cells, i)
+        if isinstance(C, ComputeCell):
+            compute_cells = self.compute_cells
+            positions = self.compute_cell_positions
+            k = positions.pop(C.id)
+            del compute_cells[k]
+            self._shift_positions(positions, compute_cells, k)
+
     def get_cell_with_id(self, id):
         """
         Get a pre-existing cell with this id, or creates a new one with it.
         """
-        for c in self.cells:
-            if c.id == id:
-                return c
-        return self._new_cell(id)
+        try:
+            return self.cell_index[id]
+        except KeyError:
+            return self._new_cell(id)
 
     def _new_text_cell(self, plain_text, id=None):
         if id is None:
@@ -1730,11 +1843,11 @@ class Worksheet(object):
 
     def insert_cell(self, id, cell, offset=0):
         cells = self.cells
-        for i, C in enumerate(cells):
-            if C.id == id:
-                cells.insert(i + offset, cell)
-                return cell
-        cells.append(cell)
+        self._build_cell_indexes()
+        i = self.cell_positions.get(id)
+        i = len(cells) if i is None else i + offset
+        cells.insert(i, cell)
+        self._cell_inserted(i)
         return cell
 
     def new_cell_before(self, id, input=''):
@@ -1854,29 +1967,45 @@ class Worksheet(object):
             ['foo', 'dont_delete_me']
         """
         cells = self.cells
-        for i, C in enumerate(cells):
-            if C.id == id:
+        self._build_cell_indexes()
+        i = self.cell_positions.get(id)
+        if i is not None:
+            C = cells[i]
 
-                # Delete this cell from the queued up calculation list:
-                if C in self.__queue and self.__queue[0] != C:
-                    self.__queue.remove(C)
+            # Delete this cell from the queued up calculation list:
+            if C in self.__queue and self.__queue[0] != C:
+                self.__queue.remove(C)
 
-                # Delete the cell's output.
-                C.delete_output()
+            # Delete the cell's output.
+            C.delete_output()
 
-                # Delete this cell from the list of cells in this worksheet:
-                del cells[i]
+            # Delete this cell from the list of cells in this worksheet:
+            del cells[i]
+            self._cell_deleted(i, C)
 
-                if i > 0:
-                    return cells[i - 1].id
-                else:
-                    break
+            if i > 0:
+                return cells[i - 1].id
         return cells[0].id
 
-    @property
+    def pop_cell(self):
+        """
+        Removes the last cell of this worksheet's cell list and returns
+        it. Its output and files are kept.
+        """
+        cells = self.cells
+        self._build_cell_indexes()
+        C = cells.pop()
+        self._cell_deleted(len(cells), C)
+        return C
+
+    @cached_property(invalidate=('compute_cell_positions',))
     def compute_cells(self):
         return [C for C in self.cells if isinstance(C, ComputeCell)]
 
+    @cached_property()
+    def compute_cell_positions(self):
+        return dict((C.id, k) for k, C in enumerate(self.compute_cells))
+
     def next_compute_id(self, cell):
         r"""
         Returns the ID of the next compute cell for cell.  If cell is *not* in
@@ -1905,9 +2034,9 @@ class Worksheet(object):
 
         """
         L = self.compute_cells
-        if cell not in L:
+        k = self.compute_cell_positions.get(cell.id)
+        if k is None:
             return L[0].id
-        k = L.index(cell)
         try:
             return L[k + 1].id
         except IndexError:
@@ -2014,19 +2143,23 @@ class Worksheet(object):
                 return S
         except AttributeError:
             pass
+        kernels = self.notebook().kernel_registry
+        kernels.starting(self)
         try:
             init_code = '\n'.join((
                 "DATA = '{}'".format(os.path.abspath(self.data_directory)),
                 'sys.path.append(DATA)',
                 ))
+            t = walltime()
             self.__sage = self.notebook().new_worksheet_process(
                 init_code=init_code)
+            kernel_spawn_duration.observe(walltime(t))
         except Exception as msg:
             print("ERROR initializing compute process:\n")
             print(msg)
-            del self.__sage
+            kernels.remove(self)
             raise RuntimeError(msg)
-        all_worksheet_processes.append(self.__sage)
+        kernels.started(self, self.__sage)
         del self.next_block_id_generator  # Set counter to 0
         S = self.__sage
 
@@ -2081,6 +2214,7 @@ class Worksheet(object):
         C = self.__queue[0]
         if C.interrupted:
             return
+        cell_tracer.mark(C, 'start')
 
         cell_system = self.get_cell_system(C)
         percent_directives = C.percent_directives
@@ -2129,6 +2263,7 @@ class Worksheet(object):
         self.sage().execute(
             input, os.path.abspath(self.data_directory),
             mode=mode, print_time=print_time)
+        cell_tracer.mark(C, 'send')
 
     def check_comp(self, wait=0.2):
         r"""
@@ -2165,6 +2300,7 @@ class Worksheet(object):
         if C.interrupted:
             self.__computing = False
             del self.__queue[0]
+            cell_tracer.finish(C, 'interrupted')
             return 'd', C
 
         try:
@@ -2178,6 +2314,8 @@ class Worksheet(object):
 
         # TODO: reimplement output postprosessing to get meaningful tracebacks
         out = output_status.output
+        if out:
+            cell_tracer.mark(C, 'output')
 
         if not output_status.done:
             # Still computing
@@ -2198,6 +2336,7 @@ class Worksheet(object):
                 ########################################################
             return 'w', C
 
+        cell_tracer.mark(C, 'computed')
         if C.introspect:
             before_prompt, after_prompt = C.introspect
             if len(before_prompt) == 0:
@@ -2254,10 +2393,12 @@ class Worksheet(object):
                         shutil.copy(X, target)
                         os.unlink(X)
                     set_restrictive_permissions(target)
+                self.notebook().store_wst_files([cell_dir])
             # Generate html, etc.
             html = C.files_html(out)
             C.set_output_text(out, html)
             C.introspect_html = ''
+        cell_tracer.mark(C, 'files')
 
         return 'd', C
 
@@ -2267,7 +2408,8 @@ class Worksheet(object):
 
         INPUT:
 
-        - ``timeout`` -- time to wait for interruption to succeed
+        - ``timeout`` -- time to wait for interruption to succeed, 0 to
+          return without waiting
 
         - ``callback`` -- callback to be called. Called with True if
           interrupt succeeds, else called with False.
@@ -2319,11 +2461,16 @@ class Worksheet(object):
         if len(self.__queue) == 0:
             # nothing to do
             return True
+        try:
+            S = self.__sage
+        except AttributeError:
+            # no sage running, nothing is computing
+            return True
         # stop the current computation in the running Sage
-        S = self.__sage
         S.interrupt()
 
-        time.sleep(timeout)
+        if timeout:
+            time.sleep(timeout)
 
         if S.is_computing():
             return False
@@ -2335,6 +2482,7 @@ class Worksheet(object):
             S = self.__sage
         except AttributeError:
             # no sage running anyways!
+            self.notebook().kernel_registry.remove(self)
             self.notebook().quit_worksheet(self)
             return
 
@@ -2347,6 +2495,7 @@ class Worksheet(object):
             print("WARNING: Error deleting Sage object!")
 
         del self.__sage
+        self.notebook().kernel_registry.remove(self)
 
         # We do this to avoid getting a stale Sage that uses old code.
         self.save()
@@ -2362,22 +2511,7 @@ class Worksheet(object):
                 shutil.rmtree(dir, ignore_errors=True)
         self.notebook().quit_worksheet(self)
 
-    # Idle timeout
-
-    def quit_if_idle(self, timeout):
-        r"""
-        Quit the worksheet process if it has been "idle" for more than
-        ``timeout`` seconds, where idle is by definition that
-        the worksheet has not reported back that it is actually computing.
-        I.e., an ignored worksheet process (since the user closed their
-        browser) is also considered idle, even if code is running.
-        """
-        # Quit only if timeout is greater than zero
-        if timeout > 0 and self.time_idle() > timeout:
-            # worksheet name may contain unicode, so we use %r, which prints
-            # the \xXX form for unicode characters
-            print("Quitting ignored worksheet process for %r." % self.name)
-            self.quit()
+    # Idle timeout (see gui.kernels)
 
     def time_idle(self):
         return walltime() - self.last_compute_walltime()
@@ -2427,6 +2561,7 @@ class Worksheet(object):
         # Now enqueue the requested cell.
         if not (C in self.__queue):
             self.__queue.append(C)
+        cell_tracer.mark(C, 'enqueue')
         self.start_next_comp()
 
     def _enqueue_auto_cells(self):
@@ -2456,6 +2591,7 @@ class Worksheet(object):
         # empty the queue
         for C in self.__queue:
             C.interrupt()
+            cell_tracer.finish(C, 'interrupted')
         self.__queue = []
         self.__computing = False
 
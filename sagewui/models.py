@@ -13,6 +13,7 @@ from flask_babel import lazy_gettext
 
 from . import config as CFG
 from .util import import_from
+from .util.archive import compressors
 from .util import N_
 from .util import set_default
 
@@ -25,12 +26,21 @@ app_defaults = {
     'idle_timeout': 0,        # timeout in seconds for worksheets
     'doc_timeout': 600,         # timeout in seconds for live docs
     'idle_check_interval': 360,
+    'kernel_check_interval': 10,    # heartbeat of worksheet processes
+    'kernel_walltime': 0,       # max running time of worksheet processes
 
     'save_interval': 360,        # seconds
+    'blob_collect_interval': 3600 * 24,  # removal of unused cell files
+    'cell_storage': False,       # per cell worksheet records
+    'sws_compression': 'bz2',    # compression of exported worksheets
 
     'doc_pool_size': 128,
+    'migration_workers': 8,     # threads of the model upgrades
 
     'pub_interact': False,
+    'pub_page_size': 100,       # worksheets per page of /pub/
+    'lock_stats': False,        # record lock contention (/lock_stats)
+    'cell_traces': 500,         # traced cell evaluations (/cell_traces)
 
     'server_pool': [],
 
@@ -87,22 +97,75 @@ app_gui_hints = {
         CFG.GROUP: CFG.G_SERVER,
         CFG.TYPE: CFG.T_INTEGER,
     },
+    'kernel_check_interval': {
+        CFG.DESC: _('Interval of the checks of dead worksheet processes '
+                    '(seconds)'),
+        CFG.GROUP: CFG.G_SERVER,
+        CFG.TYPE: CFG.T_INTEGER,
+    },
+    'kernel_walltime': {
+        CFG.DESC: _('Maximum running time of worksheet processes (seconds, '
+                    '0 for no limit)'),
+        CFG.GROUP: CFG.G_SERVER,
+        CFG.TYPE: CFG.T_INTEGER,
+    },
     'save_interval': {
         CFG.DESC: _('Save interval (seconds)'),
         CFG.GROUP: CFG.G_SERVER,
         CFG.TYPE: CFG.T_INTEGER,
     },
+    'blob_collect_interval': {
+        CFG.DESC: _('Interval of the removal of unused cell files '
+                    '(seconds)'),
+        CFG.GROUP: CFG.G_SERVER,
+        CFG.TYPE: CFG.T_INTEGER,
+    },
+    'cell_storage': {
+        CFG.DESC: _('Save each worksheet cell in its own file '
+                    '(applied on restart)'),
+        CFG.GROUP: CFG.G_SERVER,
+        CFG.TYPE: CFG.T_BOOL,
+    },
+    'sws_compression': {
+        CFG.DESC: _('Compression of downloaded worksheets (bz2 is '
+                    'compatible with older notebooks; the others are faster)'),
+        CFG.GROUP: CFG.G_SERVER,
+        CFG.TYPE: CFG.T_CHOICE,
+        CFG.CHOICES: sorted(compressors),
+    },
     'doc_pool_size': {
         CFG.DESC: _('Doc worksheet pool size'),
         CFG.GROUP: CFG.G_SERVER,
         CFG.TYPE: CFG.T_INTEGER,
     },
+    'migration_workers': {
+        CFG.DESC: _('Number of threads of the model upgrades and repairs'),
+        CFG.GROUP: CFG.G_SERVER,
+        CFG.TYPE: CFG.T_INTEGER,
+    },
     'pub_interact': {
         CFG.DESC: _(
             'Enable published interacts (EXPERIMENTAL; USE AT YOUR OWN RISK)'),
         CFG.GROUP: CFG.G_SERVER,
         CFG.TYPE: CFG.T_BOOL,
     },
+    'pub_page_size': {
+        CFG.DESC: _('Number of worksheets per page of published worksheets'),
+        CFG.GROUP: CFG.G_SERVER,
+        CFG.TYPE: CFG.T_INTEGER,
+    },
+    'lock_stats': {
+        CFG.DESC: _('Record the wait and hold times of the server locks '
+                    '(shown in /lock_stats)'),
+        CFG.GROUP: CFG.G_SERVER,
+        CFG.TYPE: CFG.T_BOOL,
+    },
+    'cell_traces': {
+        CFG.DESC: _('Number of traced cell evaluations kept, 0 to disable '
+                    'the tracing (shown in /cell_traces)'),
+        CFG.GROUP: CFG.G_SERVER,
+        CFG.TYPE: CFG.T_INTEGER,
+    },
     'server_pool': {
         CFG.DESC: _('Worksheet process users (comma-separated list)'),
         CFG.GROUP: CFG.G_SERVER,
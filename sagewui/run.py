@@ -29,6 +29,7 @@ import argparse
 import logging
 import getpass
 import signal
+from contextlib import contextmanager
 from os.path import join as joinpath
 
 from sagewui import config as CFG
@@ -44,6 +45,7 @@ from sagewui.util import open_msg
 from sagewui.util import securepath
 from sagewui.util import system_command
 from sagewui.util import testpaths
+from sagewui.util import walltime
 from sagewui.util import which
 
 
@@ -72,6 +74,8 @@ class NotebookFrontend(object):
         self.app_path_names = ('dbdir', 'piddir', 'ssldir')
 
         self.notebook = None
+        # (phase, seconds) pairs, reported with --profile-startup
+        self.startup_times = []
 
     @cached_property()
     def msg(self):
@@ -117,6 +121,7 @@ class NotebookFrontend(object):
                 'quit the notebook and type `sagenb --reset`.',
             )),
             'server': 'Executing SageWui with {} server',
+            'profile': 'Startup time:',
             'ssl_wzeug':
                 'HTTPS cannot be used without pyOpenSSL installed. See the '
                 'Sage README for more information.'
@@ -235,6 +240,11 @@ class NotebookFrontend(object):
             default='sage',
             action='store',
             )
+        parser.add_argument(
+            '--profile-startup',
+            dest='profile_startup',
+            action='store_true',
+            )
 
         return parser
 
@@ -244,6 +254,24 @@ class NotebookFrontend(object):
     def parse(self, args=None):
         self.conf.update(vars(self.parser.parse_args(args)))
 
+    @contextmanager
+    def phase(self, name):
+        """
+        Record the time spent in the startup phase ``name``.
+        """
+        t = walltime()
+        try:
+            yield
+        finally:
+            self.startup_times.append((name, walltime(t)))
+
+    def print_startup_times(self):
+        print(self.msg['profile'])
+        for name, t in self.startup_times:
+            print('    {:<30} {:>8.3f} s'.format(name, t))
+        print('    {:<30} {:>8.3f} s'.format(
+            'total', sum(t for name, t in self.startup_times)))
+
     def init_paths(self):
         C = self.conf
         M = self.msg
@@ -297,11 +325,12 @@ class NotebookFrontend(object):
         C = self.conf
         M = self.msg
 
-        self.notebook = notebook.load_notebook(
-            C['directory'],
-            interface=C['interface'],
-            port=C['port'],
-            secure=C['secure'])
+        with self.phase('load notebook'):
+            self.notebook = notebook.load_notebook(
+                C['directory'],
+                interface=C['interface'],
+                port=C['port'],
+                secure=C['secure'])
         nb = self.notebook
 
         C['directory'] = nb.dir
@@ -341,25 +370,31 @@ class NotebookFrontend(object):
 
         # For old notebooks, make sure that default users are always created.
         # This fixes issue #175 (https://github.com/sagemath/sagenb/issues/175)
-        um = nb.user_manager
-        for user in (CFG.UN_SAGE, CFG.UN_PUB):
-            if user not in um:
-                um.add_user(user, '', '', account_type=CFG.UAT_USER)
-        if CFG.UN_GUEST not in um:
-            um.add_user(CFG.UN_GUEST, '', '', account_type=CFG.UAT_GUEST)
+        with self.phase('default users'):
+            um = nb.user_manager
+            for user in (CFG.UN_SAGE, CFG.UN_PUB):
+                if user not in um:
+                    um.add_user(user, '', '', account_type=CFG.UAT_USER)
+            if CFG.UN_GUEST not in um:
+                um.add_user(CFG.UN_GUEST, '', '', account_type=CFG.UAT_GUEST)
 
         nb.set_server_pool(C['server_pool'])
         nb.set_ulimit(C['ulimit'])
 
-        nb.upgrade_model()
-        nb.save()
+        with self.phase('upgrade model'):
+            nb.upgrade_model()
+        with self.phase('save notebook'):
+            nb.save()
 
     def run(self, args=None):
         self.parse(args)
-        CFG.add_sage_conf(self.conf['sage'])
+        with self.phase('sage conf'):
+            CFG.add_sage_conf(self.conf['sage'])
 
-        self.init_paths()
-        self.init_misc()
+        with self.phase('paths'):
+            self.init_paths()
+        with self.phase('misc'):
+            self.init_misc()
         self.init_notebook()
         if not self.conf['quiet']:
             print(open_msg(self.conf['interface'], self.conf['port'],
@@ -371,10 +406,13 @@ class NotebookFrontend(object):
         # TODO: This must be a conf parameter of the notebook
         self.notebook.DIR = self.conf['cwd']
 
-        flask_app = create_app(self.notebook,
-                               startup_token=self.conf['startup_token'],
-                               debug=self.conf['debug'],
-                               )
+        with self.phase('create app'):
+            flask_app = create_app(self.notebook,
+                                   startup_token=self.conf['startup_token'],
+                                   debug=self.conf['debug'],
+                                   )
+        if self.conf['profile_startup']:
+            self.print_startup_times()
         self.servers[self.conf['server']](flask_app)
 
     def exit(self):
@@ -33,23 +33,96 @@ class Datastore(object):
     def save_server_conf(self, server_conf):
         raise NotImplementedError
 
-    def load_users(self):
+    def load_pub_index(self):
         """
+        Return the dict which maps the filenames (``'owner/id_number'``) of
+        the published worksheets to the id numbers of their published
+        versions, or None if it has not been saved yet.
+        """
+        raise NotImplementedError
+
+    def save_pub_index(self, index):
+        """
+        Save the dict returned by :meth:`load_pub_index`.
+        """
+        raise NotImplementedError
+
+    def load_pub_catalog(self):
+        """
+        Return the catalog of published worksheets, a dict which maps
+        their id numbers to their entries (dicts with an ``'id_number'``
+        key), or None if it has not been saved yet.
+        """
+        raise NotImplementedError
+
+    def update_pub_catalog(self, entries=(), removed=()):
+        """
+        Add or replace the ``entries`` of the catalog of published
+        worksheets, and remove the entries with id numbers in
+        ``removed``.
+        """
+        raise NotImplementedError
+
+    def save_pub_catalog(self, catalog):
+        """
+        Save the whole catalog of published worksheets.
+        """
+        raise NotImplementedError
+
+    def load_migration_checkpoint(self, name):
+        """
+        Return the set of items already migrated by the migration
+        ``name``, or None if it has no checkpoint.
+        """
+        raise NotImplementedError
+
+    def checkpoint_migration(self, name, items):
+        """
+        Record that the migration ``name`` has migrated the ``items``
+        (a list of strings).
+        """
+        raise NotImplementedError
+
+    def remove_migration_checkpoint(self, name):
+        """
+        Remove the checkpoint of the migration ``name``, which is
+        complete.
+        """
+        raise NotImplementedError
+
+    def load_users(self, user_manager):
+        """
+        Register the stored users in ``user_manager``.
+
         OUTPUT:
 
             - dictionary of user info
         """
         raise NotImplementedError
 
+    def load_user(self, username):
+        """
+        Return the stored user with the given username.
+        """
+        raise NotImplementedError
+
     def save_users(self, users):
         """
+        Save the users which changed since they were loaded or saved.
+
         INPUT:
 
             - ``users`` -- dictionary mapping user names to users
         """
         raise NotImplementedError
 
-    def load_user_history(self, username):
+    def delete_user(self, username):
+        """
+        Delete the stored user with the given username, if any.
+        """
+        raise NotImplementedError
+
+    def load_user_history(self, username, maxlen=None):
         """
         Return the history log for the given user.
 
@@ -57,6 +130,9 @@ class Datastore(object):
 
             - ``username`` -- string
 
+            - ``maxlen`` -- None or integer; if given, only the last
+              ``maxlen`` entries are returned
+
         OUTPUT:
 
             - list of strings
@@ -75,6 +151,21 @@ class Datastore(object):
         """
         raise NotImplementedError
 
+    def append_user_history(self, username, entries, maxlen=None):
+        """
+        Append new entries to the history log of the given user.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``entries`` -- list of strings
+
+            - ``maxlen`` -- None or integer; the maximum length of the
+              history
+        """
+        raise NotImplementedError
+
     def save_worksheet(self, worksheet, conf_only=False):
         """
         INPUT:
@@ -123,7 +214,15 @@ class Datastore(object):
         """
         raise NotImplementedError
 
-    def export_worksheet(self, username, id_number, filename, title):
+    def worksheet_exists(self, username, id_number):
+        """
+        Return whether the worksheet with given id_number belonging to the
+        given user is stored, without loading it.
+        """
+        raise NotImplementedError
+
+    def export_worksheet(self, username, id_number, filename, title,
+                         compression='bz2'):
         """
         Export the worksheet with given username and id_number to the
         given filename (e.g., 'worksheet.sws').
@@ -132,6 +231,25 @@ class Datastore(object):
 
             - ``title`` - title to use for the exported worksheet (if
                None, just use current title)
+
+            - ``compression`` - string (default: 'bz2'); the compression of
+              the archive
+        """
+        raise NotImplementedError
+
+    def export_worksheet_stream(self, username, id_number, title,
+                                compression='bz2'):
+        """
+        Export the worksheet with given username and id_number as an
+        iterator of chunks of the sws file.
+
+        INPUT:
+
+            - ``title`` - title to use for the exported worksheet (if
+               None, just use current title)
+
+            - ``compression`` - string (default: 'bz2'); the compression of
+              the archive
         """
         raise NotImplementedError
 
@@ -142,6 +260,28 @@ class Datastore(object):
         """
         raise NotImplementedError
 
+    def store_files(self, paths):
+        """
+        Store the cell files (or directories of files) ``paths`` of
+        worksheets, so that identical files share their contents. Data
+        files can't be stored, since they may be modified in place.
+        """
+        raise NotImplementedError
+
+    def file_hash(self, path):
+        """
+        Return a hash of the contents of the file ``path`` of a
+        worksheet, which can be used as an ETag.
+        """
+        raise NotImplementedError
+
+    def collect_files(self):
+        """
+        Remove the contents of the stored files which are not used any
+        more. Return their number and total size.
+        """
+        raise NotImplementedError
+
     def worksheets(self, username):
         """
         Return list of all the worksheets belonging to the user with
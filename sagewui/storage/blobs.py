@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*
+"""
+Content addressed store of worksheet files.
+
+Cell files (plots, ``full_output.txt``, jmol files...) are often
+identical across copies and published versions of a worksheet, and
+across evaluations of a cell. Each distinct content is kept once in the
+store, named by its sha1::
+
+    blobs/
+        3f/
+            3f786850e387550fdab836ed7e6dc881de23001b
+        ...
+
+and the files of the ``cells/`` directories are hard links to it. The
+link count of a blob is then its reference count: a blob with a single
+link is not referenced by any worksheet, and it is removed by
+:meth:`BlobStore.collect`. Worksheet directories are still plain
+directories, so they are read, served, exported and deleted as before.
+
+Since a blob is shared, the files of the store must be replaced, never
+modified in place. Cell directories are rebuilt on each evaluation. Data
+files are not stored: worksheet code writes them in place.
+
+The hash of a file is also an ETag which doesn't depend on the name,
+location or modification time of the file. :meth:`BlobStore.hash`
+caches it by inode.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+from builtins import open
+
+import hashlib
+import os
+import threading
+
+
+def file_hash(path, chunk_size=1 << 16):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+class BlobStore(object):
+    def __init__(self, directory):
+        """
+        INPUT:
+
+        - ``directory`` - string; the directory of the blobs. It must be
+          in the same filesystem as the stored files.
+        """
+        self.path = directory
+        # (st_dev, st_ino) -> (st_size, st_mtime, sha1)
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Blob store at %s' % self.path
+
+    def _filename(self, h):
+        return os.path.join(self.path, h[:2], h)
+
+    def _cache(self, st, h):
+        with self._lock:
+            self._hashes[st.st_dev, st.st_ino] = (
+                st.st_size, st.st_mtime, h)
+
+    def hash(self, path):
+        """
+        Return the sha1 of the contents of the file ``path``, which needs
+        to be computed only once for all the links to a blob.
+        """
+        st = os.stat(path)
+        try:
+            size, mtime, h = self._hashes[st.st_dev, st.st_ino]
+        except KeyError:
+            pass
+        else:
+            if (size, mtime) == (st.st_size, st.st_mtime):
+                return h
+        h = file_hash(path)
+        self._cache(st, h)
+        return h
+
+    def add(self, path):
+        """
+        Store the regular file ``path``, which is replaced by a link to
+        the blob of its contents if there is already one. Return the
+        sha1 of the contents.
+        """
+        st = os.stat(path)
+        h = self.hash(path)
+        blob = self._filename(h)
+        try:
+            bst = os.stat(blob)
+        except OSError:
+            bst = None
+        if bst is not None and (bst.st_dev, bst.st_ino) == (
+                st.st_dev, st.st_ino):
+            # Already stored
+            return h
+
+        if bst is None:
+            try:
+                os.makedirs(os.path.dirname(blob))
+            except OSError:
+                pass
+            try:
+                os.link(path, blob)
+                return h
+            except OSError:
+                # Either the blob was created meanwhile or links are not
+                # supported; in the latter case the file is kept as is.
+                if not os.path.exists(blob):
+                    return h
+
+        # Replace the file with a link to the blob
+        tmp = '{}.{}.blob'.format(path, threading.current_thread().ident)
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            # The blob was collected meanwhile
+            return h
+        os.rename(tmp, path)
+        self._cache(os.stat(path), h)
+        return h
+
+    def add_tree(self, path):
+        """
+        Store the regular files of the directory ``path`` (recursively).
+        """
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                if os.path.isfile(filename) and \
+                        not os.path.islink(filename):
+                    self.add(filename)
+
+    def collect(self):
+        """
+        Remove the blobs which are not referenced any more.
+
+        OUTPUT:
+
+        - a pair of integers; the number and the total size of the
+          removed blobs
+        """
+        number = size = 0
+        if not os.path.isdir(self.path):
+            return number, size
+        for prefix in os.listdir(self.path):
+            dirname = os.path.join(self.path, prefix)
+            for h in os.listdir(dirname):
+                blob = os.path.join(dirname, h)
+                try:
+                    st = os.stat(blob)
+                    if st.st_nlink == 1:
+                        os.unlink(blob)
+                except OSError:
+                    continue
+                if st.st_nlink == 1:
+                    number += 1
+                    size += st.st_size
+                    with self._lock:
+                        self._hashes.pop((st.st_dev, st.st_ino), None)
+            try:
+                os.rmdir(dirname)
+            except OSError:
+                # Not empty
+                pass
+        return number, size
@@ -5,19 +5,29 @@ A Filesystem-based Sage Notebook Datastore
 Here is the filesystem layout for this datastore.  Note that the all
 of the pickles are pickles of basic Python objects, so can be
 unpickled in any version of Python with or without Sage or the Sage
-notebook installed.  They are also not compressed, so are reasonably
-easy to read ASCII.
+notebook installed.  They are written by the serializers of
+:mod:`.serializers`, so they start with a header naming the pickle
+protocol, except in exported worksheets, which use the ASCII protocol 0
+pickles of older versions.
 
 The filesystem layout is as follows.  It mirrors the URL's used by the
 Sage notebook server::
 
     sagewui/db/default
          conf.pickle
-         users.pickle
+         pub_index.pickle (source worksheet -> published worksheet)
+         pub_catalog.log (listing data of the published worksheets)
+         users/
+             username0.pickle
+             username1.pickle
+             ...
          readonly.txt (optional)
+         migrations/ (checkpoints of the migrations in progress)
+             name.log
+         blobs/ (see :mod:`.blobs`; the files of cells/ are links)
          home/
              username0/
-                history.pickle
+                history.log
                 id_number0/
                     worksheet.html
                     worksheet_conf.pickle
@@ -25,6 +35,10 @@ Sage notebook server::
                     data/
                     snapshots/
                 id_number1/
+                    body/ (instead of worksheet.html with cell storage)
+                        order.json
+                        0.txt
+                        ...
                     worksheet.html
                     worksheet_conf.pickle
                     cells/
@@ -40,25 +54,30 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import str
-from builtins import object
 from builtins import open
-from future.moves import pickle
 
 import copy
+import json
 import os
 import shutil
 import tarfile
-import tempfile
 import traceback
 from hashlib import md5
 
 from .. import config as CFG
 from ..controllers import User
 from ..models import ServerConfiguration
+from ..util import atomic_write
 from ..util import set_restrictive_permissions
+from ..util.archive import TarStream
+from ..util.metrics import storage_read
+from ..util.records import CellRecords
+from ..util.records import RecordLog
 from ..gui.worksheet import Worksheet_from_basic
 
+from . import serializers
 from .abstract_storage import Datastore
+from .blobs import BlobStore
 
 
 def is_safe(a):
@@ -74,226 +93,24 @@ def is_safe(a):
     return '..' not in a and not a.startswith('/')
 
 
-# From sage.misc.temporary_file
-
-class atomic_write(object):
-    """
-    Write to a given file using a temporary file and then rename it
-    to the target file. This renaming should be atomic on modern
-    operating systems. Therefore, this class can be used to avoid race
-    conditions when a file might be read while it is being written.
-    It also avoids having partially written files due to exceptions
-    or crashes.
-
-    This is to be used in a ``with`` statement, where a temporary file
-    is created when entering the ``with`` and is moved in place of the
-    target file when exiting the ``with`` (if no exceptions occured).
-
-    INPUT:
-
-    - ``target_filename`` -- the name of the file to be written.
-      Normally, the contents of this file will be overwritten.
-
-    - ``append`` -- (boolean, default: False) if True and
-      ``target_filename`` is an existing file, then copy the current
-      contents of ``target_filename`` to the temporary file when
-      entering the ``with`` statement. Otherwise, the temporary file is
-      initially empty.
-
-    - ``mode`` -- (default: ``0o666``) mode bits for the file. The
-      temporary file is created with mode ``mode & ~umask`` and the
-      resulting file will also have these permissions (unless the
-      mode bits of the file were changed manually).
-
-    EXAMPLES::
-
-        sage: from sage.misc.temporary_file import atomic_write
-        sage: target_file = tmp_filename()
-        sage: open(target_file, "w").write("Old contents")
-        sage: with atomic_write(target_file) as f:
-        ....:     f.write("New contents")
-        ....:     f.flush()
-        ....:     open(target_file, "r").read()
-        'Old contents'
-        sage: open(target_file, "r").read()
-        'New contents'
-
-    The name of the temporary file can be accessed using ``f.name``.
-    It is not a problem to close and re-open the temporary file::
-
-        sage: from sage.misc.temporary_file import atomic_write
-        sage: target_file = tmp_filename()
-        sage: open(target_file, "w").write("Old contents")
-        sage: with atomic_write(target_file) as f:
-        ....:     f.close()
-        ....:     open(f.name, "w").write("Newer contents")
-        sage: open(target_file, "r").read()
-        'Newer contents'
-
-    If an exception occurs while writing the file, the target file is
-    not touched::
-
-        sage: with atomic_write(target_file) as f:
-        ....:     f.write("Newest contents")
-        ....:     raise RuntimeError
-        Traceback (most recent call last):
-        ...
-        RuntimeError
-        sage: open(target_file, "r").read()
-        'Newer contents'
-
-    Some examples of using the ``append`` option. Note that the file
-    is never opened in "append" mode, it is possible to overwrite
-    existing data::
-
-        sage: target_file = tmp_filename()
-        sage: with atomic_write(target_file, append=True) as f:
-        ....:     f.write("Hello")
-        sage: with atomic_write(target_file, append=True) as f:
-        ....:     f.write(" World")
-        sage: open(target_file, "r").read()
-        'Hello World'
-        sage: with atomic_write(target_file, append=True) as f:
-        ....:     f.seek(0)
-        ....:     f.write("HELLO")
-        sage: open(target_file, "r").read()
-        'HELLO World'
-
-    If the target file is a symbolic link, the link is kept and the
-    target of the link is written to::
-
-        sage: link_to_target = os.path.join(tmp_dir(), "templink")
-        sage: os.symlink(target_file, link_to_target)
-        sage: with atomic_write(link_to_target) as f:
-        ....:     f.write("Newest contents")
-        sage: open(target_file, "r").read()
-        'Newest contents'
-
-    We check the permission bits of the new file. Note that the old
-    permissions do not matter::
-
-        sage: os.chmod(target_file, 0o600)
-        sage: _ = os.umask(0o022)
-        sage: with atomic_write(target_file) as f:
-        ....:     pass
-        sage: oct(os.stat(target_file).st_mode & 0o777)
-        '644'
-        sage: _ = os.umask(0o077)
-        sage: with atomic_write(target_file, mode=0o777) as f:
-        ....:     pass
-        sage: oct(os.stat(target_file).st_mode & 0o777)
-        '700'
-
-    Test writing twice to the same target file. The outermost ``with``
-    "wins"::
-
-        sage: open(target_file, "w").write(">>> ")
-        sage: with atomic_write(target_file, append=True) as f, \
-        ....:          atomic_write(target_file, append=True) as g:
-        ....:     f.write("AAA"); f.close()
-        ....:     g.write("BBB"); g.close()
-        sage: open(target_file, "r").read()
-        '>>> AAA'
-    """
-    def __init__(self, target_filename, append=False, mode=0o666):
-        """
-        TESTS::
-
-            sage: from sage.misc.temporary_file import atomic_write
-            sage: link_to_target = os.path.join(tmp_dir(), "templink")
-            sage: os.symlink("/foobar", link_to_target)
-            sage: aw = atomic_write(link_to_target)
-            sage: print aw.target
-            /foobar
-            sage: print aw.tmpdir
-            /
-        """
-        self.target = os.path.realpath(target_filename)
-        self.tmpdir = os.path.dirname(self.target)
-        self.append = append
-        # Remove umask bits from mode
-        umask = os.umask(0)
-        os.umask(umask)
-        self.mode = mode & (~umask)
-
-    def __enter__(self):
-        """
-        Create and return a temporary file in ``self.tmpdir`` (normally
-        the same directory as the target file).
-
-        If ``self.append``, then copy the current contents of
-        ``self.target`` to the temporary file.
-
-        OUTPUT: a file returned by :func:`tempfile.NamedTemporaryFile`.
-
-        TESTS::
-
-            sage: from sage.misc.temporary_file import atomic_write
-            sage: aw = atomic_write(tmp_filename())
-            sage: with aw as f:
-            ....:     os.path.dirname(aw.target) == os.path.dirname(f.name)
-            True
-        """
-        self.tempfile = tempfile.NamedTemporaryFile(dir=self.tmpdir,
-                                                    delete=False)
-        self.tempname = self.tempfile.name
-        os.chmod(self.tempname, self.mode)
-        if self.append:
-            try:
-                r = open(self.target).read()
-            except IOError:
-                pass
-            else:
-                self.tempfile.write(r)
-        return self.tempfile
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        """
-        If the ``with`` block was successful, move the temporary file
-        to the target file. Otherwise, delete the temporary file.
-
-        TESTS:
-
-        Check that the temporary file is deleted if there was an
-        exception::
-
-            sage: from sage.misc.temporary_file import atomic_write
-            sage: with atomic_write(tmp_filename()) as f:
-            ....:     tempname = f.name
-            ....:     raise RuntimeError
-            Traceback (most recent call last):
-            ...
-            RuntimeError
-            sage: os.path.exists(tempname)
-            False
-        """
-        # Flush the file contents to disk (to be safe even if the
-        # system crashes) and close the file.
-        if not self.tempfile.closed:
-            self.tempfile.flush()
-            os.fsync(self.tempfile.fileno())
-            self.tempfile.close()
-
-        if exc_type is None:
-            # Success: move temporary file to target file
-            try:
-                os.rename(self.tempname, self.target)
-            except OSError:
-                os.unlink(self.target)
-                os.rename(self.tempname, self.target)
-        else:
-            # Failure: delete temporary file
-            os.unlink(self.tempname)
-
-
 class FilesystemDatastore(Datastore):
 
-    def __init__(self, path):
+    def __init__(self, path, cell_storage=False,
+                 serializer=serializers.default):
         """
         INPUT:
 
            - ``path`` -- string, path to this datastore
 
+           - ``cell_storage`` -- bool (default: False); if True, save the
+             worksheet bodies as per cell records instead of
+             ``worksheet.html``, so that only the modified cells are
+             written.
+
+           - ``serializer`` -- string (default: ``serializers.default``);
+             the name of the serializer used to write the pickles. Files
+             written by any serializer are read.
+
         EXAMPLES::
 
             sage: from sagenb.storage import FilesystemDatastore
@@ -303,12 +120,23 @@ class FilesystemDatastore(Datastore):
         path = os.path.abspath(path)
         self._path = path
         self._makepath(os.path.join(self._path, 'home'))
+        self._makepath(os.path.join(self._path, 'users'))
         self._home_path = 'home'
+        self._users_path = 'users'
+        self._blobs = BlobStore(self._abspath('blobs'))
         self._conf_filename = 'conf.pickle'
-        self._users_filename = 'users.pickle'
+        self._pub_index_filename = 'pub_index.pickle'
+        self._pub_catalog_filename = 'pub_catalog.log'
+        self._users_filename = 'users.pickle'  # Older versions
         self._readonly_filename = 'readonly.txt'
+        self._migrations_path = 'migrations'
         self._readonly_mtime = 0
         self._readonly = None
+        self.cell_storage = cell_storage
+        self.serializer = serializer
+        self._history_lengths = {}
+        # Resolved user directories
+        self._user_paths = {}
 
     def __repr__(self):
         return "Filesystem Sage Notebook Datastore at %s" % self._path
@@ -327,10 +155,7 @@ class FilesystemDatastore(Datastore):
 
     def _deep_user_path(self, username):
         h = md5(username.encode('utf-8')).hexdigest()
-        base = ['__store__', h[:1], h[:2], h[:3], h[:4]]
-        path = os.path.join(*base)
-        self._makepath(self._abspath(os.path.join(self._home_path, path)))
-        return os.path.join(path, username)
+        return os.path.join('__store__', h[:1], h[:2], h[:3], h[:4], username)
 
     def _user_path(self, username):
         # There are weird cases, e.g., old notebook server migration
@@ -340,14 +165,16 @@ class FilesystemDatastore(Datastore):
         # There are also some cases where the username could have unicode in
         # it.
         username = str(username)
+        try:
+            return self._user_paths[username]
+        except KeyError:
+            pass
 
         home = self._abspath(self._home_path)
         path = os.path.join(home, username)
         if not os.path.islink(path):
-            self._makepath(home)
-
-            old_dir = os.getcwd()
-            os.chdir(home)
+            # Relative to home, so that the link doesn't depend on the
+            # location of the datastore
             new_path = self._deep_user_path(username)
 
             # Ensure that new_path exists:
@@ -355,36 +182,68 @@ class FilesystemDatastore(Datastore):
                 # If the old path exists, move it to the new path.
                 # If both the old and new path exist, that's an error
                 # and this will raise an exception.
-                os.rename(path, new_path)
+                self._makepath(os.path.dirname(os.path.join(home, new_path)))
+                os.rename(path, os.path.join(home, new_path))
             else:
                 # Otherwise, simply create the new path.
                 self._makepath(os.path.join(home, new_path))
 
             # new_path now points to the actual directory
-            os.symlink(new_path, username)
-            os.chdir(old_dir)
+            try:
+                os.symlink(new_path, path)
+            except OSError:
+                # Created meanwhile by another thread
+                if not os.path.islink(path):
+                    raise
 
+        self._user_paths[username] = path
         return path
 
     def _worksheet_pathname(self, username, id_number):
         return os.path.join(self._user_path(username), str(id_number))
 
-    def _worksheet_path(self, username, id_number=None):
-        if id_number is None:
-            return self._makepath(self._user_path(username))
-        return self._makepath(self._worksheet_pathname(username, id_number))
-
     def _worksheet_conf_filename(self, username, id_number):
-        return os.path.join(
-            self._worksheet_path(username, id_number), 'worksheet_conf.pickle')
+        return os.path.join(self._worksheet_pathname(username, id_number),
+                            'worksheet_conf.pickle')
 
     def _worksheet_html_filename(self, username, id_number):
-        return os.path.join(
-            self._worksheet_path(username, id_number), 'worksheet.html')
+        return os.path.join(self._worksheet_pathname(username, id_number),
+                            'worksheet.html')
+
+    def _worksheet_records(self, username, id_number):
+        return CellRecords(self._abspath(
+            self._worksheet_pathname(username, id_number)))
+
+    def _worksheet_body_exists(self, username, id_number):
+        html_file = self._abspath(
+            self._worksheet_html_filename(username, id_number))
+        return (os.path.exists(html_file) or
+                self._worksheet_records(username, id_number).exists)
+
+    def _user_filename(self, username):
+        return os.path.join(self._users_path, '{}.pickle'.format(username))
 
     def _history_filename(self, username):
+        return os.path.join(self._user_path(username), 'history.log')
+
+    def _legacy_history_filename(self, username):
         return os.path.join(self._user_path(username), 'history.pickle')
 
+    def _history_log(self, username):
+        """
+        Return the history log of the given user, converting the history
+        pickle of older versions if needed.
+        """
+        log = RecordLog(self._abspath(self._history_filename(username)))
+        if username not in self._history_lengths:
+            legacy = self._legacy_history_filename(username)
+            if not log.exists and os.path.exists(self._abspath(legacy)):
+                log.rewrite(self._load(legacy))
+                self._permissions(log.filename)
+                os.unlink(self._abspath(legacy))
+            self._history_lengths[username] = log.check()
+        return log
+
     def _abspath(self, file):
         """
         Return absolute path to filename got by joining self._path
@@ -409,16 +268,17 @@ class FilesystemDatastore(Datastore):
 
     def _load(self, filename):
         with open(self._abspath(filename), 'rb') as f:
-            try:
-                result = pickle.load(f)
-            # Workaround for some exported worksheets with encoded worksheet
-            # names. It might fix other encoding problems. For py3.
-            except UnicodeEncodeError:
-                result = pickle.load(f, econding='utf-8')
+            s = f.read()
+        storage_read.inc(len(s))
+        return self._loads(s)
 
-        return result
+    def _loads(self, s):
+        return serializers.loads(s)
 
-    def _save(self, obj, filename):
+    def _dumps(self, obj, serializer=None):
+        return serializers.dumps(obj, serializer or self.serializer)
+
+    def _save(self, obj, filename, serializer=None):
         """
         TESTS:
 
@@ -444,9 +304,7 @@ class FilesystemDatastore(Datastore):
             sage: len(D._load(fn))
             100000
         """
-        s = pickle.dumps(obj, protocol=0)
-        if len(s) == 0:
-            raise ValueError("Invalid Pickle")
+        s = self._dumps(obj, serializer)
         with atomic_write(self._abspath(filename)) as f:
             f.write(s)
 
@@ -460,14 +318,6 @@ class FilesystemDatastore(Datastore):
     # storage will work).
     #########################################################################
 
-    def _basic_to_users(self, obj):
-        return dict([(name, User.from_basic(basic)) for name, basic in obj])
-
-    def _users_to_basic(self, users):
-        new = list(sorted([[name, U.basic]
-                           for name, U in users.items()]))
-        return new
-
     def _basic_to_server_conf(self, obj):
         return ServerConfiguration.from_basic(obj)
 
@@ -489,7 +339,7 @@ class FilesystemDatastore(Datastore):
         else:
             obj['name'] = name
 
-        path = self._abspath(self._worksheet_path(obj['owner']))
+        path = self._abspath(self._user_path(obj['owner']))
         return Worksheet_from_basic(obj, path)
 
     def _worksheet_to_basic(self, worksheet):
@@ -516,8 +366,116 @@ class FilesystemDatastore(Datastore):
         self._save(basic, self._conf_filename)
         self._permissions(self._conf_filename)
 
+    def load_pub_index(self):
+        """
+        Return the dict which maps the filenames (``'owner/id_number'``) of
+        the published worksheets to the id numbers of their published
+        versions, or None if it has not been saved yet.
+        """
+        if not os.path.exists(self._abspath(self._pub_index_filename)):
+            return None
+        return self._load(self._pub_index_filename)
+
+    def save_pub_index(self, index):
+        self._save(index, self._pub_index_filename)
+
+    def load_pub_catalog(self):
+        """
+        Return the catalog of published worksheets, a dict which maps
+        their id numbers to their entries (dicts with an ``'id_number'``
+        key), or None if it has not been saved yet.
+
+        The catalog is a log of json records, the new entries and the
+        removed id numbers. It is compacted when it is loaded.
+        """
+        log = RecordLog(self._abspath(self._pub_catalog_filename))
+        if not log.exists:
+            return None
+        log.check()
+        catalog = {}
+        n = 0
+        for record in log.tail():
+            entry = json.loads(record)
+            if 'removed' in entry:
+                catalog.pop(entry['removed'], None)
+            else:
+                catalog[entry['id_number']] = entry
+            n += 1
+        if n > len(catalog):
+            self.save_pub_catalog(catalog)
+        return catalog
+
+    def update_pub_catalog(self, entries=(), removed=()):
+        """
+        Add or replace the ``entries`` of the catalog of published
+        worksheets, and remove the entries with id numbers in
+        ``removed``, appending them to the catalog log.
+        """
+        records = [json.dumps(e) for e in entries] + [
+            json.dumps({'removed': id_number}) for id_number in removed]
+        RecordLog(self._abspath(self._pub_catalog_filename)).append(records)
+
+    def save_pub_catalog(self, catalog):
+        """
+        Save the whole catalog of published worksheets (see
+        :meth:`load_pub_catalog`).
+        """
+        RecordLog(self._abspath(self._pub_catalog_filename)).rewrite(
+            json.dumps(e) for e in catalog.values())
+
+    def _migration_log(self, name):
+        return RecordLog(self._abspath(os.path.join(
+            self._migrations_path, '{}.log'.format(name))))
+
+    def load_migration_checkpoint(self, name):
+        """
+        Return the set of items already migrated by the migration
+        ``name``, or None if it has no checkpoint.
+
+        The checkpoint is a log of the migrated items, so that it is
+        updated by appending to it.
+        """
+        log = self._migration_log(name)
+        if not log.exists:
+            return None
+        log.check()
+        return set(log.tail())
+
+    def checkpoint_migration(self, name, items):
+        """
+        Record that the migration ``name`` has migrated the ``items``
+        (a list of strings).
+        """
+        self._makepath(self._migrations_path)
+        self._migration_log(name).append(items)
+
+    def remove_migration_checkpoint(self, name):
+        """
+        Remove the checkpoint of the migration ``name``, which is
+        complete.
+        """
+        try:
+            os.unlink(self._migration_log(name).filename)
+        except OSError:
+            pass
+
+    def _upgrade_users(self):
+        """
+        Convert the single users pickle of older versions to per user
+        records.
+        """
+        filename = self._abspath(self._users_filename)
+        if os.path.exists(filename):
+            for name, basic in self._load(self._users_filename):
+                self._save(basic, self._user_filename(name))
+                self._permissions(self._user_filename(name))
+            os.unlink(filename)
+
     def load_users(self, user_manager):
         """
+        Register the stored users in ``user_manager``. Each user is read
+        from the storage on its first access.
+
         OUTPUT:
 
             - dictionary of user info
@@ -532,19 +490,30 @@ class FilesystemDatastore(Datastore):
             sage: from sagenb.storage import FilesystemDatastore
             sage: ds = FilesystemDatastore(tmp_dir())
             sage: ds.save_users(users)
-            sage: 'users.pickle' in os.listdir(ds._path)
-            True
+            sage: os.listdir(os.path.join(ds._path, 'users'))
+            ['admin.pickle', 'wstein.pickle']
             sage: users = ds.load_users(U)
             sage: U
             {'admin': admin, 'wstein': wstein}
         """
-        for username, user in self._basic_to_users(
-                self._load(self._users_filename)).items():
-            user_manager[username] = user
+        self._upgrade_users()
+        user_manager.set_stored_users(
+            (filename[:-len('.pickle')] for filename in os.listdir(
+                self._abspath(self._users_path))
+             if filename.endswith('.pickle')),
+            self.load_user)
         return user_manager
 
+    def load_user(self, username):
+        """
+        Return the stored user with the given username.
+        """
+        return User.from_basic(self._load(self._user_filename(username)))
+
     def save_users(self, users):
         """
+        Save the users which changed since they were loaded or saved.
+
         INPUT:
 
             - ``users`` -- dictionary mapping user names to users
@@ -559,16 +528,32 @@ class FilesystemDatastore(Datastore):
             sage: from sagenb.storage import FilesystemDatastore
             sage: ds = FilesystemDatastore(tmp_dir())
             sage: ds.save_users(users)
-            sage: 'users.pickle' in os.listdir(ds._path)
-            True
+            sage: os.listdir(os.path.join(ds._path, 'users'))
+            ['admin.pickle', 'wstein.pickle']
             sage: users = ds.load_users(U)
             sage: U
             {'admin': admin, 'wstein': wstein}
         """
-        self._save(self._users_to_basic(users), self._users_filename)
-        self._permissions(self._users_filename)
+        for username, U in users.items():
+            if U.modified:
+                # A change made while saving marks the user again
+                U.modified = False
+                filename = self._user_filename(username)
+                with atomic_write(self._abspath(filename)) as f:
+                    f.write(self._dumps(U.basic))
+                self._permissions(filename)
+
+    def delete_user(self, username):
+        """
+        Delete the stored user with the given username, if any.
+        """
+        try:
+            os.unlink(self._abspath(self._user_filename(username)))
+        except OSError:
+            # never saved
+            pass
 
-    def load_user_history(self, username):
+    def load_user_history(self, username, maxlen=None):
         """
         Return the history log for the given user.
 
@@ -576,14 +561,14 @@ class FilesystemDatastore(Datastore):
 
             - ``username`` -- string
 
+            - ``maxlen`` -- None or integer; if given, only the last
+              ``maxlen`` entries are read
+
         OUTPUT:
 
             - list of strings
         """
-        filename = self._history_filename(username)
-        if not os.path.exists(self._abspath(filename)):
-            return []
-        return self._load(filename)
+        return self._history_log(username).tail(maxlen)
 
     def save_user_history(self, username, history):
         """
@@ -595,9 +580,34 @@ class FilesystemDatastore(Datastore):
 
             - ``history`` -- list of strings
         """
-        filename = self._history_filename(username)
-        self._save(history, filename)
-        self._permissions(filename)
+        log = self._history_log(username)
+        log.rewrite(history)
+        self._permissions(log.filename)
+        self._history_lengths[username] = len(history)
+
+    def append_user_history(self, username, entries, maxlen=None):
+        """
+        Append new entries to the history log of the given user.
+
+        The log is compacted to its last ``maxlen`` entries once it holds
+        twice as many.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``entries`` -- list of strings
+
+            - ``maxlen`` -- None or integer; the maximum length of the
+              history
+        """
+        log = self._history_log(username)
+        log.append(entries)
+        self._permissions(log.filename)
+        n = self._history_lengths[username] + len(entries)
+        self._history_lengths[username] = n
+        if maxlen is not None and n >= 2 * maxlen:
+            self.save_user_history(username, log.tail(maxlen))
 
     def save_worksheet(self, worksheet, conf_only=False):
         """
@@ -620,6 +630,9 @@ class FilesystemDatastore(Datastore):
         """
         username = worksheet.owner
         id_number = worksheet.id_number
+        # The directory is created with the worksheet, but it may have been
+        # deleted since then.
+        self._makepath(self._worksheet_pathname(username, id_number))
         basic = self._worksheet_to_basic(worksheet)
         if not hasattr(
                 worksheet, '_last_basic') or worksheet._last_basic != basic:
@@ -629,10 +642,22 @@ class FilesystemDatastore(Datastore):
             worksheet._last_basic = basic
         if not conf_only and worksheet.body_is_loaded:
             # only save if loaded
-            # todo -- add check if changed
-            filename = self._worksheet_html_filename(username, id_number)
-            with atomic_write(self._abspath(filename)) as f:
-                f.write(worksheet.body.encode('utf-8', 'ignore'))
+            records = self._worksheet_records(username, id_number)
+            html_file = self._abspath(
+                self._worksheet_html_filename(username, id_number))
+            if self.cell_storage:
+                # only the cells changed since the last save are written
+                worksheet._saved_cells = records.save(
+                    worksheet.cells, getattr(worksheet, '_saved_cells', None))
+                if os.path.exists(html_file):
+                    os.unlink(html_file)
+            else:
+                # todo -- add check if changed
+                with atomic_write(html_file) as f:
+                    f.write(worksheet.body.encode('utf-8', 'ignore'))
+                if records.exists:
+                    records.delete()
+                    worksheet._saved_cells = None
 
     def create_worksheet(self, username, id_number, **kwargs):
         """
@@ -650,9 +675,7 @@ class FilesystemDatastore(Datastore):
 
             - a worksheet
         """
-        filename = self._worksheet_html_filename(username, id_number)
-        html_file = self._abspath(filename)
-        if os.path.exists(html_file):
+        if self._worksheet_body_exists(username, id_number):
             raise ValueError("Worksheet %s/%s already exists" %
                              (username, id_number))
 
@@ -685,9 +708,7 @@ class FilesystemDatastore(Datastore):
             raise ValueError("Worksheet %s/%s does not exist" %
                              (username, id_number))
 
-        filename = self._worksheet_html_filename(username, id_number)
-        html_file = self._abspath(filename)
-        if not os.path.exists(html_file):
+        if not self._worksheet_body_exists(username, id_number):
             raise ValueError("Worksheet %s/%s does not exist" %
                              (username, id_number))
 
@@ -714,7 +735,15 @@ class FilesystemDatastore(Datastore):
                 self.save_worksheet(W, conf_only=True)
         return W
 
-    def export_worksheet(self, username, id_number, filename, title):
+    def worksheet_exists(self, username, id_number):
+        """
+        Return whether the worksheet with given id_number belonging to the
+        given user is stored, without loading it.
+        """
+        return self._worksheet_body_exists(username, id_number)
+
+    def export_worksheet(self, username, id_number, filename, title,
+                         compression='bz2'):
         """
         Export the worksheet with given username and id_number to the
         given filename (e.g., 'worksheet.sws').
@@ -723,8 +752,33 @@ class FilesystemDatastore(Datastore):
 
             - ``title`` - title to use for the exported worksheet (if
                None, just use current title)
+
+            - ``compression`` - string (default: 'bz2'); the compression of
+              the archive, one of the keys of ``archive.compressors``
+        """
+        with open(filename, 'wb') as f:
+            for chunk in self.export_worksheet_stream(
+                    username, id_number, title, compression):
+                f.write(chunk)
+
+    def export_worksheet_stream(self, username, id_number, title,
+                                compression='bz2'):
         """
-        T = tarfile.open(filename, 'w:bz2')
+        Export the worksheet with given username and id_number as an
+        iterator of chunks of the sws file.
+
+        The archive is built while it is consumed, directly from the
+        worksheet files.
+
+        INPUT:
+
+            - ``title`` - title to use for the exported worksheet (if
+               None, just use current title)
+
+            - ``compression`` - string (default: 'bz2'); the compression of
+              the archive, one of the keys of ``archive.compressors``
+        """
+        T = TarStream(compression)
         worksheet = self.load_worksheet(username, id_number)
         basic = copy.deepcopy(self._worksheet_to_basic(worksheet))
         if title:
@@ -737,144 +791,129 @@ class FilesystemDatastore(Datastore):
             if k in basic:
                 del basic[k]
 
-        self._save(basic, self._worksheet_conf_filename(
-            username, id_number) + '2')
-        tmp = self._abspath(self._worksheet_conf_filename(
-            username, id_number) + '2')
-        T.add(tmp, os.path.join('sage_worksheet', 'worksheet_conf.pickle'))
-        os.unlink(tmp)
+        # Legacy pickle, so that older notebooks can import the worksheet
+        members = [
+            T.add_bytes(
+                os.path.join('sage_worksheet', 'worksheet_conf.pickle'),
+                self._dumps(basic, serializers.legacy.name)),
+            ]
 
-        worksheet_html = self._abspath(
-            self._worksheet_html_filename(username, id_number))
-        T.add(worksheet_html, os.path.join('sage_worksheet', 'worksheet.html'))
+        # worksheet.html is always exported, whatever the storage of the
+        # body, for compatibility.
+        body = worksheet.saved_body
+        members.append(T.add_bytes(
+            os.path.join('sage_worksheet', 'worksheet.html'),
+            body.encode('utf-8')))
 
         # The following is purely for backwards compatibility with old
         # notebook servers prior to sage-4.1.2.
-        fd, worksheet_txt = tempfile.mkstemp()
         old_heading = "%s\nsystem:%s\n" % (basic['name'], basic['system'])
-        with open(worksheet_txt, 'w') as f:
-            with open(worksheet_html) as g:
-                f.write(old_heading + g.read())
-        T.add(worksheet_txt,
-              os.path.join('sage_worksheet', 'worksheet.txt'))
-        os.unlink(worksheet_txt)
-        # important, so we don't leave an open file handle!
-        os.close(fd)
+        members.append(T.add_bytes(
+            os.path.join('sage_worksheet', 'worksheet.txt'),
+            (old_heading + body).encode('utf-8')))
         # end backwards compat block.
 
-        # Add the contents of the DATA directory
+        # Add the contents of the DATA directory and of each of the cell
+        # directories.
         path = self._abspath(self._worksheet_pathname(username, id_number))
-        data = os.path.join(path, 'data')
-        if os.path.exists(data):
-            for X in os.listdir(data):
-                T.add(os.path.join(data, X), os.path.join(
-                    'sage_worksheet', 'data', X))
-
-        # Add the contents of each of the cell directories.
-        cells = os.path.join(path, 'cells')
-        if os.path.exists(cells):
-            for X in os.listdir(cells):
-                T.add(os.path.join(cells, X), os.path.join(
-                    'sage_worksheet', 'cells', X))
+        for dirname in ('data', 'cells'):
+            dirpath = os.path.join(path, dirname)
+            if os.path.exists(dirpath):
+                for X in sorted(os.listdir(dirpath)):
+                    members.append(T.add(
+                        os.path.join(dirpath, X),
+                        os.path.join('sage_worksheet', dirname, X)))
 
         # NOTE: We do not export the snapshot/undo data.  People
         # frequently *complain* about Sage exporting a record of their
         # mistakes anyways.
-        T.close()
+        members.append(T.close())
 
-    def _import_old_worksheet(self, username, id_number, filename):
-        """
-        Import a worksheet from an old version of Sage.
-        """
-        T = tarfile.open(filename, 'r:bz2')
-        members = [a for a in T.getmembers(
-        ) if 'worksheet.txt' in a.name and is_safe(a.name)]
-        if len(members) == 0:
-            raise RuntimeError("unable to import worksheet")
-
-        worksheet_txt = members[0].name
-        W = self.load_worksheet(username, id_number)
-        W.edit_save_old_format(T.extractfile(
-            worksheet_txt).read().decode('utf-8', 'ignore'))
-        # '/' is right, since old worksheets always unix
-        dir = worksheet_txt.split('/')[0]
-
-        path = self._abspath(self._worksheet_pathname(username, id_number))
-
-        base = os.path.join(dir, 'data')
-        members = [a for a in T.getmembers() if a.name.startswith(base) and
-                   is_safe(a.name)]
-        if len(members) > 0:
-            T.extractall(path, members)
-            dest = os.path.join(path, 'data')
-            if os.path.exists(dest):
-                shutil.rmtree(dest)
-            shutil.move(os.path.join(path, base), path)
-
-        base = os.path.join(dir, 'cells')
-        members = [a for a in T.getmembers() if a.name.startswith(base) and
-                   is_safe(a.name)]
-        if len(members) > 0:
-            T.extractall(path, members)
-            dest = os.path.join(path, 'cells')
-            if os.path.exists(dest):
-                shutil.rmtree(dest)
-            shutil.move(os.path.join(path, base), path)
-
-        tmp = os.path.join(path, dir)
-        if os.path.exists(tmp):
-            shutil.rmtree(tmp)
-
-        T.close()
-
-        return W
+        return (chunk for member in members for chunk in member if chunk)
 
     def import_worksheet(self, username, id_number, filename):
         """
         Import the worksheet username/id_number from the file with
         given filename.
+
+        The archive is read in a single pass and each member is written
+        directly to its final location. Worksheets from old versions of
+        Sage, which have no ``worksheet_conf.pickle``, are imported from
+        their ``worksheet.txt``.
         """
         path = self._abspath(self._worksheet_pathname(username, id_number))
         if os.path.exists(path):
             shutil.rmtree(path, ignore_errors=True)
         os.makedirs(path)
-        T = tarfile.open(filename, 'r:bz2')
-        try:
-            with open(self._abspath(self._worksheet_conf_filename(
-                    username, id_number)), 'wb') as f:
-                f.write(T.extractfile(os.path.join(
-                    'sage_worksheet', 'worksheet_conf.pickle')).read())
-        except KeyError:
-            # Not a valid worksheet.  This might mean it is an old
-            # worksheet from a previous version of Sage.
-            return self._import_old_worksheet(username, id_number, filename)
-
-        with open(self._abspath(self._worksheet_html_filename(
-                username, id_number)), 'wb') as f:
-            f.write(T.extractfile(os.path.join(
-                'sage_worksheet', 'worksheet.html')).read())
-
-        base = os.path.join('sage_worksheet', 'data')
-        members = [a for a in T.getmembers() if a.name.startswith(base) and
-                   is_safe(a.name)]
-        if len(members) > 0:
-            T.extractall(path, members)
-            shutil.move(os.path.join(path, base), path)
-
-        base = os.path.join('sage_worksheet', 'cells')
-        members = [a for a in T.getmembers() if a.name.startswith(base) and
-                   is_safe(a.name)]
-        if len(members) > 0:
-            T.extractall(path, members)
-            shutil.move(os.path.join(path, base), path)
-
-        tmp = os.path.join(path, 'sage_worksheet')
-        if os.path.exists(tmp):
-            shutil.rmtree(tmp)
 
+        conf_filename = self._abspath(
+            self._worksheet_conf_filename(username, id_number))
+        html_filename = self._abspath(
+            self._worksheet_html_filename(username, id_number))
+        top = None
+        has_conf = False
+        old_text = None
+        T = tarfile.open(filename, 'r|*')
+        for member in T:
+            if not is_safe(member.name):
+                continue
+            # '/' is right, since tar member names are always unix
+            parts = member.name.split('/')
+            if top is None:
+                top = parts[0]
+            if parts[0] != top or len(parts) < 2:
+                continue
+            rest = parts[1:]
+            if rest == ['worksheet_conf.pickle']:
+                with open(conf_filename, 'wb') as f:
+                    shutil.copyfileobj(T.extractfile(member), f)
+                has_conf = True
+            elif rest == ['worksheet.html']:
+                with open(html_filename, 'wb') as f:
+                    shutil.copyfileobj(T.extractfile(member), f)
+            elif rest == ['worksheet.txt']:
+                # Only needed by worksheets of old versions of Sage
+                old_text = T.extractfile(member).read()
+            elif rest[0] in ('data', 'cells') and (
+                    member.isfile() or member.isdir()):
+                member.name = '/'.join(rest)
+                T.extract(member, path)
         T.close()
+        self.store_files([os.path.join(path, 'cells')])
+
+        if has_conf:
+            return self.load_worksheet(username, id_number)
+        if old_text is None:
+            raise RuntimeError("unable to import worksheet")
+        W = self.create_worksheet(username, id_number)
+        W.edit_save_old_format(old_text.decode('utf-8', 'ignore'))
+        self.save_worksheet(W)
+        return W
+
+    def store_files(self, paths):
+        """
+        Store the cell files (or directories of files) ``paths`` of
+        worksheets in the blob store, so that identical files share their
+        contents. See :mod:`.blobs`.
+        """
+        for path in paths:
+            if os.path.isdir(path):
+                self._blobs.add_tree(path)
+            elif os.path.isfile(path):
+                self._blobs.add(path)
+
+    def file_hash(self, path):
+        """
+        Return the sha1 of the file ``path`` of a worksheet.
+        """
+        return self._blobs.hash(path)
 
-        return self.load_worksheet(username, id_number)
+    def collect_files(self):
+        """
+        Remove the contents of the stored files which are not used any
+        more, and return their number and total size.
+        """
+        return self._blobs.collect()
 
     def worksheets(self, username):
         """
@@ -932,6 +971,7 @@ class FilesystemDatastore(Datastore):
         This is only here because it is useful for doctesting.
         """
         shutil.rmtree(self._path, ignore_errors=True)
+        self._user_paths.clear()
 
 
 ##############################################################################
@@ -982,4 +1022,10 @@ class FilesystemDatastore(Datastore):
 # NOTE!  Actually simplejson does just as well at cPickle for this benchmark.
 #        Thanks to Mitesh Patel for pointing this out.
 #
+# UPDATE: util/benchmarks/serializers.py reproduces these measurements.
+# On Python 3.11 loads(dumps(b)) takes 45 us with pickle protocol 0, 13 us
+# with protocol 4 (which is also 25% smaller), 39 us with json and 1 ms
+# with yaml + C. Hence protocol 4 is the default serializer, see
+# serializers.py.
+#
 #############################################################################
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*
+"""
+Serializers of the basic Python objects kept by the datastores.
+
+Serialized data starts with a header which names the serializer that
+wrote it::
+
+    b'\x00' <serializer name> b'\n' <data>
+
+so that the serializer can be changed without converting the existing
+files. Data without header is a pickle written by older versions, which
+always used the (slow and large) pickle protocol 0. It is still read, and
+it is still written when compatibility with them is needed, e.g., in
+exported worksheets.
+
+A pickle never starts with a null byte, so headers and legacy pickles
+can't be mistaken.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+from future.moves import pickle
+
+
+class Serializer(object):
+    """
+    Abstract serializer. Subclasses implement :meth:`dumps` and
+    :meth:`loads` and are registered in ``serializers``.
+    """
+    name = None
+
+    def __repr__(self):
+        return '{} serializer'.format(self.name)
+
+    @property
+    def header(self):
+        return b'\x00' + self.name.encode('ascii') + b'\n'
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, s):
+        raise NotImplementedError
+
+
+class PickleSerializer(Serializer):
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.name = 'pickle{}'.format(protocol)
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, protocol=self.protocol)
+
+    def loads(self, s):
+        try:
+            return pickle.loads(s)
+        # Workaround for some exported worksheets with encoded worksheet
+        # names. It might fix other encoding problems. For py3.
+        except UnicodeEncodeError:
+            return pickle.loads(s, encoding='utf-8')
+
+
+class LegacySerializer(PickleSerializer):
+    """
+    Protocol 0 pickles without header, as written by older versions.
+    """
+    header = b''
+
+    def __init__(self):
+        PickleSerializer.__init__(self, 0)
+        self.name = 'legacy'
+
+
+legacy = LegacySerializer()
+
+# Protocol 4 is only available on Python 3.4+
+serializers = dict((S.name, S) for S in (
+    PickleSerializer(protocol) for protocol in (2, 4)
+    if protocol <= pickle.HIGHEST_PROTOCOL))
+
+default = 'pickle{}'.format(min(4, pickle.HIGHEST_PROTOCOL))
+
+
+def dumps(obj, serializer=default):
+    """
+    Return the serialization of ``obj``, with its header.
+
+    INPUT:
+
+    - ``obj`` - a basic Python object
+
+    - ``serializer`` - string (default: ``default``); the name of a
+      registered serializer or ``'legacy'``
+    """
+    S = legacy if serializer == legacy.name else serializers[serializer]
+    s = S.dumps(obj)
+    if len(s) == 0:
+        raise ValueError('Invalid serialization')
+    return S.header + s
+
+
+def loads(s):
+    """
+    Return the object serialized in ``s`` by :func:`dumps`, whatever the
+    serializer.
+    """
+    if not s.startswith(b'\x00'):
+        return legacy.loads(s)
+    end = s.index(b'\n')
+    name = s[1:end].decode('ascii')
+    try:
+        S = serializers[name]
+    except KeyError:
+        raise ValueError('Unknown serializer {!r}'.format(name))
+    return S.loads(s[end + 1:])
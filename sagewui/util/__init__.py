@@ -5,9 +5,13 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import range
 from builtins import filter
+from builtins import object
+from builtins import open
 
 import errno
+import heapq
 import os
+import shutil
 import resource
 import signal
 import socket
@@ -17,12 +21,16 @@ import sys
 import tempfile
 import time
 
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from importlib import import_module
-from itertools import chain
-from itertools import count
 from future.moves.itertools import filterfalse
 from future.moves.itertools import zip_longest
 
+from .metrics import storage_written
+
 
 def grouper(iterable, n, fillvalue=None):
     "Collect data into fixed-length chunks or blocks"
@@ -167,6 +175,219 @@ def tmp_dir(name='dir', ext='', **kwargs):
     return '{}{}'.format(tmp, os.sep)
 
 
+# From sage.misc.temporary_file
+
+class atomic_write(object):
+    """
+    Write to a given file using a temporary file and then rename it
+    to the target file. This renaming should be atomic on modern
+    operating systems. Therefore, this class can be used to avoid race
+    conditions when a file might be read while it is being written.
+    It also avoids having partially written files due to exceptions
+    or crashes.
+
+    This is to be used in a ``with`` statement, where a temporary file
+    is created when entering the ``with`` and is moved in place of the
+    target file when exiting the ``with`` (if no exceptions occured).
+
+    INPUT:
+
+    - ``target_filename`` -- the name of the file to be written.
+      Normally, the contents of this file will be overwritten.
+
+    - ``append`` -- (boolean, default: False) if True and
+      ``target_filename`` is an existing file, then copy the current
+      contents of ``target_filename`` to the temporary file when
+      entering the ``with`` statement. Otherwise, the temporary file is
+      initially empty.
+
+    - ``mode`` -- (default: ``0o666``) mode bits for the file. The
+      temporary file is created with mode ``mode & ~umask`` and the
+      resulting file will also have these permissions (unless the
+      mode bits of the file were changed manually).
+
+    EXAMPLES::
+
+        sage: from sage.misc.temporary_file import atomic_write
+        sage: target_file = tmp_filename()
+        sage: open(target_file, "w").write("Old contents")
+        sage: with atomic_write(target_file) as f:
+        ....:     f.write("New contents")
+        ....:     f.flush()
+        ....:     open(target_file, "r").read()
+        'Old contents'
+        sage: open(target_file, "r").read()
+        'New contents'
+
+    The name of the temporary file can be accessed using ``f.name``.
+    It is not a problem to close and re-open the temporary file::
+
+        sage: from sage.misc.temporary_file import atomic_write
+        sage: target_file = tmp_filename()
+        sage: open(target_file, "w").write("Old contents")
+        sage: with atomic_write(target_file) as f:
+        ....:     f.close()
+        ....:     open(f.name, "w").write("Newer contents")
+        sage: open(target_file, "r").read()
+        'Newer contents'
+
+    If an exception occurs while writing the file, the target file is
+    not touched::
+
+        sage: with atomic_write(target_file) as f:
+        ....:     f.write("Newest contents")
+        ....:     raise RuntimeError
+        Traceback (most recent call last):
+        ...
+        RuntimeError
+        sage: open(target_file, "r").read()
+        'Newer contents'
+
+    Some examples of using the ``append`` option. Note that the file
+    is never opened in "append" mode, it is possible to overwrite
+    existing data::
+
+        sage: target_file = tmp_filename()
+        sage: with atomic_write(target_file, append=True) as f:
+        ....:     f.write("Hello")
+        sage: with atomic_write(target_file, append=True) as f:
+        ....:     f.write(" World")
+        sage: open(target_file, "r").read()
+        'Hello World'
+        sage: with atomic_write(target_file, append=True) as f:
+        ....:     f.seek(0)
+        ....:     f.write("HELLO")
+        sage: open(target_file, "r").read()
+        'HELLO World'
+
+    If the target file is a symbolic link, the link is kept and the
+    target of the link is written to::
+
+        sage: link_to_target = os.path.join(tmp_dir(), "templink")
+        sage: os.symlink(target_file, link_to_target)
+        sage: with atomic_write(link_to_target) as f:
+        ....:     f.write("Newest contents")
+        sage: open(target_file, "r").read()
+        'Newest contents'
+
+    We check the permission bits of the new file. Note that the old
+    permissions do not matter::
+
+        sage: os.chmod(target_file, 0o600)
+        sage: _ = os.umask(0o022)
+        sage: with atomic_write(target_file) as f:
+        ....:     pass
+        sage: oct(os.stat(target_file).st_mode & 0o777)
+        '644'
+        sage: _ = os.umask(0o077)
+        sage: with atomic_write(target_file, mode=0o777) as f:
+        ....:     pass
+        sage: oct(os.stat(target_file).st_mode & 0o777)
+        '700'
+
+    Test writing twice to the same target file. The outermost ``with``
+    "wins"::
+
+        sage: open(target_file, "w").write(">>> ")
+        sage: with atomic_write(target_file, append=True) as f, \
+        ....:          atomic_write(target_file, append=True) as g:
+        ....:     f.write("AAA"); f.close()
+        ....:     g.write("BBB"); g.close()
+        sage: open(target_file, "r").read()
+        '>>> AAA'
+    """
+    def __init__(self, target_filename, append=False, mode=0o666):
+        """
+        TESTS::
+
+            sage: from sage.misc.temporary_file import atomic_write
+            sage: link_to_target = os.path.join(tmp_dir(), "templink")
+            sage: os.symlink("/foobar", link_to_target)
+            sage: aw = atomic_write(link_to_target)
+            sage: print aw.target
+            /foobar
+            sage: print aw.tmpdir
+            /
+        """
+        self.target = os.path.realpath(target_filename)
+        self.tmpdir = os.path.dirname(self.target)
+        self.append = append
+        # Remove umask bits from mode
+        umask = os.umask(0)
+        os.umask(umask)
+        self.mode = mode & (~umask)
+
+    def __enter__(self):
+        """
+        Create and return a temporary file in ``self.tmpdir`` (normally
+        the same directory as the target file).
+
+        If ``self.append``, then copy the current contents of
+        ``self.target`` to the temporary file.
+
+        OUTPUT: a file returned by :func:`tempfile.NamedTemporaryFile`.
+
+        TESTS::
+
+            sage: from sage.misc.temporary_file import atomic_write
+            sage: aw = atomic_write(tmp_filename())
+            sage: with aw as f:
+            ....:     os.path.dirname(aw.target) == os.path.dirname(f.name)
+            True
+        """
+        self.tempfile = tempfile.NamedTemporaryFile(dir=self.tmpdir,
+                                                    delete=False)
+        self.tempname = self.tempfile.name
+        os.chmod(self.tempname, self.mode)
+        if self.append:
+            try:
+                r = open(self.target).read()
+            except IOError:
+                pass
+            else:
+                self.tempfile.write(r)
+        return self.tempfile
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        If the ``with`` block was successful, move the temporary file
+        to the target file. Otherwise, delete the temporary file.
+
+        TESTS:
+
+        Check that the temporary file is deleted if there was an
+        exception::
+
+            sage: from sage.misc.temporary_file import atomic_write
+            sage: with atomic_write(tmp_filename()) as f:
+            ....:     tempname = f.name
+            ....:     raise RuntimeError
+            Traceback (most recent call last):
+            ...
+            RuntimeError
+            sage: os.path.exists(tempname)
+            False
+        """
+        # Flush the file contents to disk (to be safe even if the
+        # system crashes) and close the file.
+        if not self.tempfile.closed:
+            self.tempfile.flush()
+            os.fsync(self.tempfile.fileno())
+            self.tempfile.close()
+
+        if exc_type is None:
+            # Success: move temporary file to target file
+            storage_written.inc(os.path.getsize(self.tempname))
+            try:
+                os.rename(self.tempname, self.target)
+            except OSError:
+                os.unlink(self.target)
+                os.rename(self.tempname, self.target)
+        else:
+            # Failure: delete temporary file
+            os.unlink(self.tempname)
+
+
 def cputime(t=0):
     # TODO: Not used
     try:
@@ -248,6 +469,88 @@ def ignore_nonexistent_files(curdir, dirlist):
     return ignore
 
 
+# ioctl of Linux which makes a copy on write clone (reflink) of a file, on
+# filesystems which support it (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst, link=True):
+    """
+    Create ``dst`` with the contents, permissions and times of the file
+    ``src``, as cheaply as the filesystem allows: a hard link (if
+    ``link``), a reflink, or a copy.
+
+    A hard link shares the file, so it must only be used if the files are
+    replaced, not modified in place. Reflinks and copies are
+    independent.
+    """
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            # Another filesystem, links not supported, too many links...
+            pass
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+    except (ImportError, IOError, OSError):
+        shutil.copy2(src, dst)
+
+
+def sync_tree(src, dst, link=True):
+    """
+    Make the directory ``dst`` a copy of the directory ``src``, as
+    :func:`shutil.copytree` does, but touching only what differs.
+
+    Files are created by :func:`clone_file`. Files of ``dst`` with the
+    same size and modification time as those of ``src`` (which hard
+    links, reflinks and copies preserve) are kept, and files of ``dst``
+    which are not in ``src`` are removed. As with :func:`shutil.copytree`,
+    symbolic links are followed and broken ones are ignored.
+
+    OUTPUT:
+
+    - an integer; the number of files created
+    """
+    created = 0
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        dst_names = set(os.listdir(dst))
+    else:
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        os.makedirs(dst)
+        dst_names = set()
+    for name in os.listdir(src):
+        s = os.path.join(src, name)
+        d = os.path.join(dst, name)
+        dst_names.discard(name)
+        if os.path.isdir(s):
+            created += sync_tree(s, d, link)
+        elif os.path.isfile(s):
+            if os.path.isfile(d) and not os.path.islink(d):
+                ss, ds = os.stat(s), os.stat(d)
+                if (ss.st_ino, ss.st_dev) == (ds.st_ino, ds.st_dev) or (
+                        ss.st_size == ds.st_size and
+                        int(ss.st_mtime) == int(ds.st_mtime)):
+                    continue
+            if os.path.isdir(d) and not os.path.islink(d):
+                shutil.rmtree(d)
+            elif os.path.lexists(d):
+                os.unlink(d)
+            clone_file(s, d, link)
+            created += 1
+    for name in dst_names:
+        d = os.path.join(dst, name)
+        if os.path.isdir(d) and not os.path.islink(d):
+            shutil.rmtree(d)
+        else:
+            os.unlink(d)
+    return created
+
+
 def word_wrap(s, ncols=85):
     t = []
     if ncols == 0:
@@ -454,13 +757,92 @@ def cached_property(writable=False, invalidate=()):
     return wrapper
 
 
+class IdGenerator(object):
+    """
+    Iterator over the free ids: in increasing order, the non negative
+    integers lower than the largest used id which are not used, then the
+    integers from the largest used id + 1 + ``offset`` (from ``offset`` if
+    no id is used).
+
+    The used ids are kept in a heap, from which they are dropped as the
+    iteration passes them, so creating the iterator doesn't sort them,
+    and memory does not grow with the magnitude of the ids as with
+    set(range(max(used))).
+    """
+    def __init__(self, used=(), offset=0):
+        self._used = list(set(used))
+        heapq.heapify(self._used)
+        # Largest used id, until the iteration passes it
+        self._last = max(self._used) if self._used else None
+        self._offset = offset
+        self._next = 0 if self._used else offset
+
+    def __repr__(self):
+        return 'Id generator at {}'.format(self._next)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        used = self._used
+        while True:
+            if self._last is not None and self._next > self._last:
+                self._next = self._last + 1 + self._offset
+                self._last = None
+            while used and used[0] < self._next:
+                heapq.heappop(used)
+            if used and used[0] == self._next:
+                self._next += 1
+                continue
+            id = self._next
+            self._next += 1
+            return id
+
+
 def id_generator(exclude=None, offset=0):
-    if exclude:
-        m = max(exclude)
-        return chain(sorted(set(range(m)) - set(exclude)),
-                     count(m + 1 + offset))
-    else:
-        return count(offset)
+    return IdGenerator(exclude or (), offset)
+
+
+def bounded_map(function, iterable, workers, discard=None):
+    """
+    Yields the pairs ``(item, function(item))`` for the items of
+    ``iterable``, in order of completion, computing them in a pool of
+    ``workers`` threads.
+
+    At most ``2 * workers`` results are pending (being computed or not
+    yet consumed) at any time, so ``iterable`` may be long and the results
+    large, e.g., temporary files.
+
+    If the iteration is interrupted (the generator is closed, or
+    ``function`` raises an exception, which is raised here), the pending
+    items are completed and ``discard`` is called on their results.
+    """
+    items = iter(iterable)
+    pending = {}
+    done = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                while len(pending) < 2 * workers:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        break
+                    pending[executor.submit(function, item)] = item
+                if not done:
+                    if not pending:
+                        break
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    done.extend(finished)
+                future = done.popleft()
+                yield pending.pop(future), future.result()
+        finally:
+            for future in pending:
+                if not future.cancel() and discard is not None:
+                    try:
+                        discard(future.result())
+                    except Exception:
+                        pass
 
 
 def make_path_relative(dir):
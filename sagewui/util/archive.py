@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*
+"""
+Streamed tar and zip archives.
+
+:class:`TarStream` produces a compressed tar archive as an iterator of
+chunks, so that it can be sent as it is built, e.g., in an HTTP
+response, without temporary files and without holding the archive (or
+any of its members) in memory.
+
+The archives are regular tar files, readable by :mod:`tarfile` with mode
+``'r:*'`` or ``'r|*'``.
+
+:class:`ZipStream` does the same for (uncompressed) zip archives. Its
+members are followed by data descriptors, as :mod:`zipfile` writes them
+on unseekable files. Before Python 3.6, :mod:`zipfile` can't stream
+members, so each member is held in memory while it is written.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+from builtins import open
+
+import bz2
+import io
+import os
+import sys
+import tarfile
+import time
+import zipfile
+import zlib
+
+from . import get_module
+
+
+# Compressor factories. Compression levels favour speed for gzip and xz.
+# bzip2 is the historical compression of sws files and the slowest one.
+compressors = {
+    'bz2': lambda: bz2.BZ2Compressor(9),
+    'gz': lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+    }
+# lzma is not available on Python 2
+if get_module('lzma') is not None:
+    compressors['xz'] = lambda: get_module('lzma').LZMACompressor(preset=1)
+
+
+class TarStream(object):
+    chunk_size = 1 << 16
+
+    def __init__(self, compression='bz2'):
+        """
+        INPUT:
+
+        - ``compression`` - string (default: 'bz2'); one of the keys of
+          ``compressors``
+
+        Each method returns an iterator of compressed chunks, which must be
+        consumed in order.
+        """
+        self.compressor = compressors[compression]()
+        self.offset = 0
+        # Only used to build the member headers from the file system
+        self._tarinfos = tarfile.open(fileobj=io.BytesIO(), mode='w')
+
+    def _write(self, data):
+        self.offset += len(data)
+        return self.compressor.compress(data)
+
+    def _padding(self, size):
+        remainder = size % tarfile.BLOCKSIZE
+        return tarfile.NUL * (tarfile.BLOCKSIZE - remainder) if remainder \
+            else b''
+
+    def _header(self, info):
+        return self._write(info.tobuf(
+            self._tarinfos.format, self._tarinfos.encoding,
+            self._tarinfos.errors))
+
+    def add_bytes(self, arcname, data):
+        """
+        Add a regular file named ``arcname`` with content ``data``.
+        """
+        info = tarfile.TarInfo(arcname)
+        info.size = len(data)
+        info.mtime = time.time()
+        yield self._header(info)
+        yield self._write(data + self._padding(len(data)))
+
+    def add(self, path, arcname):
+        """
+        Add the file or directory (recursively) ``path`` as ``arcname``,
+        as ``tarfile.TarFile.add`` does.
+        """
+        info = self._tarinfos.gettarinfo(path, arcname)
+        if info is None:
+            # sockets, fifos...
+            return
+        if info.islnk():
+            # Files sharing their contents (hard links) are archived as
+            # independent files, since importers only extract those.
+            info.type = tarfile.REGTYPE
+            info.linkname = ''
+            info.size = os.path.getsize(path)
+        yield self._header(info)
+        if info.isreg():
+            # Exactly info.size bytes, even if the file changed meanwhile
+            remaining = info.size
+            with open(path, 'rb') as f:
+                while remaining:
+                    data = f.read(min(self.chunk_size, remaining)) or \
+                        tarfile.NUL * min(self.chunk_size, remaining)
+                    remaining -= len(data)
+                    yield self._write(data)
+            yield self._write(self._padding(info.size))
+        elif info.isdir():
+            for name in sorted(os.listdir(path)):
+                for chunk in self.add(os.path.join(path, name),
+                                      os.path.join(arcname, name)):
+                    yield chunk
+
+    def close(self):
+        """
+        Terminate the archive.
+        """
+        # Two empty blocks, then padding to a full record, as tarfile does
+        end = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+        yield self._write(end)
+        remainder = self.offset % tarfile.RECORDSIZE
+        if remainder:
+            yield self._write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+        yield self.compressor.flush()
+
+
+# ZipFile.open(..., 'w') is new in Python 3.6
+STREAMED_ZIP_MEMBERS = sys.version_info >= (3, 6)
+
+
+class _ChunkBuffer(object):
+    """
+    File which keeps what is written until it is taken.
+
+    It is unseekable if ``seekable`` is False. Otherwise, only the data
+    not yet taken can be sought, which is enough for :mod:`zipfile` to
+    rewrite the header of the member it has just written.
+    """
+    def __init__(self, seekable=False):
+        self._seekable = seekable
+        self._data = io.BytesIO()
+        # Position of the start of _data in the file
+        self._offset = 0
+
+    def write(self, data):
+        return self._data.write(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        if not self._seekable:
+            raise IOError('unseekable file')
+        return self._offset + self._data.tell()
+
+    def seek(self, offset, whence=0):
+        if not self._seekable or whence != 0 or offset < self._offset:
+            raise IOError('unseekable position')
+        self._data.seek(offset - self._offset)
+
+    def take(self):
+        self._data.seek(0, 2)
+        data = self._data.getvalue()
+        self._offset += len(data)
+        self._data = io.BytesIO()
+        return data
+
+
+class ZipStream(object):
+    chunk_size = 1 << 16
+
+    def __init__(self, compression=zipfile.ZIP_STORED):
+        """
+        INPUT:
+
+        - ``compression`` - (default: ``zipfile.ZIP_STORED``); a
+          compression method of :mod:`zipfile`. sws files are already
+          compressed.
+
+        Each method returns an iterator of chunks, which must be consumed
+        in order.
+        """
+        self._buffer = _ChunkBuffer(seekable=not STREAMED_ZIP_MEMBERS)
+        self._zip = zipfile.ZipFile(self._buffer, 'w', compression)
+
+    def add(self, path, arcname):
+        """
+        Add the regular file ``path`` as ``arcname``.
+        """
+        if not STREAMED_ZIP_MEMBERS:
+            self._zip.write(path, arcname)
+            yield self._buffer.take()
+            return
+        info = zipfile.ZipInfo.from_file(path, arcname)
+        info.compress_type = self._zip.compression
+        with open(path, 'rb') as f, self._zip.open(info, 'w') as dest:
+            yield self._buffer.take()
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                dest.write(data)
+                yield self._buffer.take()
+        yield self._buffer.take()
+
+    def close(self):
+        """
+        Write the central directory, which terminates the archive.
+        """
+        self._zip.close()
+        yield self._buffer.take()
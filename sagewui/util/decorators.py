@@ -4,7 +4,6 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from functools import wraps
-from threading import Lock
 
 from flask import url_for
 from flask import request
@@ -18,8 +17,6 @@ from .templates import message as message_template
 
 _ = gettext
 
-global_lock = Lock()
-
 
 def login_required(f):
     @wraps(f)
@@ -63,9 +60,29 @@ def guest_or_login_required(f):
     return wrapper
 
 
-def with_lock(f):
-    @wraps(f)
-    def wrapper(*args, **kwds):
-        with global_lock:
-            return f(*args, **kwds)
-    return wrapper
+def with_read_lock(lock):
+    """
+    Decorator which holds the read/write ``lock`` (see :mod:`.locks`)
+    for reading while the request is handled.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwds):
+            with lock.read():
+                return f(*args, **kwds)
+        return wrapper
+    return decorator
+
+
+def with_write_lock(lock):
+    """
+    Decorator which holds the read/write ``lock`` (see :mod:`.locks`)
+    for writing while the request is handled.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwds):
+            with lock.write():
+                return f(*args, **kwds)
+        return wrapper
+    return decorator
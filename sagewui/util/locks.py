@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*
+"""
+Locks of the notebook server.
+
+The state shared by the request threads is protected by:
+
+- :data:`worksheet_locks` - a lock per worksheet, held while a request
+  uses the worksheet (see ``blueprints.worksheet.worksheet_view``).
+  The locks are striped: worksheets are mapped to a fixed number of
+  reentrant locks by the hash of their filename, so the number of locks
+  doesn't grow with the number of worksheets.
+
+- the save and idle locks of ``NotebookUpdater``, which serialize the
+  periodic saves and kernel checks. Requests never wait for them: if a
+  save is in progress, they skip it. The kernel checks, which may quit
+  worksheets, don't wait for the worksheet locks either: the worksheets
+  in use are skipped until the next check (see ``gui.kernels``).
+
+- :data:`users_lock` and :data:`conf_lock` - read/write locks of the
+  users and of the server configuration. They are written by the
+  requests which change them (registration, account settings, user
+  management, notebook settings) and read by ``Notebook.save`` and by
+  the pages which iterate over all of them (the ``/users`` listing), so
+  that the set of users doesn't change under them. Readers don't wait
+  for each other, so these pages don't wait for a save. Pages which only
+  show a single user or setting take no lock.
+
+- the internal locks of some objects (e.g., ``Notebook._pub_lock``,
+  ``UserManager._load_lock``, ``BlobStore._lock``), which protect a
+  single data structure.
+
+Lock ordering. A thread which holds several of these locks acquires them
+in the order of the list above: a worksheet lock, then the save or idle
+lock, then ``users_lock``, then ``conf_lock``, then internal locks. It
+holds at most one worksheet lock, and it doesn't acquire any other lock
+while it holds an internal lock. Read/write locks are not reentrant, so a
+thread which writes one must not read it too.
+
+Instrumentation. These locks record, when :data:`lock_monitor` is
+enabled (``lock_stats`` server option), the time spent waiting for them
+and holding them in histograms, with totals by endpoint of the holder
+(and by worksheet for the worksheet locks), so that slow requests can be
+attributed to contention. See the ``/lock_stats`` admin page.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+from builtins import range
+
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import has_request_context
+from flask import request
+
+from .. import config as CFG
+
+
+class Histogram(object):
+    """
+    Histogram of durations (in seconds).
+    """
+    bounds = (0.0001, 0.001, 0.01, 0.1, 1, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @property
+    def basic(self):
+        return {
+            'buckets': [[b, c] for b, c in zip(
+                list(self.bounds) + ['+Inf'], self.counts)],
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            }
+
+
+class LockStats(object):
+    """
+    Wait and hold times of a lock, with totals by holder and by key.
+    """
+    # The least waited keys are dropped beyond this number
+    max_keys = 200
+
+    def __init__(self, name):
+        self.name = name
+        self.wait = Histogram()
+        self.hold = Histogram()
+        # holder (or key) -> [acquisitions, wait, hold]
+        self.holders = {}
+        self.keys = {}
+
+    def record(self, wait, hold, holder, key=None):
+        self.wait.add(wait)
+        self.hold.add(hold)
+        for totals, name in ((self.holders, holder), (self.keys, key)):
+            if name is not None:
+                t = totals.setdefault(name, [0, 0, 0])
+                t[0] += 1
+                t[1] += wait
+                t[2] += hold
+        if len(self.keys) > self.max_keys:
+            for key in sorted(self.keys, key=lambda k: self.keys[k][1])[
+                    :len(self.keys) - self.max_keys // 2]:
+                del self.keys[key]
+
+    @staticmethod
+    def _totals(totals):
+        return sorted(
+            ({'name': name, 'count': t[0], 'wait': t[1], 'hold': t[2]}
+             for name, t in totals.items()),
+            key=lambda t: -t['wait'])
+
+    @property
+    def basic(self):
+        return {
+            'name': self.name,
+            'wait': self.wait.basic,
+            'hold': self.hold.basic,
+            'holders': self._totals(self.holders),
+            'keys': self._totals(self.keys),
+            }
+
+
+class LockMonitor(object):
+    """
+    Statistics of the instrumented locks. Nothing is recorded unless
+    ``enabled``.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.since = time.time()
+        self._stats = {}
+        self._lock = threading.Lock()
+        # The locks held by each thread
+        self._local = threading.local()
+
+    def __repr__(self):
+        return 'Lock monitor ({})'.format(
+            'enabled' if self.enabled else 'disabled')
+
+    def _held(self):
+        try:
+            return self._local.held
+        except AttributeError:
+            self._local.held = {}
+            return self._local.held
+
+    @staticmethod
+    def holder():
+        """
+        Return the endpoint of the current request, or the name of the
+        current thread outside of requests.
+        """
+        if has_request_context():
+            return request.endpoint or request.path
+        return threading.current_thread().name
+
+    def acquired(self, token, name, wait, key=None):
+        """
+        Record that the current thread acquired the lock identified by
+        ``token`` after waiting ``wait`` seconds. Reentrant acquisitions
+        are counted once.
+        """
+        if not self.enabled:
+            return
+        held = self._held()
+        if token in held:
+            held[token][3] += 1
+        else:
+            held[token] = [name, key, wait, 1, time.time()]
+
+    def released(self, token):
+        """
+        Record that the current thread is about to release the lock
+        identified by ``token``.
+        """
+        held = self._held()
+        entry = held.get(token)
+        if entry is None:
+            # Acquired while disabled
+            return
+        entry[3] -= 1
+        if entry[3]:
+            return
+        del held[token]
+        name, key, wait, depth, start = entry
+        hold = time.time() - start
+        holder = self.holder()
+        with self._lock:
+            try:
+                stats = self._stats[name]
+            except KeyError:
+                stats = self._stats[name] = LockStats(name)
+            stats.record(wait, hold, holder, key)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.since = time.time()
+
+    @property
+    def basic(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'since': self.since,
+                'locks': [self._stats[name].basic
+                          for name in sorted(self._stats)],
+                }
+
+
+lock_monitor = LockMonitor()
+
+
+class InstrumentedLock(object):
+    """
+    Wrapper of a lock (or reentrant lock) which records its wait and hold
+    times in :data:`lock_monitor`.
+    """
+    def __init__(self, lock, name, key=None):
+        self._lock = lock
+        self.name = name
+        self.key = key
+
+    def __repr__(self):
+        return 'Instrumented lock {}'.format(self.name)
+
+    def acquire(self, blocking=True):
+        t = time.time()
+        if not self._lock.acquire(blocking):
+            return False
+        lock_monitor.acquired(
+            id(self._lock), self.name, time.time() - t, self.key)
+        return True
+
+    def release(self):
+        lock_monitor.released(id(self._lock))
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class RWLock(object):
+    """
+    Read/write lock: any number of readers or a single writer.
+
+    Writers have priority: new readers wait while a writer is waiting,
+    so that writers don't starve.
+    """
+    def __init__(self, name):
+        """
+        INPUT:
+
+        - ``name`` - string; the name of the lock in :data:`lock_monitor`
+        """
+        self.name = name
+        self._read_name = '{} (read)'.format(name)
+        self._write_name = '{} (write)'.format(name)
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def __repr__(self):
+        return 'RWLock {} ({} readers, {} writer, {} waiting writers)'.format(
+            self.name, self._readers, int(self._writer), self._waiting_writers)
+
+    def acquire_read(self):
+        t = time.time()
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        lock_monitor.acquired(
+            (id(self), 'read'), self._read_name, time.time() - t)
+
+    def release_read(self):
+        lock_monitor.released((id(self), 'read'))
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        t = time.time()
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+        lock_monitor.acquired(
+            (id(self), 'write'), self._write_name, time.time() - t)
+
+    def release_write(self):
+        lock_monitor.released((id(self), 'write'))
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class LockStripes(object):
+    """
+    A fixed set of reentrant locks, indexed by any hashable key.
+
+    Two keys may share a lock, which only serializes them. Since the
+    locks are reentrant, a thread may hold the locks of several keys
+    which share a lock, but see the lock ordering above.
+    """
+    def __init__(self, stripes, name):
+        """
+        INPUT:
+
+        - ``stripes`` - integer; the number of locks
+
+        - ``name`` - string; the name of the locks in :data:`lock_monitor`
+        """
+        self.name = name
+        self._locks = [threading.RLock() for i in range(stripes)]
+
+    def __repr__(self):
+        return '{} lock stripes {}'.format(len(self._locks), self.name)
+
+    def __len__(self):
+        return len(self._locks)
+
+    def __getitem__(self, key):
+        return InstrumentedLock(
+            self._locks[hash(key) % len(self._locks)], self.name, key)
+
+
+worksheet_locks = LockStripes(CFG.WORKSHEET_LOCK_STRIPES, 'worksheet_locks')
+users_lock = RWLock('users_lock')
+conf_lock = RWLock('conf_lock')
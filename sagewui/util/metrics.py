@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*
+"""
+Metrics of the notebook server.
+
+A :class:`Registry` of counters, gauges and histograms, rendered in the
+Prometheus text exposition format by the ``/metrics`` admin page. The
+metrics of the server are defined here, and updated where the measured
+events happen. Gauges may be computed by a function when they are
+rendered, which is set when the notebook is known (see ``create_app``).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+from builtins import str
+
+import threading
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    typ = None
+
+    def __init__(self, name, help, labels=()):
+        """
+        INPUT:
+
+        - ``name`` - string; the name of the metric
+
+        - ``help`` - string; its description
+
+        - ``labels`` - tuple of strings; the names of its labels
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # label values -> value
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '{} {}'.format(self.typ, self.name)
+
+    def _key(self, labels):
+        try:
+            return tuple(str(labels[label]) for label in self.labels)
+        except KeyError as e:
+            raise ValueError('Missing label {} of {}'.format(e, self.name))
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(name, _escape(value)) for name, value in pairs))
+
+    def samples(self):
+        """
+        Yield the triples ``(suffix, labels, value)`` of the metric, where
+        ``labels`` is the formatted label set.
+        """
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values):
+            yield '', self._format_labels(key), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.typ)]
+        lines.extend(
+            '{}{}{} {}'.format(self.name, suffix, labels, _format_value(v))
+            for suffix, labels, v in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    typ = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    typ = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        """
+        See :class:`Metric`. If ``function`` is given, it is called when
+        the gauge is rendered. It returns the value (or None if there is
+        none) or, if the gauge has labels, a dict which maps the tuples of
+        label values to values.
+        """
+        Metric.__init__(self, name, help, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.function is None:
+            for sample in Metric.samples(self):
+                yield sample
+            return
+        values = self.function()
+        if values is None:
+            return
+        if not self.labels:
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            yield '', self._format_labels(key), value
+
+
+class Histogram(Metric):
+    typ = 'histogram'
+    # Bounds of the buckets, in seconds
+    bounds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labels=(), bounds=None):
+        Metric.__init__(self, name, help, labels)
+        if bounds is not None:
+            self.bounds = tuple(bounds)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        with self._lock:
+            try:
+                counts, total = self._values[key]
+            except KeyError:
+                counts, total = [0] * (len(self.bounds) + 1), 0
+            counts[i] += 1
+            self._values[key] = counts, total + value
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(counts), total))
+                      for key, (counts, total) in self._values.items()]
+        for key, (counts, total) in sorted(values):
+            cumulative = 0
+            for bound, count in zip(
+                    self.bounds + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', self._format_labels(
+                    key, [('le', _format_value(float(bound)))]), cumulative
+            yield '_sum', self._format_labels(key), total
+            yield '_count', self._format_labels(key), cumulative
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def __repr__(self):
+        return 'Registry of {} metrics'.format(len(self._metrics))
+
+    def __iter__(self):
+        return iter(self._metrics)
+
+    def _register(self, metric):
+        if any(m.name == metric.name for m in self._metrics):
+            raise ValueError('Duplicated metric {}'.format(metric.name))
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwds):
+        return self._register(Counter(*args, **kwds))
+
+    def gauge(self, *args, **kwds):
+        return self._register(Gauge(*args, **kwds))
+
+    def histogram(self, *args, **kwds):
+        return self._register(Histogram(*args, **kwds))
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text format.
+        """
+        return ''.join(m.render() + '\n' for m in self._metrics)
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    'sagewui_requests_total', 'Handled HTTP requests',
+    ('endpoint', 'method', 'status'))
+request_duration = registry.histogram(
+    'sagewui_request_duration_seconds',
+    'Time to handle HTTP requests (until the response starts)',
+    ('endpoint',))
+worksheets_loaded = registry.gauge(
+    'sagewui_worksheets_loaded', 'Worksheets loaded in memory')
+kernels = registry.gauge(
+    'sagewui_kernels', 'Worksheet compute processes by state', ('state',))
+queued_cells = registry.gauge(
+    'sagewui_queued_cells', 'Cells waiting for evaluation or being '
+    'evaluated')
+save_duration = registry.histogram(
+    'sagewui_save_duration_seconds', 'Duration of the notebook saves')
+kernel_spawn_duration = registry.histogram(
+    'sagewui_kernel_spawn_seconds',
+    'Time to start a worksheet compute process')
+storage_read = registry.counter(
+    'sagewui_storage_read_bytes_total',
+    'Bytes of notebook records read from the datastore')
+storage_written = registry.counter(
+    'sagewui_storage_written_bytes_total',
+    'Bytes of notebook records written to the datastore')
@@ -24,4 +24,25 @@ def extended_wst_basic(wst, nb):
             "%B %d, %Y %I:%M %p",
             nb.filename_wst(wst.published_filename).date_edited)
     return d
+
+
+def pub_entry_basic(entry):
+    """
+    The fields of :func:`extended_wst_basic` used by the listing of
+    published worksheets, for an entry of the catalog.
+    """
+    return {
+        'id_number': entry.id_number,
+        'name': entry.name,
+        'owner': entry.owner,
+        'collaborators': [],
+        'publisher': entry.publisher,
+        'published_id_number': entry.id_number,
+        'worksheet_that_was_published': entry.worksheet_that_was_published,
+        'last_change': list(entry.last_change),
+        'last_change_pretty': prettify_time_ago(entry.time_since_last_edited),
+        'filename': entry.filename,
+        'running': False,
+        'rating': entry.rating(),
+        }
 # New UI end
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*
+"""
+Resource usage of the worksheet processes.
+
+The usage is read from ``/proc``, so it is only available on Linux. A
+worksheet process is the leader of its process group (it runs in its
+own pseudo terminal), so the usage of a worksheet process is the sum of
+the usage of the processes of its group, which includes the
+subprocesses started by the worksheet code.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+from builtins import str
+
+import os
+import threading
+import time
+
+PROC = '/proc'
+
+
+def _sysconf(name, default):
+    try:
+        return os.sysconf(name)
+    except (AttributeError, ValueError, OSError):
+        return default
+
+
+CLOCK_TICKS = _sysconf('SC_CLK_TCK', 100)
+PAGE_SIZE = _sysconf('SC_PAGE_SIZE', 4096)
+
+
+def _stat_fields(pid):
+    # The command name may contain spaces and parentheses, the fields
+    # after it are: state ppid pgrp ... utime stime ... rss
+    with open(os.path.join(PROC, str(pid), 'stat'), 'rb') as f:
+        stat = f.read().decode('utf-8', 'replace')
+    return stat[stat.rfind(')') + 2:].split()
+
+
+def process_state(pid):
+    """
+    Return the state of the process ``pid`` (``'R'`` running, ``'S'``
+    sleeping, ``'T'`` stopped, ``'Z'`` zombie...), or None if it doesn't
+    exist or ``/proc`` is not available.
+    """
+    try:
+        return _stat_fields(pid)[0]
+    except (IOError, OSError, IndexError):
+        return None
+
+
+def process_group_usage():
+    """
+    Return a dict which maps the process groups to their usage, a dict
+    with the keys ``rss`` (resident memory in bytes), ``cpu_time`` (user
+    and system time in seconds) and ``processes``.
+
+    Return an empty dict if ``/proc`` is not available.
+    """
+    usage = {}
+    try:
+        pids = [pid for pid in os.listdir(PROC) if pid.isdigit()]
+    except OSError:
+        return usage
+    for pid in pids:
+        try:
+            fields = _stat_fields(pid)
+        except (IOError, OSError):
+            # the process has exited
+            continue
+        try:
+            pgrp = int(fields[2])
+            cpu_time = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            rss = int(fields[21]) * PAGE_SIZE
+        except (IndexError, ValueError):
+            continue
+        u = usage.setdefault(pgrp, {'rss': 0, 'cpu_time': 0, 'processes': 0})
+        u['rss'] += rss
+        u['cpu_time'] += cpu_time
+        u['processes'] += 1
+    return usage
+
+
+class CpuSampler(object):
+    """
+    CPU usage of process groups between two samples.
+    """
+    def __init__(self):
+        # process group -> (time, cpu time) of the last sample
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'CPU sampler of {} process groups'.format(len(self._samples))
+
+    def sample(self, usage):
+        """
+        Add the key ``cpu_percent`` to the values of ``usage`` (see
+        :func:`process_group_usage`), the CPU usage since the previous
+        sample of the process group, or None on its first sample. The
+        process groups not in ``usage`` are forgotten.
+        """
+        now = time.time()
+        with self._lock:
+            previous = self._samples
+            self._samples = {}
+            for pgrp, u in usage.items():
+                self._samples[pgrp] = now, u['cpu_time']
+                try:
+                    t, cpu_time = previous[pgrp]
+                except KeyError:
+                    u['cpu_percent'] = None
+                    continue
+                u['cpu_percent'] = (
+                    100 * (u['cpu_time'] - cpu_time) / (now - t)
+                    if now > t else None)
+        return usage
+
+
+cpu_sampler = CpuSampler()
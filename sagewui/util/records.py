@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*
+"""
+Record storage helpers.
+
+Per cell storage of worksheet bodies.
+
+The body of a worksheet is usually stored as a single ``worksheet.html``
+file, which has to be rewritten entirely on each save. With this layout
+each cell is stored as an individual record, so saving a worksheet only
+writes the cells that changed::
+
+    id_number/
+        body/
+            order.json      -- list of the cell ids, in worksheet order
+            0.txt           -- edit text of the cell with id 0
+            1.txt
+            ...
+
+The records hold the same text as ``worksheet.html`` (the ``edit_text``
+of each cell), so the whole body is rebuilt by joining them in order.
+
+Append-only logs.
+
+A :class:`RecordLog` is a file of text records, each one framed by its
+length before and after it::
+
+    <length: 4 bytes, big endian> <utf-8 text> <length: 4 bytes, big endian>
+
+New records are appended without reading or rewriting the file, and
+the trailing lengths allow reading the last records from the end of the
+file, without reading the older ones.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import str
+from builtins import object
+from builtins import open
+
+import json
+import os
+import shutil
+import struct
+
+from . import atomic_write
+from . import makedirs
+from . import securepath
+from .metrics import storage_read
+from .metrics import storage_written
+
+
+class CellRecords(object):
+    dirname = 'body'
+    order_filename = 'order.json'
+
+    def __init__(self, directory):
+        """
+        INPUT:
+
+        - ``directory`` - string; the directory of the worksheet
+        """
+        self.path = os.path.join(directory, self.dirname)
+
+    def __repr__(self):
+        return 'Cell records at %s' % self.path
+
+    def _filename(self, id):
+        return os.path.join(self.path, '{}.txt'.format(securepath(str(id))))
+
+    @property
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, self.order_filename))
+
+    @property
+    def order(self):
+        """
+        Return the list of cell ids of the stored worksheet.
+        """
+        with open(os.path.join(self.path, self.order_filename), 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+
+    def load(self):
+        """
+        Return the stored records as a list of (id, edit text) pairs, in
+        worksheet order.
+        """
+        records = []
+        for id in self.order:
+            try:
+                with open(self._filename(id), 'rb') as f:
+                    data = f.read()
+            except IOError:
+                data = b''
+            storage_read.inc(len(data))
+            records.append((id, data.decode('utf-8')))
+        return records
+
+    @staticmethod
+    def body(records):
+        """
+        Return the worksheet body, as in ``worksheet.html``, of a list of
+        records.
+        """
+        return '\n\n'.join(text for id, text in records if text)
+
+    def save(self, cells, saved=None):
+        """
+        Store the given cells, writing only the records of the cells which
+        changed since the last save.
+
+        INPUT:
+
+        - ``cells`` - list of cells, in worksheet order
+
+        - ``saved`` - None or the output of the previous call of this
+          method (or of :meth:`saved_state`). If None, every record is
+          written.
+
+        OUTPUT:
+
+        - a pair (ids, states), that describes what is stored on disk and
+          must be given back in the next call as ``saved``.
+        """
+        if saved is None:
+            order, states = (self.order if self.exists else []), {}
+        else:
+            order, states = saved
+        makedirs(self.path)
+
+        ids = []
+        new_states = {}
+        for C in cells:
+            state = C.edit_state
+            if states.get(C.id) != state:
+                with atomic_write(self._filename(C.id)) as f:
+                    f.write(C.edit_text.strip().encode('utf-8'))
+            ids.append(C.id)
+            new_states[C.id] = state
+
+        if ids != order:
+            with atomic_write(
+                    os.path.join(self.path, self.order_filename)) as f:
+                f.write(json.dumps(ids).encode('utf-8'))
+            for id in set(order) - set(ids):
+                try:
+                    os.unlink(self._filename(id))
+                except OSError:
+                    pass
+        return ids, new_states
+
+    @staticmethod
+    def saved_state(records, cells):
+        """
+        Return the ``saved`` argument of :meth:`save` for cells just built
+        from the given records.
+
+        Text cell ids are not part of the edit text and the cells may be
+        altered while they are built, so only the cells whose record has the
+        same id and the same text count as saved.
+        """
+        texts = dict(records)
+        states = dict((C.id, C.edit_state) for C in cells
+                      if texts.get(C.id) == C.edit_text.strip())
+        return [id for id, text in records], states
+
+    def delete(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class RecordLog(object):
+    frame = struct.Struct('>I')
+
+    def __init__(self, filename):
+        """
+        INPUT:
+
+        - ``filename`` - string; the path of the log file
+        """
+        self.filename = filename
+
+    def __repr__(self):
+        return 'Record log at %s' % self.filename
+
+    @property
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def _encode(self, records):
+        chunks = []
+        for record in records:
+            data = record.encode('utf-8')
+            size = self.frame.pack(len(data))
+            chunks.extend((size, data, size))
+        return b''.join(chunks)
+
+    def check(self):
+        """
+        Return the number of records of the log, dropping a trailing
+        malformed record, e.g., one truncated by a crash while appending.
+
+        Only the record lengths are read.
+        """
+        n = 0
+        fs = self.frame.size
+        try:
+            with open(self.filename, 'r+b') as f:
+                end = f.seek(0, os.SEEK_END)
+                pos = 0
+                while pos + 2 * fs <= end:
+                    f.seek(pos)
+                    size, = self.frame.unpack(f.read(fs))
+                    last = pos + size + fs
+                    if last + fs > end:
+                        break
+                    f.seek(last)
+                    if self.frame.unpack(f.read(fs))[0] != size:
+                        break
+                    pos = last + fs
+                    n += 1
+                if pos < end:
+                    f.truncate(pos)
+        except IOError:
+            pass
+        return n
+
+    def append(self, records):
+        """
+        Append the given list of strings to the log.
+        """
+        if records:
+            data = self._encode(records)
+            with open(self.filename, 'ab') as f:
+                f.write(data)
+            storage_written.inc(len(data))
+
+    def tail(self, n=None):
+        """
+        Return the list of the last ``n`` records (or of all the records if
+        ``n`` is None), oldest first.
+
+        Reading starts at the end of the file. It stops at the first
+        malformed record, see :meth:`check`.
+        """
+        records = []
+        try:
+            with open(self.filename, 'rb') as f:
+                pos = f.seek(0, os.SEEK_END)
+                fs = self.frame.size
+                while pos >= 2 * fs and (n is None or len(records) < n):
+                    f.seek(pos - fs)
+                    size, = self.frame.unpack(f.read(fs))
+                    start = pos - size - 2 * fs
+                    if start < 0:
+                        break
+                    f.seek(start)
+                    chunk = f.read(size + fs)
+                    if self.frame.unpack(chunk[:fs])[0] != size:
+                        break
+                    records.append(chunk[fs:].decode('utf-8'))
+                    storage_read.inc(len(chunk) + fs)
+                    pos = start
+        except IOError:
+            pass
+        records.reverse()
+        return records
+
+    def rewrite(self, records):
+        """
+        Replace the content of the log by the given list of strings.
+        """
+        with atomic_write(self.filename) as f:
+            f.write(self._encode(records))
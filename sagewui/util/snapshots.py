@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*
+"""
+Delta compressed store of worksheet snapshots.
+
+Each snapshot (revision) of a worksheet body is identified by a key, the
+``time.time()`` of its creation in seconds. Most snapshots only differ in
+a few cells from the previous one, so only every ``keyframe_interval``-th
+snapshot is stored as a full bz2 compressed body (a keyframe) and the
+others as a bz2 compressed line delta against the previous snapshot::
+
+    id_number/
+        snapshots/
+            index.json          -- list of the snapshots, oldest first
+            1500000000.bz2      -- keyframe
+            1500000100.delta.bz2
+            1500000200.delta.bz2
+            ...
+
+The index keeps the key, the sha1 of the body and the kind of each
+snapshot, so listing snapshots or restoring one of them needs no
+directory scan, and a snapshot identical to the previous one is not
+stored at all.
+
+Keyframes have the same format as the snapshots of older versions, which
+stored every snapshot as a keyframe. Snapshot directories without an
+index are indexed on first use.
+
+A store serializes its reads and writes of the index, and keeps the body
+of the last snapshot, against which the next one is compared and
+delta compressed.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+from builtins import open
+
+import bz2
+import difflib
+import hashlib
+import json
+import os
+import threading
+
+from . import atomic_write
+
+
+def digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def make_delta(old, new):
+    """
+    Return a line delta which transforms the text ``old`` into ``new``.
+
+    The delta is a list whose items are either a pair ``[i, j]``, meaning
+    the lines ``i`` to ``j`` of ``old``, or a string to be inserted.
+    """
+    a = old.splitlines(True)
+    b = new.splitlines(True)
+    delta = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(
+            None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            delta.append([i1, i2])
+        elif j1 < j2:
+            delta.append(''.join(b[j1:j2]))
+    return delta
+
+
+def apply_delta(old, delta):
+    """
+    Return the text obtained applying ``delta`` (see :func:`make_delta`)
+    to the text ``old``.
+    """
+    a = old.splitlines(True)
+    return ''.join(
+        ''.join(a[op[0]:op[1]]) if isinstance(op, list) else op
+        for op in delta)
+
+
+class SnapshotStore(object):
+    index_filename = 'index.json'
+    keyframe_interval = 10
+
+    def __init__(self, directory):
+        """
+        INPUT:
+
+        - ``directory`` - string; the snapshot directory of the worksheet
+        """
+        self.path = directory
+        self.__index = None
+        # Body of the last snapshot, or None if not read yet
+        self.__last_body = None
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return 'Snapshot store at %s' % self.path
+
+    def _filename(self, key, keyframe=True):
+        return os.path.join(
+            self.path, '{}.{}'.format(key, 'bz2' if keyframe else 'delta.bz2'))
+
+    # Index
+
+    @property
+    def index(self):
+        """
+        Return the list of snapshot entries, oldest first. Each entry is a
+        dict with the ``key``, the ``sha1`` of the body and whether the
+        snapshot is a ``keyframe``.
+        """
+        with self._lock:
+            if self.__index is None:
+                try:
+                    with open(os.path.join(self.path, self.index_filename),
+                              'rb') as f:
+                        self.__index = json.loads(f.read().decode('utf-8'))
+                except IOError:
+                    self.__index = self._legacy_index()
+                    if self.__index:
+                        self._save_index()
+            return self.__index
+
+    def _legacy_index(self):
+        try:
+            filenames = os.listdir(self.path)
+        except OSError:
+            return []
+        keys = sorted(
+            (fn[:-4] for fn in filenames
+             if fn.endswith('.bz2') and not fn.endswith('.delta.bz2')),
+            key=float)
+        return [{'key': key, 'sha1': None, 'keyframe': True}
+                for key in keys]
+
+    def _save_index(self):
+        with atomic_write(os.path.join(self.path, self.index_filename)) as f:
+            f.write(json.dumps(self.__index).encode('utf-8'))
+
+    @property
+    def keys(self):
+        """
+        Return the list of snapshot keys, oldest first.
+        """
+        return [entry['key'] for entry in self.index]
+
+    def _position(self, key):
+        for i, entry in enumerate(self.index):
+            if entry['key'] == key:
+                return i
+        raise KeyError(key)
+
+    # Reading
+
+    def _read(self, key, keyframe=True):
+        with open(self._filename(key, keyframe), 'rb') as f:
+            data = bz2.decompress(f.read()).decode('utf-8')
+        return data if keyframe else json.loads(data)
+
+    def _body_at(self, i):
+        index = self.index
+        start = i
+        while not index[start]['keyframe']:
+            start -= 1
+        text = self._read(index[start]['key'])
+        for entry in index[start + 1:i + 1]:
+            text = apply_delta(text, self._read(entry['key'], False))
+        return text
+
+    def body(self, key):
+        """
+        Return the worksheet body of the snapshot with the given key.
+        """
+        with self._lock:
+            return self._body_at(self._position(key))
+
+    def _last_body(self):
+        if self.__last_body is None:
+            self.__last_body = self._body_at(len(self.index) - 1)
+        return self.__last_body
+
+    # Writing
+
+    def add(self, key, text):
+        """
+        Store ``text`` as a new snapshot with the given key.
+
+        OUTPUT:
+
+        - the key of the stored snapshot, which is later than every stored
+          key, or None if ``text`` is identical to the last snapshot.
+        """
+        sha1 = digest(text)
+        with self._lock:
+            index = self.index
+            last = index[-1] if index else None
+            if last is not None:
+                if last['sha1'] is None:
+                    last['sha1'] = digest(self._last_body())
+                if last['sha1'] == sha1:
+                    return None
+                if float(key) <= float(last['key']):
+                    key = '{:.0f}'.format(float(last['key']) + 1)
+
+            recent = index[max(0, len(index) - self.keyframe_interval + 1):]
+            keyframe = not any(entry['keyframe'] for entry in recent)
+            if keyframe:
+                data = text
+            else:
+                data = json.dumps(make_delta(self._last_body(), text))
+            with atomic_write(self._filename(key, keyframe)) as f:
+                f.write(bz2.compress(data.encode('utf-8')))
+            index.append({'key': key, 'sha1': sha1, 'keyframe': keyframe})
+            self._save_index()
+            self.__last_body = text
+            return key
+
+    def remove(self, keys):
+        """
+        Remove the snapshots with the given keys. The remaining snapshots
+        which were stored as deltas against a removed one are stored again
+        as keyframes.
+        """
+        keys = set(keys)
+        with self._lock:
+            index = self.index
+            rewrite = {}
+            for i, entry in enumerate(index):
+                if (i > 0 and entry['key'] not in keys and
+                        not entry['keyframe'] and index[i - 1]['key'] in keys):
+                    rewrite[entry['key']] = self._body_at(i)
+
+            for key, text in rewrite.items():
+                with atomic_write(self._filename(key)) as f:
+                    f.write(bz2.compress(text.encode('utf-8')))
+            removed = [entry for entry in index if entry['key'] in keys]
+            self.__index = [
+                entry for entry in index if entry['key'] not in keys]
+            if index and index[-1]['key'] in keys:
+                self.__last_body = None
+            for entry in self.__index:
+                if entry['key'] in rewrite:
+                    entry['keyframe'] = True
+            self._save_index()
+
+            obsolete = [self._filename(entry['key'], entry['keyframe'])
+                        for entry in removed]
+            obsolete.extend(self._filename(key, False) for key in rewrite)
+            for filename in obsolete:
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*
+"""
+Tracing of the evaluation of cells.
+
+The evaluation of a compute cell goes through these phases, each of
+which is marked with its time in a :class:`CellTrace`:
+
+- ``request`` - the ``eval`` request is received (``worksheet_eval``)
+- ``evaluate`` - the cell is evaluated (``ComputeCell.evaluate``)
+- ``enqueue`` - the cell is queued (``Worksheet.enqueue``)
+- ``start`` - the cell leaves the queue (``Worksheet.start_next_comp``)
+- ``send`` - its code has been sent to the compute process
+- ``output`` - its first output is seen (``Worksheet.check_comp``)
+- ``computed`` - the compute process is done with it
+- ``files`` - its output files have been moved to the cell directory
+- ``delivered`` - the response with the result is built
+  (``worksheet_cell_update``)
+
+The time between two phases is a span (see :data:`SPANS`). The finished
+traces are kept in a ring buffer of :data:`cell_tracer`, whose size is
+the ``cell_traces`` server option (0 disables the tracing), and shown,
+for all the worksheets or for one of them, in the ``/cell_traces`` admin
+page.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+
+import threading
+import time
+from collections import deque
+from collections import OrderedDict
+
+from flask import g
+from flask import has_request_context
+
+
+PHASES = ('request', 'evaluate', 'enqueue', 'start', 'send', 'output',
+          'computed', 'files', 'delivered')
+
+# (span, start phase, end phase). A start phase of None is the first
+# marked phase.
+SPANS = (
+    ('handling', None, 'enqueue'),
+    ('queue', 'enqueue', 'start'),
+    ('send', 'start', 'send'),
+    ('first_output', 'send', 'output'),
+    ('execution', 'send', 'computed'),
+    ('files', 'computed', 'files'),
+    ('delivery', 'files', 'delivered'),
+    ('total', None, 'delivered'),
+    )
+
+
+class CellTrace(object):
+    def __init__(self, worksheet, cell_id, username=None, start=None):
+        """
+        INPUT:
+
+        - ``worksheet`` - string; the filename of the worksheet
+
+        - ``cell_id`` - the id of the cell
+
+        - ``username`` - string (default: None); who evaluates the cell
+
+        - ``start`` - float (default: now); the time of the ``request``
+          phase
+        """
+        self.worksheet = worksheet
+        self.cell_id = cell_id
+        self.username = username
+        self.status = 'active'
+        # phase -> time
+        self.marks = {}
+        if start is not None:
+            self.marks['request'] = start
+
+    def __repr__(self):
+        return 'Trace of cell {} of {} ({})'.format(
+            self.cell_id, self.worksheet, self.status)
+
+    @property
+    def start(self):
+        return min(self.marks.values())
+
+    def mark(self, phase, t=None):
+        """
+        Mark the time of ``phase``. Only the first time is kept.
+        """
+        if phase not in self.marks:
+            self.marks[phase] = time.time() if t is None else t
+
+    @property
+    def spans(self):
+        """
+        Dict of the durations of the spans whose phases are marked.
+        """
+        spans = {}
+        start = self.start
+        for name, begin, end in SPANS:
+            if end in self.marks and (begin is None or begin in self.marks):
+                spans[name] = self.marks[end] - (
+                    start if begin is None else self.marks[begin])
+        return spans
+
+    @property
+    def basic(self):
+        return {
+            'worksheet': self.worksheet,
+            'cell_id': self.cell_id,
+            'username': self.username,
+            'status': self.status,
+            'start': self.start,
+            'spans': self.spans,
+            }
+
+
+def _summary(values):
+    values = sorted(values)
+    n = len(values)
+    return {
+        'count': n,
+        'mean': sum(values) / n,
+        'p50': values[(n - 1) // 2],
+        'p95': values[int(0.95 * (n - 1))],
+        'max': values[-1],
+        }
+
+
+class CellTracer(object):
+    """
+    Traces of the cells being evaluated, and ring buffer of the last
+    finished ones.
+    """
+    def __init__(self, size=0):
+        self._lock = threading.Lock()
+        self.resize(size)
+
+    def __repr__(self):
+        return 'Cell tracer ({} traces)'.format(self.size)
+
+    def resize(self, size):
+        """
+        Keep the last ``size`` traces. Drop them all if ``size`` changes.
+        """
+        with self._lock:
+            if getattr(self, 'size', None) == size:
+                return
+            self.size = max(0, size)
+            self.since = time.time()
+            self._traces = deque(maxlen=self.size)
+            # (worksheet, cell id) -> trace of the cells being evaluated
+            self._active = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    @staticmethod
+    def _key(cell):
+        return cell.worksheet().filename, cell.id
+
+    def start(self, cell, username=None):
+        """
+        Start the trace of ``cell``, replacing any unfinished one. The
+        ``request`` phase is the start of the current request.
+        """
+        if not self.enabled:
+            return
+        start = None
+        if has_request_context():
+            start = g.get('request_start')
+        key = self._key(cell)
+        trace = CellTrace(key[0], key[1], username, start)
+        trace.mark('evaluate')
+        with self._lock:
+            self._active.pop(key, None)
+            self._active[key] = trace
+            # Cells whose result is never fetched are forgotten
+            while len(self._active) > self.size:
+                self._active.popitem(last=False)
+
+    def mark(self, cell, phase):
+        """
+        Mark ``phase`` in the trace of ``cell``, if it is traced.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            trace = self._active.get(self._key(cell))
+            if trace is not None:
+                trace.mark(phase)
+
+    def finish(self, cell, status='done'):
+        """
+        Finish the trace of ``cell``, marking the ``delivered`` phase if
+        it is done.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            trace = self._active.pop(self._key(cell), None)
+            if trace is None:
+                return
+            if status == 'done':
+                trace.mark('delivered')
+            trace.status = status
+            self._traces.append(trace)
+
+    def reset(self):
+        with self._lock:
+            self._traces.clear()
+            self.since = time.time()
+
+    def traces(self, worksheet=None):
+        """
+        Return the finished traces (of ``worksheet`` if given), the most
+        recent first.
+        """
+        with self._lock:
+            traces = list(self._traces)
+        return [t for t in reversed(traces)
+                if worksheet is None or t.worksheet == worksheet]
+
+    def basic(self, worksheet=None, recent=100):
+        """
+        Return the statistics of the spans of the traces of ``worksheet``
+        (of all the worksheets by default), the totals by worksheet and
+        the ``recent`` last traces.
+        """
+        traces = self.traces(worksheet)
+        spans = {}
+        totals = {}
+        for trace in traces:
+            trace_spans = trace.spans
+            for name, value in trace_spans.items():
+                spans.setdefault(name, []).append(value)
+            if 'total' in trace_spans:
+                totals.setdefault(trace.worksheet, []).append(
+                    trace_spans['total'])
+        worksheets = []
+        for name, values in totals.items():
+            summary = _summary(values)
+            summary['name'] = name
+            worksheets.append(summary)
+        worksheets.sort(key=lambda s: -s['mean'] * s['count'])
+        return {
+            'enabled': self.enabled,
+            'size': self.size,
+            'since': self.since,
+            'worksheet': worksheet,
+            'spans': [dict(_summary(spans[name]), name=name)
+                      for name, _, _ in SPANS if name in spans],
+            'worksheets': worksheets,
+            'traces': [t.basic for t in traces[:recent]],
+            }
+
+
+cell_tracer = CellTracer()
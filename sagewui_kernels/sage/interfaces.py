@@ -111,6 +111,32 @@ class SageServerABC(object):
         """
         raise NotImplementedError
 
+    def is_alive(self):
+        """
+        Return True if this worksheet subprocess has been started and has
+        not exited.
+
+        OUTPUT:
+
+            - ``bool``
+        """
+        raise NotImplementedError
+
+    @property
+    def pid(self):
+        """
+        Return the id of the process (on the server host) of this worksheet
+        process, or None if it is not running.
+        """
+        raise NotImplementedError
+
+    @property
+    def host(self):
+        """
+        Return the host on which this worksheet process runs.
+        """
+        return 'localhost'
+
     def execute(self, string, data=None):
         """
         Start executing the given string in this subprocess.
@@ -329,6 +355,17 @@ class SageServerExpect(SageServerABC):
         """
         return self._is_started
 
+    def is_alive(self):
+        # isalive() also reaps the subprocess if it has exited
+        try:
+            return self._expect is not None and self._expect.isalive()
+        except Exception:
+            return False
+
+    @property
+    def pid(self):
+        return None if self._expect is None else self._expect.pid
+
     def get_tmpdir(self):
         """
         Return two strings (local, remote), where local is the name
@@ -515,6 +552,10 @@ class SageServerExpectRemote(SageServerExpect):
 
         SageServerExpect.__init__(self, **kwargs)
 
+    @property
+    def host(self):
+        return self._user_at_host
+
     def command(self):
         return 'ssh -t {} "{}"'.format(
             self._user_at_host, SageServerExpect.command(self))
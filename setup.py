@@ -37,6 +37,7 @@ install_requires = [
     'flask-babel',
     'flask-themes2',
     'future',
+    'futures; python_version<"3"',  # concurrent.futures backport
     # 'smtpsend',
     'pexpect',
     'docutils',
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*
+"""
+Fixtures shared by the tests.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import pytest
+
+from sagewui import config as CFG
+from sagewui.app import create_app
+from sagewui.gui.notebook import Notebook
+
+
+@pytest.fixture(autouse=True)
+def sage_conf(monkeypatch):
+    # The configuration read from sage by config.add_sage_conf, with the
+    # values of sagewui_kernels/sage/sage_code/interact.py
+    for name, value in (
+            ('INTERACT_UPDATE_PREFIX', '%__sage_interact__'),
+            ('INTERACT_RESTART', '__SAGE_INTERACT_RESTART__'),
+            ('INTERACT_START', '<?__SAGE__START>'),
+            ('INTERACT_TEXT', '<?__SAGE__TEXT>'),
+            ('INTERACT_HTML', '<?__SAGE__HTML>'),
+            ('INTERACT_END', '<?__SAGE__END>')):
+        monkeypatch.setattr(CFG, name, value)
+
+
+@pytest.fixture
+def notebook(tmpdir, monkeypatch):
+    notebook = Notebook(str(tmpdir.join('nb.sagenb')))
+    monkeypatch.setattr(CFG, 'notebook', notebook)
+    notebook.user_manager.create_default_users('passpass')
+    return notebook
+
+
+@pytest.fixture
+def client(notebook):
+    """
+    A test client of the notebook server, logged in as the admin.
+    """
+    client = create_app(notebook).test_client()
+    with client.session_transaction() as session:
+        session['username'] = CFG.UN_ADMIN
+    return client
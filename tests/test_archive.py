@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*
+"""
+Streamed tar and zip archives, and the export and import of worksheets.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import open
+
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from sagewui.storage.filesystem_storage import FilesystemDatastore
+from sagewui.util.archive import TarStream
+from sagewui.util.archive import ZipStream
+from sagewui.util.archive import compressors
+
+BODY = '<p>été</p>\n\n{{{id=0|\n1+1\n///\n2\n}}}'
+
+
+def write(path, data):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def files(tmpdir):
+    files = {}
+    for name, size in (('empty', 0), ('small', 10), ('large', 300000)):
+        path = str(tmpdir.join(name))
+        write(path, os.urandom(size))
+        files[name] = path
+    return files
+
+
+@pytest.mark.parametrize('compression', sorted(compressors))
+def test_tar_stream(files, compression):
+    T = TarStream(compression)
+    members = [T.add_bytes('top/bytes.txt', 'été'.encode('utf-8'))]
+    members.extend(T.add(path, 'top/files/' + name)
+                   for name, path in sorted(files.items()))
+    members.append(T.close())
+    data = b''.join(chunk for member in members for chunk in member)
+
+    for mode in ('r:*', 'r|*'):
+        with tarfile.open(fileobj=io.BytesIO(data), mode=mode) as tar:
+            contents = dict((m.name, tar.extractfile(m).read())
+                            for m in tar if m.isfile())
+        assert contents.pop('top/bytes.txt') == 'été'.encode('utf-8')
+        assert contents == dict(('top/files/' + name, read(path))
+                                for name, path in files.items())
+
+
+def test_tar_stream_hard_links(tmpdir, files):
+    # Files which share an inode are archived as regular files
+    link = str(tmpdir.join('link'))
+    os.link(files['small'], link)
+    T = TarStream('gz')
+    members = [T.add(files['small'], 'a'), T.add(link, 'b'), T.close()]
+    data = b''.join(chunk for member in members for chunk in member)
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert all(m.isfile() for m in tar)
+        assert tar.extractfile('b').read() == read(files['small'])
+
+
+def test_zip_stream(files):
+    Z = ZipStream()
+    chunks = [chunk for name, path in sorted(files.items())
+              for chunk in Z.add(path, name + '.sws')]
+    chunks.extend(Z.close())
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zip_file:
+        assert zip_file.testzip() is None
+        assert sorted(zip_file.namelist()) == sorted(
+            name + '.sws' for name in files)
+        for name, path in files.items():
+            assert zip_file.read(name + '.sws') == read(path)
+
+
+def test_zip_stream_empty():
+    Z = ZipStream()
+    with zipfile.ZipFile(io.BytesIO(b''.join(Z.close()))) as zip_file:
+        assert zip_file.namelist() == []
+
+
+@pytest.fixture
+def datastore(tmpdir):
+    S = FilesystemDatastore(str(tmpdir.join('store')))
+    W = S.create_worksheet('alice', 0)
+    W.name = 'Exported'
+    W.edit_save(BODY)
+    S.save_worksheet(W)
+    path = S._abspath(S._worksheet_pathname('alice', 0))
+    write(os.path.join(path, 'data', 'été.txt'), b'data')
+    write(os.path.join(path, 'cells', '0', 'plot.png'), os.urandom(100000))
+    write(os.path.join(path, 'cells', '0', 'copy.png'), b'same')
+    write(os.path.join(path, 'cells', '1', 'copy.png'), b'same')
+    S.store_files([os.path.join(path, 'cells')])
+    return S
+
+
+def tree(path):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            filename = os.path.join(dirpath, name)
+            files[os.path.relpath(filename, path)] = read(filename)
+    return files
+
+
+@pytest.mark.parametrize('compression', sorted(compressors))
+def test_export_import_worksheet(tmpdir, datastore, compression):
+    S = datastore
+    sws = str(tmpdir.join('exported.sws'))
+    with open(sws, 'wb') as f:
+        for chunk in S.export_worksheet_stream(
+                'alice', 0, 'Title', compression):
+            f.write(chunk)
+    with tarfile.open(sws) as tar:
+        names = tar.getnames()
+    assert 'sage_worksheet/worksheet_conf.pickle' in names
+    assert 'sage_worksheet/worksheet.html' in names
+    assert 'sage_worksheet/worksheet.txt' in names
+    assert not any('snapshots' in name for name in names)
+
+    W = S.import_worksheet('bob', 7, sws)
+    assert (W.owner, W.id_number, W.name) == ('bob', 7, 'Title')
+    assert W.body == BODY
+    for dirname in ('data', 'cells'):
+        assert tree(os.path.join(S._abspath(
+            S._worksheet_pathname('bob', 7)), dirname)) == tree(
+                os.path.join(S._abspath(
+                    S._worksheet_pathname('alice', 0)), dirname))
+
+
+def test_import_unsafe_members(tmpdir, datastore):
+    sws = str(tmpdir.join('unsafe.sws'))
+    S = datastore
+    S.export_worksheet('alice', 0, sws, None)
+    with tarfile.open(sws, 'r:bz2') as tar:
+        members = [(m, tar.extractfile(m).read() if m.isfile() else None)
+                   for m in tar]
+    with tarfile.open(sws, 'w:bz2') as tar:
+        for m, data in members:
+            tar.addfile(m, io.BytesIO(data) if data is not None else None)
+        for name in ('../evil', '/tmp/evil', 'sage_worksheet/../evil',
+                     'other/data/evil'):
+            info = tarfile.TarInfo(name)
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b'evil'))
+
+    W = S.import_worksheet('bob', 1, sws)
+    assert W.name == 'Exported'
+    path = S._abspath(S._worksheet_pathname('bob', 1))
+    assert not os.path.exists(os.path.join(path, 'evil'))
+    assert not os.path.exists(os.path.join(os.path.dirname(path), 'evil'))
+    assert not os.path.exists(os.path.join(path, 'data', 'evil'))
+
+
+def test_import_old_format(tmpdir, datastore):
+    # Worksheets of old versions of Sage only have a worksheet.txt
+    sws = str(tmpdir.join('old.sws'))
+    with tarfile.open(sws, 'w:bz2') as tar:
+        data = 'Old worksheet\nsystem:gap\n{}'.format(BODY).encode('utf-8')
+        info = tarfile.TarInfo('sage_worksheet/worksheet.txt')
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+    W = datastore.import_worksheet('bob', 2, sws)
+    assert (W.name, W.system) == ('Old worksheet', 'gap')
+    assert W.body == BODY
+
+    with tarfile.open(sws, 'w:bz2'):
+        pass
+    with pytest.raises(RuntimeError):
+        datastore.import_worksheet('bob', 3, sws)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*
+"""
+Cloned files, synchronized trees and the blob store of worksheet files.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import open
+
+import hashlib
+import os
+import shutil
+
+import pytest
+
+from sagewui.storage.blobs import BlobStore
+from sagewui.storage.filesystem_storage import FilesystemDatastore
+from sagewui.util import clone_file
+from sagewui.util import sync_tree
+
+
+def write(path, data):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def tree(path):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            filename = os.path.join(dirpath, name)
+            files[os.path.relpath(filename, path)] = read(filename)
+    return files
+
+
+def same_file(a, b):
+    sa, sb = os.stat(a), os.stat(b)
+    return (sa.st_dev, sa.st_ino) == (sb.st_dev, sb.st_ino)
+
+
+@pytest.mark.parametrize('link', [True, False])
+def test_clone_file(tmpdir, link):
+    src = str(tmpdir.join('src'))
+    dst = str(tmpdir.join('dst'))
+    write(src, b'contents')
+    os.chmod(src, 0o640)
+    os.utime(src, (1000000000, 1000000000))
+    clone_file(src, dst, link)
+    assert read(dst) == b'contents'
+    assert same_file(src, dst) == link
+    st = os.stat(dst)
+    assert st.st_mode & 0o777 == 0o640
+    assert int(st.st_mtime) == 1000000000
+
+
+@pytest.fixture
+def src(tmpdir):
+    src = str(tmpdir.join('src'))
+    write(os.path.join(src, 'a'), b'a')
+    write(os.path.join(src, 'sub', 'b'), b'b')
+    write(os.path.join(src, 'sub', 'deep', 'c'), b'c')
+    os.makedirs(os.path.join(src, 'empty'))
+    return src
+
+
+@pytest.mark.parametrize('link', [True, False])
+def test_sync_tree(tmpdir, src, link):
+    dst = str(tmpdir.join('dst'))
+    assert sync_tree(src, dst, link) == 3
+    assert tree(dst) == tree(src)
+    assert os.path.isdir(os.path.join(dst, 'empty'))
+    assert same_file(os.path.join(src, 'a'), os.path.join(dst, 'a')) == link
+    # Nothing to do the second time
+    assert sync_tree(src, dst, link) == 0
+
+
+def test_sync_tree_differences(tmpdir, src):
+    dst = str(tmpdir.join('dst'))
+    shutil.copytree(src, dst)
+    # Modified, removed, added and replaced files and directories
+    os.unlink(os.path.join(src, 'a'))
+    write(os.path.join(src, 'a'), b'new a')
+    write(os.path.join(src, 'new', 'd'), b'd')
+    write(os.path.join(dst, 'extra'), b'extra')
+    write(os.path.join(dst, 'extradir', 'e'), b'e')
+    shutil.rmtree(os.path.join(dst, 'sub', 'deep'))
+    write(os.path.join(dst, 'sub', 'deep'), b'a file')
+    os.unlink(os.path.join(src, 'sub', 'b'))
+    os.makedirs(os.path.join(src, 'sub', 'b'))
+
+    assert sync_tree(src, dst) == 3
+    assert tree(dst) == tree(src)
+    assert sorted(os.listdir(dst)) == sorted(os.listdir(src))
+    assert os.path.isdir(os.path.join(dst, 'sub', 'b'))
+
+
+def test_sync_tree_keeps_unchanged_files(tmpdir, src):
+    dst = str(tmpdir.join('dst'))
+    sync_tree(src, dst, False)
+    st = os.stat(os.path.join(dst, 'a'))
+    # Same size and modification time: the file is not copied again
+    sync_tree(src, dst, False)
+    assert os.stat(os.path.join(dst, 'a')).st_ino == st.st_ino
+
+
+def test_blob_store_add(tmpdir):
+    B = BlobStore(str(tmpdir.join('blobs')))
+    a = str(tmpdir.join('a'))
+    b = str(tmpdir.join('b'))
+    c = str(tmpdir.join('c'))
+    write(a, b'same')
+    write(b, b'same')
+    write(c, b'other')
+
+    h = B.add(a)
+    assert h == hashlib.sha1(b'same').hexdigest()
+    blob = B._filename(h)
+    assert same_file(a, blob)
+    assert B.add(a) == h
+    # Identical contents share the blob
+    assert B.add(b) == h
+    assert same_file(b, blob)
+    assert os.stat(blob).st_nlink == 3
+    assert read(b) == b'same'
+    assert B.add(c) != h
+
+
+def test_blob_store_hash(tmpdir, monkeypatch):
+    B = BlobStore(str(tmpdir.join('blobs')))
+    a = str(tmpdir.join('a'))
+    b = str(tmpdir.join('b'))
+    write(a, b'data')
+    os.link(a, b)
+    h = B.hash(a)
+
+    computed = []
+    monkeypatch.setattr('sagewui.storage.blobs.file_hash',
+                        lambda path: computed.append(path))
+    # Cached by inode
+    assert B.hash(b) == h
+    assert computed == []
+    os.utime(a, (1000000000, 1000000000))
+    B.hash(b)
+    assert computed == [b]
+
+
+def test_blob_store_collect(tmpdir):
+    B = BlobStore(str(tmpdir.join('blobs')))
+    assert B.collect() == (0, 0)
+    cells = str(tmpdir.join('cells'))
+    write(os.path.join(cells, '0', 'plot.png'), b'x' * 10)
+    write(os.path.join(cells, '1', 'plot.png'), b'x' * 10)
+    write(os.path.join(cells, '1', 'full_output.txt'), b'y' * 5)
+    B.add_tree(cells)
+    assert B.collect() == (0, 0)
+
+    shutil.rmtree(os.path.join(cells, '0'))
+    assert B.collect() == (0, 0)
+    shutil.rmtree(os.path.join(cells, '1'))
+    assert B.collect() == (2, 15)
+    assert os.listdir(B.path) == []
+
+    # A collected blob is stored again
+    path = os.path.join(cells, '2', 'plot.png')
+    write(path, b'x' * 10)
+    h = B.add(path)
+    assert same_file(path, B._filename(h))
+
+
+def test_datastore_files(tmpdir):
+    S = FilesystemDatastore(str(tmpdir.join('store')))
+    path = S._abspath(S._worksheet_pathname('alice', 0))
+    cells = os.path.join(path, 'cells')
+    write(os.path.join(cells, '0', 'plot.png'), b'plot')
+    write(os.path.join(path, 'data', 'file'), b'plot')
+    S.store_files([cells])
+    h = S.file_hash(os.path.join(cells, '0', 'plot.png'))
+    assert h == hashlib.sha1(b'plot').hexdigest()
+    # Data files are not stored
+    assert os.stat(os.path.join(path, 'data', 'file')).st_nlink == 1
+
+    # A copy of the worksheet shares the blobs
+    copy = S._abspath(S._worksheet_pathname('alice', 1))
+    sync_tree(path, copy)
+    shutil.rmtree(path)
+    assert S.collect_files() == (0, 0)
+    shutil.rmtree(copy)
+    assert S.collect_files() == (1, 4)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*
+"""
+Download and upload of zip files of worksheets.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import zipfile
+
+from sagewui import config as CFG
+
+
+def make_worksheets(notebook, names):
+    worksheets = []
+    for i, name in enumerate(names):
+        W = notebook.create_wst(name, CFG.UN_ADMIN)
+        W.edit_save('{{{id=0|\n%d+1\n///\n%d\n}}}' % (i, i + 1))
+        W.save()
+        worksheets.append(W)
+    return worksheets
+
+
+def download(client, worksheets):
+    response = client.get('/download_worksheets.zip', query_string={
+        'filenames': json.dumps([W.filename for W in worksheets])})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    return response.get_data()
+
+
+def upload(client, data, filename='worksheets.zip', name=''):
+    response = client.post('/upload_worksheet', data={
+        'url': '', 'name': name,
+        'file': (io.BytesIO(data), filename)})
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def test_download_zip(client, notebook):
+    worksheets = make_worksheets(notebook, ['a', 'b', 'a', 'a'])
+    with zipfile.ZipFile(io.BytesIO(download(client, worksheets))) as Z:
+        assert Z.testzip() is None
+        # Worksheets with the same name get distinct entries
+        assert sorted(Z.namelist()) == [
+            'a.sws', 'a_2.sws', 'a_3.sws', 'b.sws']
+
+
+def test_download_zip_empty(client):
+    with zipfile.ZipFile(io.BytesIO(download(client, []))) as Z:
+        assert Z.namelist() == []
+
+
+def test_zip_round_trip(client, notebook):
+    worksheets = make_worksheets(notebook, ['a', 'b', 'c'])
+    data = download(client, worksheets)
+    before = set(W.filename for W in notebook.user_wsts(CFG.UN_ADMIN))
+
+    page = upload(client, data, name='Copy')
+    assert page.count('Imported') == 3
+    assert 'window.location.href' in page
+
+    imported = [W for W in notebook.user_wsts(CFG.UN_ADMIN)
+                if W.filename not in before]
+    assert sorted(W.name for W in imported) == [
+        'Copy - a', 'Copy - b', 'Copy - c']
+    bodies = dict((W.name, W.body) for W in worksheets)
+    for W in imported:
+        assert W.body == bodies[W.name[len('Copy - '):]]
+
+
+def test_upload_zip_skipped_and_failed_members(client, notebook):
+    W, = make_worksheets(notebook, ['good'])
+    with zipfile.ZipFile(io.BytesIO(download(client, [W]))) as Z:
+        sws = Z.read('good.sws')
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as Z:
+        Z.writestr('good.sws', sws)
+        Z.writestr('__MACOSX/._good.sws', b'metadata')
+        Z.writestr('notes.pdf', b'unknown extension')
+        Z.writestr('folder/', b'')
+        Z.writestr('broken.sws', b'not a tar file')
+    before = len(notebook.user_wsts(CFG.UN_ADMIN))
+
+    page = upload(client, buf.getvalue())
+    assert '[1/2]' in page and '[2/2]' in page
+    assert page.count('Imported') == 1
+    assert 'Error importing broken.sws' in page
+    # No redirection, so that the errors can be read
+    assert 'window.location.href' not in page
+    assert len(notebook.user_wsts(CFG.UN_ADMIN)) == before + 1
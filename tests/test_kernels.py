@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*
+"""
+Registry of the worksheet processes.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+
+import os
+import signal
+import sys
+import threading
+import time
+
+import pytest
+
+from sagewui.gui.kernels import KernelRegistry
+from sagewui.util.locks import worksheet_locks
+from sagewui.util.processes import process_state
+
+TIMEOUT = 5
+
+
+class FakeProcess(object):
+    """
+    A child process which is not waited for, as the pexpect processes of
+    the worksheets.
+    """
+    def __init__(self):
+        self.pid = os.spawnl(os.P_NOWAIT, sys.executable, sys.executable,
+                             '-c', 'import time; time.sleep(60)')
+        self.alive = True
+        self.killed = False
+
+    def is_alive(self):
+        return self.alive
+
+    def quit(self):
+        if not self.killed:
+            os.kill(self.pid, signal.SIGKILL)
+            self.killed = True
+        self.alive = False
+
+
+class FakeWorksheet(object):
+    def __init__(self, registry, name, docbrowser=False):
+        self.registry = registry
+        self.name = name
+        self.filename = 'admin/{}'.format(name)
+        self.docbrowser = docbrowser
+        self.queue = []
+        self.idle = 0
+        self.process = None
+
+    def time_idle(self):
+        return self.idle
+
+    def sage(self):
+        self.registry.starting(self)
+        self.process = FakeProcess()
+        self.registry.started(self, self.process)
+
+    def quit(self):
+        if self.process is not None:
+            self.process.quit()
+            self.process = None
+        self.registry.remove(self)
+
+
+@pytest.fixture
+def registry():
+    registry = KernelRegistry()
+    yield registry
+    for kernel in registry.kernels:
+        kernel.worksheet.quit()
+    wait_until(lambda: not registry._unreaped, registry.reap)
+
+
+def wait_until(condition, action=None):
+    deadline = time.time() + TIMEOUT
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+        if action is not None:
+            action()
+
+
+def counts(registry):
+    return dict((state, n) for (state,), n in registry.counts().items() if n)
+
+
+def test_kernel_states(registry):
+    W = FakeWorksheet(registry, 'a')
+    registry.starting(W)
+    assert W in registry
+    assert counts(registry) == {'starting': 1}
+    W.process = FakeProcess()
+    registry.started(W, W.process)
+    kernel, = registry.kernels
+    assert (kernel.pid, kernel.state) == (W.process.pid, 'idle')
+    assert kernel.last_heartbeat is not None
+    W.queue.append('cell')
+    assert counts(registry) == {'busy': 1}
+
+    W2 = FakeWorksheet(registry, 'b')
+    W2.sage()
+    assert len(registry) == 2
+    assert counts(registry) == {'busy': 1, 'idle': 1}
+
+
+def test_remove_reaps(registry):
+    W = FakeWorksheet(registry, 'a')
+    W.sage()
+    pid = W.process.pid
+    W.quit()
+    assert W not in registry
+    # Reaped once it has exited
+    wait_until(lambda: not registry._unreaped, registry.reap)
+    assert process_state(pid) is None
+
+    # Already reaped processes are forgotten
+    registry._unreaped.add(pid)
+    registry.reap()
+    assert not registry._unreaped
+
+
+def test_restart_reaps_previous_process(registry):
+    W = FakeWorksheet(registry, 'a')
+    W.sage()
+    pid = W.process.pid
+    # The process exited without the worksheet being quit
+    W.process.quit()
+    W.sage()
+    assert pid in registry._unreaped
+    wait_until(lambda: pid not in registry._unreaped, registry.reap)
+    assert process_state(pid) is None
+    assert registry.kernels[0].pid == W.process.pid
+
+
+def test_heartbeat(registry):
+    alive = FakeWorksheet(registry, 'alive')
+    dead = FakeWorksheet(registry, 'dead')
+    stopped = FakeWorksheet(registry, 'stopped')
+    for W in (alive, dead, stopped):
+        W.sage()
+    kernel = registry.kernels[0]
+    kernel.last_heartbeat = 0
+
+    dead.process.alive = False
+    os.kill(stopped.process.pid, signal.SIGSTOP)
+    wait_until(lambda: process_state(stopped.process.pid) == 'T')
+    pids = [W.process.pid for W in (dead, stopped)]
+    registry.heartbeat()
+    assert [K.worksheet for K in registry.kernels] == [alive]
+    assert registry.kernels[0].last_heartbeat > 0
+    wait_until(lambda: not registry._unreaped, registry.reap)
+    for pid in pids:
+        assert process_state(pid) is None
+
+
+def test_heartbeat_skips_worksheets_in_use(registry):
+    W = FakeWorksheet(registry, 'a')
+    W.sage()
+    W.process.alive = False
+    # The worksheet lock is held by a request thread
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def request():
+        with worksheet_locks[W.filename]:
+            acquired.set()
+            release.wait(TIMEOUT)
+
+    thread = threading.Thread(target=request)
+    thread.start()
+    assert acquired.wait(TIMEOUT)
+    registry.heartbeat()
+    registry.apply_policies(walltime=1e-6)
+    assert W in registry
+    release.set()
+    thread.join(TIMEOUT)
+    registry.heartbeat()
+    assert W not in registry
+
+
+def test_apply_policies(registry):
+    idle = FakeWorksheet(registry, 'idle')
+    doc = FakeWorksheet(registry, 'doc', docbrowser=True)
+    old = FakeWorksheet(registry, 'old')
+    for W in (idle, doc, old):
+        W.sage()
+    idle.idle = doc.idle = 50
+    old_kernel = [K for K in registry.kernels if K.worksheet is old][0]
+    old_kernel.started -= 1000
+
+    registry.apply_policies()
+    assert len(registry) == 3
+    registry.apply_policies(idle_timeout=100, doc_timeout=10)
+    assert doc not in registry and idle in registry
+    registry.apply_policies(idle_timeout=10, walltime=500)
+    assert len(registry) == 0
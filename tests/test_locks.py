@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*
+"""
+Read/write locks, lock stripes and their instrumentation.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import range
+
+import threading
+import time
+
+import pytest
+
+from sagewui.util.locks import LockStripes
+from sagewui.util.locks import RWLock
+from sagewui.util.locks import lock_monitor
+
+TIMEOUT = 5
+
+
+def start(function, *args):
+    thread = threading.Thread(target=function, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def wait_until(condition):
+    deadline = time.time() + TIMEOUT
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.001)
+
+
+def blocked(event):
+    # The other thread doesn't get the lock meanwhile
+    return not event.wait(0.1)
+
+
+def test_rwlock_concurrent_readers():
+    L = RWLock('test')
+    acquired = threading.Event()
+
+    def reader():
+        with L.read():
+            acquired.set()
+
+    with L.read():
+        thread = start(reader)
+        assert acquired.wait(TIMEOUT)
+    thread.join(TIMEOUT)
+    assert L._readers == 0
+
+
+def test_rwlock_exclusive_writer():
+    L = RWLock('test')
+    events = dict((name, threading.Event())
+                  for name in ('read', 'write', 'release'))
+
+    def writer():
+        with L.write():
+            events['write'].set()
+            events['release'].wait(TIMEOUT)
+
+    def reader():
+        with L.read():
+            events['read'].set()
+
+    L.acquire_read()
+    start(writer)
+    assert blocked(events['write'])
+    L.release_read()
+    assert events['write'].wait(TIMEOUT)
+
+    # Readers wait for the writer
+    start(reader)
+    assert blocked(events['read'])
+    events['release'].set()
+    assert events['read'].wait(TIMEOUT)
+
+
+def test_rwlock_writer_priority():
+    L = RWLock('test')
+    order = []
+
+    def writer():
+        with L.write():
+            order.append('writer')
+
+    def reader():
+        with L.read():
+            order.append('reader')
+
+    L.acquire_read()
+    threads = [start(writer)]
+    wait_until(lambda: L._waiting_writers == 1)
+    # A new reader waits for the waiting writer
+    threads.append(start(reader))
+    time.sleep(0.1)
+    assert order == []
+    L.release_read()
+    for thread in threads:
+        thread.join(TIMEOUT)
+    assert order == ['writer', 'reader']
+    assert (L._readers, L._writer, L._waiting_writers) == (0, False, 0)
+
+
+def test_rwlock_released_on_error():
+    L = RWLock('test')
+    for lock in (L.read, L.write):
+        with pytest.raises(ValueError):
+            with lock():
+                raise ValueError
+    assert (L._readers, L._writer) == (0, False)
+
+
+def test_lock_stripes():
+    S = LockStripes(4, 'test')
+    assert len(S) == 4
+    keys = ['admin/%d' % i for i in range(20)]
+    assert set(S[key]._lock for key in keys) == set(S._locks)
+    for key in keys:
+        assert S[key]._lock is S._locks[hash(key) % 4]
+        assert S[key].key == key
+
+
+def test_lock_stripes_reentrant():
+    S = LockStripes(1, 'test')
+    acquired = []
+
+    def other(key):
+        acquired.append(S[key].acquire(False))
+
+    # Keys which share a lock may be held together
+    with S['a']:
+        with S['b']:
+            with S['a']:
+                thread = start(other, 'c')
+                thread.join(TIMEOUT)
+    assert acquired == [False]
+    thread = start(other, 'c')
+    thread.join(TIMEOUT)
+    assert acquired == [False, True]
+
+
+def test_lock_monitor(monkeypatch):
+    monkeypatch.setattr(lock_monitor, 'enabled', True)
+    lock_monitor.reset()
+    S = LockStripes(2, 'stripes')
+    L = RWLock('rwlock')
+    with S['key']:
+        with S['key']:
+            pass
+    with L.read():
+        pass
+    with L.write():
+        pass
+
+    stats = dict((s['name'], s) for s in lock_monitor.basic['locks'])
+    assert sorted(stats) == ['rwlock (read)', 'rwlock (write)', 'stripes']
+    # Reentrant acquisitions are counted once
+    assert stats['stripes']['hold']['count'] == 1
+    assert [(k['name'], k['count']) for k in stats['stripes']['keys']] == [
+        ('key', 1)]
+    holder = threading.current_thread().name
+    assert stats['rwlock (write)']['holders'][0]['name'] == holder
+
+    lock_monitor.reset()
+    monkeypatch.setattr(lock_monitor, 'enabled', False)
+    with S['key']:
+        pass
+    assert lock_monitor.basic['locks'] == []
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*
+"""
+Scrape of the ``/metrics`` admin page.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import re
+
+from sagewui import config as CFG
+
+# name{label="value",...} value
+SAMPLE = re.compile(
+    r'^([a-zA-Z_:][a-zA-Z0-9_:]*)'
+    r'(?:\{((?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*",?)*)\})?'
+    r' (\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_exposition(text):
+    """
+    Parse the Prometheus text format ``text``.
+
+    OUTPUT:
+
+    - a pair of dicts; the types of the metrics, and the values of the
+      samples by (name, labels), where labels is a sorted tuple of pairs
+    """
+    types = {}
+    samples = {}
+    for line in text.splitlines():
+        if not line:
+            continue
+        if line.startswith('#'):
+            fields = line.split(None, 3)
+            assert fields[1] in ('HELP', 'TYPE'), line
+            if fields[1] == 'TYPE':
+                assert fields[3] in ('counter', 'gauge', 'histogram'), line
+                types[fields[2]] = fields[3]
+            continue
+        match = SAMPLE.match(line)
+        assert match is not None, line
+        name, labels, value = match.groups()
+        labels = tuple(sorted(LABEL.findall(labels or '')))
+        assert (name, labels) not in samples, line
+        samples[name, labels] = float(value)
+    return types, samples
+
+
+def test_metrics(client):
+    assert client.get('/users').status_code == 200
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+
+    types, samples = parse_exposition(response.get_data(as_text=True))
+    assert types['sagewui_requests_total'] == 'counter'
+    assert types['sagewui_request_duration_seconds'] == 'histogram'
+    assert types['sagewui_kernels'] == 'gauge'
+
+    labels = (('endpoint', 'admin.users'), ('method', 'GET'),
+              ('status', '200'))
+    assert samples['sagewui_requests_total', labels] >= 1
+
+    endpoint = (('endpoint', 'admin.users'),)
+    count = samples['sagewui_request_duration_seconds_count', endpoint]
+    assert count >= 1
+    assert samples['sagewui_request_duration_seconds_bucket',
+                   endpoint + (('le', '+Inf'),)] == count
+    assert samples['sagewui_request_duration_seconds_sum', endpoint] >= 0
+
+    for state in ('starting', 'idle', 'busy', 'dead'):
+        assert samples['sagewui_kernels', (('state', state),)] == 0
+    assert samples['sagewui_worksheets_loaded', ()] == 0
+
+
+def test_metrics_admin_only(client):
+    with client.session_transaction() as session:
+        session['username'] = CFG.UN_GUEST
+    response = client.get('/metrics')
+    assert 'sagewui_requests_total' not in response.get_data(as_text=True)
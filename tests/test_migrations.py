@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*
+"""
+Resumable migrations of the notebook data.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import pytest
+
+from sagewui import config as CFG
+from sagewui.gui.migrations import Migration
+from sagewui.gui.migrations import PublishedIdMigration
+from sagewui.gui.migrations import SharedWorksheetsMigration
+
+
+class Interrupted(Exception):
+    pass
+
+
+class RecordingMigration(Migration):
+    name = 'recording'
+    title = 'Recording'
+    checkpoint_interval = 3
+
+    def __init__(self, notebook, items, fail=(), interrupt=None):
+        super(RecordingMigration, self).__init__(notebook, 1)
+        self._items = items
+        self.fail = fail
+        self.interrupt = interrupt
+        self.applied = []
+        self.commits = 0
+        self.finished = False
+
+    def items(self):
+        return self._items
+
+    def migrate(self, item):
+        if item in self.fail:
+            raise ValueError(item)
+        return item.upper()
+
+    def apply(self, item, result):
+        if item == self.interrupt:
+            raise Interrupted(item)
+        assert result == item.upper()
+        self.applied.append(item)
+
+    def commit(self):
+        self.commits += 1
+
+    def finish(self):
+        self.finished = True
+
+
+ITEMS = ['i%d' % i for i in range(8)]
+
+
+def checkpoint(notebook):
+    return notebook._storage.load_migration_checkpoint(
+        RecordingMigration.name)
+
+
+def test_migration_complete(notebook):
+    M = RecordingMigration(notebook, ITEMS)
+    assert M.run() == []
+    assert sorted(M.applied) == ITEMS
+    assert M.finished
+    assert checkpoint(notebook) is None
+    # Two checkpoints of 3 items and the last commit
+    assert M.commits == 3
+
+
+def test_migration_failed_items(notebook, capsys):
+    M = RecordingMigration(notebook, ITEMS, fail=('i1', 'i6'))
+    assert sorted(M.run()) == ['i1', 'i6']
+    assert 'error on i1' in capsys.readouterr().err
+    assert not M.finished
+    assert checkpoint(notebook) == set(ITEMS) - set(['i1', 'i6'])
+
+    # Only the failed items are migrated again
+    M = RecordingMigration(notebook, ITEMS, fail=('i6',))
+    assert M.run() == ['i6']
+    assert M.applied == ['i1']
+    M = RecordingMigration(notebook, ITEMS)
+    assert M.run() == []
+    assert M.applied == ['i6']
+    assert M.finished
+    assert checkpoint(notebook) is None
+
+
+def test_migration_interrupted(notebook):
+    M = RecordingMigration(notebook, ITEMS, interrupt='i7')
+    with pytest.raises(Interrupted):
+        M.run()
+    done = checkpoint(notebook)
+    assert 'i7' not in M.applied
+    assert len(done) == 6 and done.issubset(M.applied)
+
+    # The items migrated since the last checkpoint are migrated again
+    M = RecordingMigration(notebook, ITEMS + ['i8'])
+    assert M.run() == []
+    assert sorted(M.applied) == sorted(set(ITEMS + ['i8']) - done)
+    assert checkpoint(notebook) is None
+
+
+def test_migration_no_items(notebook):
+    M = RecordingMigration(notebook, [])
+    assert M.run() == []
+    assert M.finished
+    assert checkpoint(notebook) is None
+
+
+def make_worksheet(notebook, name):
+    W = notebook.create_wst(name, CFG.UN_ADMIN)
+    W.edit_save('{{{id=0|\n1+1\n///\n}}}')
+    return W
+
+
+def test_shared_worksheets_migration(notebook):
+    notebook.user_manager.add_user('alice', 'passpass', '')
+    W = make_worksheet(notebook, 'Shared')
+    W.collaborators = ['alice', 'nobody']
+    W.save()
+    notebook.conf['model_version'] = 0
+
+    assert SharedWorksheetsMigration(notebook).run() == []
+    assert (CFG.UN_ADMIN, W.id_number) in \
+        notebook.user_manager['alice'].viewable_worksheets
+    assert notebook.conf['model_version'] == 1
+    assert notebook._storage.load_server_conf()['model_version'] == 1
+    assert notebook._storage.load_migration_checkpoint(
+        SharedWorksheetsMigration.name) is None
+
+
+def test_published_id_migration(notebook):
+    published = make_worksheet(notebook, 'Published')
+    P = notebook.publish_wst(published, CFG.UN_ADMIN)
+    published.save()
+    # Unpublished by older versions, which kept the published id number
+    broken = make_worksheet(notebook, 'Broken')
+    broken.published_id_number = P.id_number + 1
+    broken.save()
+
+    assert PublishedIdMigration(notebook).run() == []
+    assert broken.published_id_number is None
+    assert published.published_id_number == P.id_number
+    stored = dict((W.id_number, W.published_id_number)
+                  for W in notebook._storage.worksheets(CFG.UN_ADMIN))
+    assert stored == {published.id_number: P.id_number,
+                      broken.id_number: None}
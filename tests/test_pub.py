@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*
+"""
+Index and catalog of the published worksheets.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+
+import pytest
+
+from sagewui import config as CFG
+from sagewui.gui.pub_catalog import PubCatalog
+from sagewui.gui.pub_catalog import PubEntry
+from sagewui.util.records import RecordLog
+
+
+def make_worksheet(notebook, name, text):
+    W = notebook.create_wst(name, CFG.UN_ADMIN)
+    W.edit_save('{{{id=0|\n%s\n///\n}}}' % text)
+    W.save()
+    return W
+
+
+def stored_catalog(notebook):
+    return notebook._storage.load_pub_catalog()
+
+
+def test_publish_unpublish(notebook):
+    W = make_worksheet(notebook, 'Algebra', 'factor(x^2 - 1)')
+    assert notebook.published_wst(W) is None
+    P = notebook.publish_wst(W, CFG.UN_ADMIN)
+    assert notebook._pub_index == {W.filename: P.id_number}
+    assert notebook._storage.load_pub_index() == notebook._pub_index
+    assert notebook.published_wst(W).filename == P.filename
+
+    entry = notebook.pub_catalog.get(P.id_number)
+    assert entry == PubEntry.from_worksheet(P)
+    assert (entry.name, entry.source) == ('Algebra', W.filename)
+    assert 'factor(x^2' in entry.tokens
+    assert stored_catalog(notebook) == {P.id_number: entry.basic}
+
+    # Publishing again updates the same published worksheet
+    W.edit_save('{{{id=0|\nexpand((x - 1)*(x + 1))\n///\n}}}')
+    assert notebook.publish_wst(W, CFG.UN_ADMIN).id_number == P.id_number
+    entry = notebook.pub_catalog.get(P.id_number)
+    assert 'expand((x' in entry.tokens
+    assert len(notebook.pub_catalog) == 1
+    assert stored_catalog(notebook) == {P.id_number: entry.basic}
+
+    notebook.unpublish_wst(W)
+    assert notebook.published_wst(W) is None
+    assert notebook._pub_index == {}
+    assert notebook._storage.load_pub_index() == {}
+    assert P.id_number not in notebook.pub_catalog
+    assert stored_catalog(notebook) == {}
+
+
+def test_reload_and_rating(notebook):
+    W = make_worksheet(notebook, 'Rated', '1 + 1')
+    P = notebook.publish_wst(W, CFG.UN_ADMIN)
+    P.rate(3, 'good', 'guest')
+    assert notebook.pub_catalog.get(P.id_number).rating() == 3
+
+    # The index and catalog are read from the datastore
+    index = notebook._pub_index
+    catalog = dict((e.id_number, e.basic)
+                   for e in notebook.pub_catalog.select())
+    del notebook._pub_index
+    del notebook.pub_catalog
+    assert notebook._pub_index == index
+    assert dict((e.id_number, e.basic)
+                for e in notebook.pub_catalog.select()) == catalog
+
+
+def test_catalog_log_compaction(notebook):
+    worksheets = [make_worksheet(notebook, 'W%d' % i, 'x = %d' % i)
+                  for i in range(3)]
+    published = [notebook.publish_wst(W, CFG.UN_ADMIN) for W in worksheets]
+    notebook.unpublish_wst(worksheets[1])
+    published[0].rate(1, '', 'guest')
+
+    log = RecordLog(notebook._storage._abspath(
+        notebook._storage._pub_catalog_filename))
+    assert len(log.tail()) > 2
+    catalog = stored_catalog(notebook)
+    assert sorted(catalog) == [published[0].id_number,
+                               published[2].id_number]
+    assert catalog[published[0].id_number]['rating'] == 1
+    # The log is compacted when it is loaded
+    assert len(log.tail()) == 2
+    assert stored_catalog(notebook) == catalog
+
+
+def test_stale_index_entry(notebook):
+    W1 = make_worksheet(notebook, 'One', '1')
+    W2 = make_worksheet(notebook, 'Two', '2')
+    P1 = notebook.publish_wst(W1, CFG.UN_ADMIN)
+    notebook._update_pub_index(W2.filename, P1.id_number)
+    # P1 is not a published version of W2
+    assert notebook.published_wst(W2) is None
+    assert notebook._pub_index == {W1.filename: P1.id_number}
+
+    notebook._update_pub_index(W2.filename, 1000)
+    assert notebook.published_wst(W2) is None
+
+
+def test_deleted_published_worksheet(notebook):
+    W = make_worksheet(notebook, 'Deleted', '1')
+    P = notebook.publish_wst(W, CFG.UN_ADMIN)
+    notebook.delete_wst(P.filename)
+    assert notebook._pub_index == {}
+    assert P.id_number not in notebook.pub_catalog
+
+
+def test_build_index_and_catalog(notebook):
+    worksheets = [make_worksheet(notebook, 'W%d' % i, 'x = %d' % i)
+                  for i in range(3)]
+    published = [notebook.publish_wst(W, CFG.UN_ADMIN) for W in worksheets]
+    index = dict(notebook._pub_index)
+    catalog = stored_catalog(notebook)
+
+    # Built from the published worksheets when they are missing
+    os.unlink(notebook._storage._abspath(
+        notebook._storage._pub_index_filename))
+    os.unlink(notebook._storage._abspath(
+        notebook._storage._pub_catalog_filename))
+    del notebook._pub_index
+    del notebook.pub_catalog
+    assert notebook._pub_index == index
+    assert len(notebook.pub_catalog) == len(published)
+    assert stored_catalog(notebook) == catalog
+
+    # Or by a repair
+    notebook._storage.save_pub_index({})
+    notebook._storage.save_pub_catalog({})
+    notebook.repair()
+    assert notebook._pub_index == index
+    assert stored_catalog(notebook) == catalog
+
+
+def entry(id_number, name, source, last_edited, rating, text):
+    return PubEntry(id_number, name, 'admin', source,
+                    ('admin', last_edited), rating,
+                    sorted(set(text.lower().split())))
+
+
+@pytest.fixture
+def catalog():
+    return PubCatalog([
+        entry(0, 'Beta', 'bob/0', 30, 2, 'plot(sin(x)) graphics'),
+        entry(1, 'alpha', 'carol/3', 10, -1, 'integral of sin(x)'),
+        entry(2, 'Gamma', 'alice/1', 20, 4, 'matrix rank'),
+        ])
+
+
+def ids(entries):
+    return [e.id_number for e in entries]
+
+
+def test_pub_catalog_select(catalog):
+    assert ids(catalog.select()) == [0, 2, 1]
+    assert ids(catalog.select(reverse=True)) == [1, 2, 0]
+    assert ids(catalog.select(sort='name')) == [1, 0, 2]
+    assert ids(catalog.select(sort='owner')) == [2, 0, 1]
+    assert ids(catalog.select(sort='rating')) == [1, 0, 2]
+    with pytest.raises(ValueError):
+        catalog.select(sort='size')
+
+
+def test_pub_catalog_search(catalog):
+    assert ids(catalog.select('sin')) == [0, 1]
+    assert ids(catalog.select('SIN plot')) == [0]
+    assert ids(catalog.select('"rank matrix"')) == [2]
+    assert ids(catalog.select('missing')) == []
+    assert ids(catalog.select('')) == [0, 2, 1]
+
+
+def test_pub_catalog_update_remove(catalog):
+    e = catalog.get(0)
+    assert not catalog.update(PubEntry.from_basic(e.basic))
+    e = entry(0, 'Beta', 'bob/0', 40, 2, 'plot')
+    assert catalog.update(e)
+    assert catalog.get(0) == e
+    assert catalog.update(entry(5, 'New', 'bob/5', 0, -1, ''))
+    assert len(catalog) == 4
+    assert catalog.remove(5)
+    assert not catalog.remove(5)
+    assert 5 not in catalog
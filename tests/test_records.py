@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*
+"""
+Per cell records of worksheet bodies and append-only record logs.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import open
+
+import os
+
+import pytest
+
+from sagewui.gui.worksheet import Worksheet
+from sagewui.util.records import CellRecords
+from sagewui.util.records import RecordLog
+
+BODY = ('<p>intro</p>\n\n'
+        '{{{id=0|\n1+1\n///\n2\n}}}\n\n'
+        '{{{id=5|\nx = "été"\n///\n}}}')
+
+
+@pytest.fixture
+def worksheet(tmpdir):
+    W = Worksheet('alice', 0, name='records',
+                  notebook_worksheet_directory=str(tmpdir))
+    W.edit_save(BODY)
+    return W
+
+
+def read(R, id):
+    with open(R._filename(id), 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+def overwrite(R, id, text):
+    with open(R._filename(id), 'wb') as f:
+        f.write(text.encode('utf-8'))
+
+
+def test_cell_records_round_trip(worksheet):
+    R = CellRecords(worksheet.directory)
+    assert not R.exists
+    ids, states = R.save(worksheet.cells)
+    assert R.exists
+    assert ids == R.order == [C.id for C in worksheet.cells]
+    records = R.load()
+    assert [id for id, text in records] == ids
+    assert CellRecords.body(records) == worksheet.body
+
+
+def test_cell_records_write_changed_cells(worksheet):
+    R = CellRecords(worksheet.directory)
+    saved = R.save(worksheet.cells)
+    # Not rewritten, unless saved is unknown
+    overwrite(R, 0, 'unchanged')
+    worksheet.get_cell_with_id(5).input = 'y = 2'
+    saved = R.save(worksheet.cells, saved)
+    assert read(R, 0) == 'unchanged'
+    assert 'y = 2' in read(R, 5)
+
+    R.save(worksheet.cells)
+    assert read(R, 0) == '{{{id=0|\n1+1\n///\n2\n}}}'
+
+
+def test_cell_records_removed_cells(worksheet):
+    R = CellRecords(worksheet.directory)
+    saved = R.save(worksheet.cells)
+    cells = [C for C in worksheet.cells if C.id != 0]
+    ids, states = R.save(cells, saved)
+    assert R.order == ids == [C.id for C in cells]
+    assert not os.path.exists(R._filename(0))
+    assert [id for id, text in R.load()] == ids
+
+
+def test_cell_records_missing_record(worksheet):
+    R = CellRecords(worksheet.directory)
+    R.save(worksheet.cells)
+    os.unlink(R._filename(0))
+    assert dict(R.load())[0] == ''
+    assert '{{{id=0|' not in CellRecords.body(R.load())
+
+
+def test_cell_records_saved_state(worksheet):
+    R = CellRecords(worksheet.directory)
+    R.save(worksheet.cells)
+    records = R.load()
+    cells = worksheet.body_to_cells(CellRecords.body(records))
+    saved = CellRecords.saved_state(records, cells)
+    for id, text in records:
+        overwrite(R, id, 'unchanged')
+    R.save(cells, saved)
+    texts = dict(records)
+    for C in cells:
+        assert texts[C.id] == C.edit_text.strip()
+        assert read(R, C.id) == 'unchanged'
+
+    # A cell whose record differs is written
+    id, text = records[1]
+    records[1] = id, 'stale'
+    R.save(cells, CellRecords.saved_state(records, cells))
+    assert read(R, id) == text
+    assert read(R, records[0][0]) == 'unchanged'
+
+
+def test_record_log_round_trip(tmpdir):
+    log = RecordLog(str(tmpdir.join('log')))
+    assert not log.exists
+    assert log.tail() == []
+    assert log.check() == 0
+
+    records = ['first', '', 'été', 'x' * 100000]
+    log.append(records[:2])
+    log.append([])
+    log.append(records[2:])
+    assert log.check() == 4
+    assert log.tail() == records
+    assert log.tail(2) == records[2:]
+    assert log.tail(0) == []
+    assert log.tail(10) == records
+
+    log.rewrite(['only'])
+    assert log.tail() == ['only']
+    log.rewrite([])
+    assert log.exists
+    assert log.tail() == []
+
+
+@pytest.mark.parametrize('cut', [1, 4, 6, 9])
+def test_record_log_truncated(tmpdir, cut):
+    log = RecordLog(str(tmpdir.join('log')))
+    log.append(['kept', 'other'])
+    size = os.path.getsize(log.filename)
+    log.append(['truncated'])
+    with open(log.filename, 'r+b') as f:
+        f.truncate(os.path.getsize(log.filename) - cut)
+
+    # The truncated record is dropped by tail and removed by check
+    assert log.tail() == []
+    assert log.check() == 2
+    assert os.path.getsize(log.filename) == size
+    assert log.tail() == ['kept', 'other']
+    log.append(['appended'])
+    assert log.tail() == ['kept', 'other', 'appended']
+
+
+def test_record_log_corrupted_length(tmpdir):
+    log = RecordLog(str(tmpdir.join('log')))
+    log.append(['kept', 'corrupted'])
+    with open(log.filename, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'\xff')
+    assert log.tail() == []
+    assert log.check() == 1
+    assert log.tail() == ['kept']
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*
+"""
+Delta compressed worksheet snapshots.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import open
+
+import bz2
+import os
+import random
+
+import pytest
+
+from sagewui.util.snapshots import SnapshotStore
+from sagewui.util.snapshots import apply_delta
+from sagewui.util.snapshots import make_delta
+
+
+def bodies(n, seed=0):
+    # Successive versions of a worksheet body, each one editing, adding or
+    # removing a line of the previous one
+    rnd = random.Random(seed)
+    lines = ['line %d été' % i for i in range(30)]
+    result = []
+    for i in range(n):
+        k = rnd.randrange(len(lines))
+        action = rnd.choice(('edit', 'insert', 'delete'))
+        if action == 'edit':
+            lines[k] = 'edit %d' % i
+        elif action == 'insert' or len(lines) < 2:
+            lines.insert(k, 'insert %d' % i)
+        else:
+            del lines[k]
+        result.append('\n'.join(lines))
+    return result
+
+
+@pytest.mark.parametrize('old,new', [
+    ('', ''),
+    ('', 'a\nb'),
+    ('a\nb\n', ''),
+    ('a\nb', 'a\nb\n'),
+    ('a\nb\nc', 'c\nb\na'),
+    ('a\r\nb', 'a\nb'),
+    ])
+def test_delta_round_trip(old, new):
+    assert apply_delta(old, make_delta(old, new)) == new
+
+
+def test_snapshots_round_trip(tmpdir):
+    S = SnapshotStore(str(tmpdir))
+    assert S.keys == []
+    texts = bodies(25)
+    keys = [S.add(str(1000 + i), text) for i, text in enumerate(texts)]
+    assert S.keys == keys == [str(1000 + i) for i in range(25)]
+
+    index = S.index
+    assert [i for i, e in enumerate(index) if e['keyframe']] == [0, 10, 20]
+    assert os.path.exists(S._filename('1010'))
+    assert os.path.exists(S._filename('1011', False))
+
+    for store in (S, SnapshotStore(str(tmpdir))):
+        for key, text in zip(keys, texts):
+            assert store.body(key) == text
+    with pytest.raises(KeyError):
+        S.body('999')
+
+
+def test_snapshots_unchanged_and_keys(tmpdir):
+    S = SnapshotStore(str(tmpdir))
+    assert S.add('1000', 'a') == '1000'
+    assert S.add('1001', 'a') is None
+    # Keys are increasing, even if the clock goes back
+    assert S.add('900', 'b') == '1001'
+    assert S.add('1001', 'c') == '1002'
+    assert SnapshotStore(str(tmpdir)).add('1500', 'c') is None
+    assert S.keys == ['1000', '1001', '1002']
+
+
+def test_snapshots_remove(tmpdir):
+    S = SnapshotStore(str(tmpdir))
+    texts = bodies(15)
+    keys = [S.add(str(1000 + i), text) for i, text in enumerate(texts)]
+    removed = set(keys[:3] + keys[9:11] + keys[-1:])
+    S.remove(removed)
+
+    kept = [(k, t) for k, t in zip(keys, texts) if k not in removed]
+    for store in (S, SnapshotStore(str(tmpdir))):
+        assert store.keys == [k for k, t in kept]
+        for key, text in kept:
+            assert store.body(key) == text
+    # The snapshots which followed a removed one are keyframes
+    index = dict((e['key'], e) for e in S.index)
+    assert index[keys[3]]['keyframe'] and index[keys[11]]['keyframe']
+    for key in removed:
+        assert not os.path.exists(S._filename(key))
+        assert not os.path.exists(S._filename(key, False))
+
+    # The next snapshot is a delta of the last one, which was removed
+    key = S.add('2000', texts[-1])
+    assert S.body(key) == texts[-1]
+    assert SnapshotStore(str(tmpdir)).body(key) == texts[-1]
+
+
+def test_snapshots_legacy_directory(tmpdir):
+    # Older versions stored every snapshot as a keyframe, without index
+    texts = bodies(3)
+    for i, text in enumerate(texts):
+        with open(str(tmpdir.join('{}.bz2'.format(200 + i * 100))),
+                  'wb') as f:
+            f.write(bz2.compress(text.encode('utf-8')))
+
+    S = SnapshotStore(str(tmpdir))
+    assert S.keys == ['200', '300', '400']
+    assert tmpdir.join(SnapshotStore.index_filename).check()
+    assert [S.body(key) for key in S.keys] == texts
+    assert S.add('500', texts[-1]) is None
+    assert S.add('500', 'new') == '500'
+    assert SnapshotStore(str(tmpdir)).body('500') == 'new'
+
+
+def test_snapshots_missing_directory(tmpdir):
+    S = SnapshotStore(str(tmpdir.join('missing')))
+    assert S.keys == []
+    assert not tmpdir.join('missing').check()
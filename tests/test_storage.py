@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*
+"""
+Serializers and per user records of the filesystem datastore.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import open
+
+import os
+
+import pytest
+from future.moves import pickle
+
+from sagewui.controllers import UserManager
+from sagewui.storage import serializers
+from sagewui.storage.filesystem_storage import FilesystemDatastore
+
+OBJ = {'name': 'été', 'id_number': 3, 'collaborators': ['a', 'b'],
+       'tags': {'a': [1]}, 'last_change': ('a', 1.5), 'none': None}
+
+
+@pytest.mark.parametrize(
+    'name', sorted(serializers.serializers) + [serializers.legacy.name])
+def test_serializers_round_trip(name):
+    s = serializers.dumps(OBJ, name)
+    assert serializers.loads(s) == OBJ
+    if name == serializers.legacy.name:
+        assert not s.startswith(b'\x00')
+    else:
+        assert s.startswith(b'\x00' + name.encode('ascii') + b'\n')
+
+
+def test_serializers_legacy_pickles():
+    # Pickles written by older versions have no header
+    assert serializers.loads(pickle.dumps(OBJ, protocol=0)) == OBJ
+    assert serializers.loads(pickle.dumps(OBJ, protocol=2)) == OBJ
+
+
+def test_serializers_errors():
+    with pytest.raises(ValueError):
+        serializers.loads(b'\x00unknown\n' + pickle.dumps(OBJ))
+    with pytest.raises(KeyError):
+        serializers.dumps(OBJ, 'unknown')
+
+
+def test_datastore_serializer(tmpdir):
+    legacy = FilesystemDatastore(str(tmpdir), serializer='legacy')
+    legacy._save(OBJ, 'obj.pickle')
+    with open(legacy._abspath('obj.pickle'), 'rb') as f:
+        assert not f.read().startswith(b'\x00')
+    # Files are read whatever their serializer
+    S = FilesystemDatastore(str(tmpdir))
+    assert S._load('obj.pickle') == OBJ
+    S._save(OBJ, 'obj.pickle')
+    with open(S._abspath('obj.pickle'), 'rb') as f:
+        assert f.read().startswith(b'\x00' + S.serializer.encode('ascii'))
+    assert legacy._load('obj.pickle') == OBJ
+
+
+def stored_users(S):
+    return sorted(fn[:-len('.pickle')]
+                  for fn in os.listdir(S._abspath(S._users_path)))
+
+
+def test_users_round_trip(tmpdir):
+    S = FilesystemDatastore(str(tmpdir))
+    users = UserManager()
+    users.create_default_users('passpass')
+    users.add_user('alice', 'passpass', 'alice@example.org')
+    S.save_users(users.loaded_users)
+    assert stored_users(S) == sorted(users.loaded_users)
+
+    loaded = S.load_users(UserManager())
+    # Users are read on first access
+    assert loaded.loaded_users == {}
+    alice = loaded['alice']
+    assert sorted(loaded.loaded_users) == ['alice']
+    assert alice == users['alice']
+    assert alice.check_password('passpass')
+    assert not alice.modified
+
+
+def test_users_saved_when_modified(tmpdir, monkeypatch):
+    S = FilesystemDatastore(str(tmpdir))
+    users = UserManager()
+    users.create_default_users('passpass')
+    S.save_users(users.loaded_users)
+
+    loaded = S.load_users(UserManager())
+    admin = loaded['admin']
+    guest = loaded['guest']
+    written = []
+    dumps = S._dumps
+    monkeypatch.setattr(S, '_dumps', lambda obj, *args: (
+        written.append(obj['username']), dumps(obj, *args))[1])
+    S.save_users(loaded.loaded_users)
+    assert written == []
+
+    admin.add_viewable_worksheet('alice', 3)
+    guest['language'] = 'fr'
+    S.save_users(loaded.loaded_users)
+    assert sorted(written) == ['admin', 'guest']
+    assert not admin.modified
+    S.save_users(loaded.loaded_users)
+    assert len(written) == 2
+
+    reloaded = S.load_users(UserManager())
+    assert ('alice', 3) in reloaded['admin'].viewable_worksheets
+    assert reloaded['guest']['language'] == 'fr'
+
+
+def test_users_delete(tmpdir):
+    S = FilesystemDatastore(str(tmpdir))
+    users = UserManager()
+    users.add_user('alice', 'passpass', '')
+    S.save_users(users.loaded_users)
+    S.delete_user('alice')
+    S.delete_user('never_saved')
+    assert stored_users(S) == []
+    assert 'alice' not in S.load_users(UserManager())
+
+
+def test_users_legacy_pickle(tmpdir):
+    # Older versions stored all the users in a single pickle
+    S = FilesystemDatastore(str(tmpdir))
+    users = UserManager()
+    users.create_default_users('passpass')
+    S._save([(name, U.basic) for name, U in users.loaded_users.items()],
+            S._users_filename, serializers.legacy.name)
+
+    loaded = S.load_users(UserManager())
+    assert not os.path.exists(S._abspath(S._users_filename))
+    assert stored_users(S) == sorted(users.loaded_users)
+    assert loaded['admin'] == users['admin']
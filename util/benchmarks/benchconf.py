@@ -0,0 +1,39 @@
+"""
+Setup shared by the benchmarks.
+
+The benchmarks which import it run from the root of the repository,
+without installing sagewui, e.g.::
+
+    python util/benchmarks/cells.py
+
+and without sage, so the configuration which the notebook server reads
+from sage (see ``config.add_sage_conf``) is set by :func:`set_sage_conf`.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def set_sage_conf():
+    """
+    Set the interact markers of the configuration to the values of
+    ``sagewui_kernels/sage/sage_code/interact.py``, which can't be
+    imported without sage.
+    """
+    from sagewui import config as CFG
+
+    CFG.INTERACT_UPDATE_PREFIX = '%__sage_interact__'
+    CFG.INTERACT_RESTART = '__SAGE_INTERACT_RESTART__'
+    CFG.INTERACT_START = '<?__SAGE__START>'
+    CFG.INTERACT_TEXT = '<?__SAGE__TEXT>'
+    CFG.INTERACT_HTML = '<?__SAGE__HTML>'
+    CFG.INTERACT_END = '<?__SAGE__END>'
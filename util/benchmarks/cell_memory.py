@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Memory footprint of the cells of a loaded worksheet.
+
+Builds a worksheet whose outputs follow a typical mix (mostly short
+results, some tables and a few very long outputs), builds its cells and
+reports the memory held by the cells, with large outputs compressed as
+the notebook does and with compression disabled. The per cell overhead
+of the slotted cell classes is reported next to the size of an
+equivalent instance with a __dict__.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+
+import argparse
+import gc
+import random
+import shutil
+import sys
+import tracemalloc
+
+import benchconf
+from sagewui import config as CFG
+from sagewui.gui.cell import ComputeCell
+from sagewui.gui.worksheet import Worksheet
+from sagewui.util import tmp_dir
+
+
+description = 'Report the memory used by worksheet cells'
+
+
+def random_output(rnd):
+    x = rnd.random()
+    if x < 0.7:
+        return str(rnd.randint(0, 10**6))
+    if x < 0.95:
+        return '\n'.join(
+            ' '.join('{:8.4f}'.format(rnd.random()) for j in range(8))
+            for i in range(rnd.randint(5, 40)))
+    return '\n'.join('[{}]'.format(', '.join(
+        str(rnd.randint(0, 1000)) for j in range(20)))
+        for i in range(rnd.randint(200, 1000)))
+
+
+def make_body(ncells, seed=0):
+    rnd = random.Random(seed)
+    return '\n\n'.join(
+        '{{{id=%d|\nf(%d)\n///\n%s\n}}}' % (i, i, random_output(rnd))
+        if i % 4 else '<p>text cell %d</p>' % i
+        for i in range(ncells))
+
+
+def cells_memory(path, body):
+    W = Worksheet('bench', 0, name='bench', notebook_worksheet_directory=path)
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    cells = W.body_to_cells(body)
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return len(cells), size
+
+
+class DictCell(object):
+    pass
+
+
+def instance_overhead():
+    C = ComputeCell(0, '', '', None)
+    D = DictCell()
+    for i in range(len(ComputeCell.__slots__)):
+        setattr(D, 'a%d' % i, None)
+    return sys.getsizeof(C), sys.getsizeof(D) + sys.getsizeof(D.__dict__)
+
+
+def run(ncells):
+    body = make_body(ncells)
+    path = tmp_dir()
+    threshold = CFG.MIN_COMPRESSED_OUTPUT
+    try:
+        n, compressed = cells_memory(path, body)
+        CFG.MIN_COMPRESSED_OUTPUT = sys.maxsize
+        n, plain = cells_memory(path, body)
+    finally:
+        CFG.MIN_COMPRESSED_OUTPUT = threshold
+        shutil.rmtree(path, ignore_errors=True)
+    print('{} cells, {:.1f} KiB of worksheet text'.format(
+        n, len(body.encode('utf-8')) / 1024))
+    print('{:<40} {:>10.1f} KiB'.format('cells (uncompressed outputs)',
+                                        plain / 1024))
+    print('{:<40} {:>10.1f} KiB'.format('cells (compressed outputs)',
+                                        compressed / 1024))
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--cells', dest='cells', type=int, nargs='+',
+                        default=[1000, 5000],
+                        help='number of cells of the measured worksheets')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    benchconf.set_sage_conf()
+    slotted, with_dict = instance_overhead()
+    print('compute cell instance: {} bytes (with a __dict__: {} bytes)'
+          .format(slotted, with_dict))
+    print()
+    for ncells in args.cells:
+        run(ncells)
+        print()
+
+
+if __name__ == '__main__':
+    main()
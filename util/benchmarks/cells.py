@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Benchmark of the cell lookup and mutation paths of a worksheet.
+
+Every eval/update request of the notebook goes through
+Worksheet.get_cell_with_id, Worksheet.next_compute_id and the cell
+insertion/deletion methods. This script times them on worksheets with
+thousands of cells, next to the linear scans they replaced, and times
+the free cell id generation.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import random
+import shutil
+import timeit
+
+import benchconf
+from sagewui.gui.cell import ComputeCell
+from sagewui.gui.worksheet import Worksheet
+from sagewui.util import id_generator
+from sagewui.util import tmp_dir
+
+
+description = 'Benchmark worksheet cell lookups'
+
+
+def make_worksheet(path, ncells):
+    W = Worksheet('bench', 0, name='bench', notebook_worksheet_directory=path)
+    W.edit_save('\n\n'.join(
+        '{{{id=%d|\n%d+1\n///\n%d\n}}}' % (i, i, i + 1) if i % 4 else
+        '<p>text cell %d</p>' % i
+        for i in range(ncells)))
+    return W
+
+
+def linear_get_cell_with_id(W, id):
+    for c in W.cells:
+        if c.id == id:
+            return c
+
+
+def linear_next_compute_id(W, cell):
+    L = [C for C in W.cells if isinstance(C, ComputeCell)]
+    k = L.index(cell)
+    return L[k + 1].id if k + 1 < len(L) else cell.id
+
+
+def bench(title, stmt, number):
+    t = timeit.timeit(stmt, number=number)
+    print('{:<40} {:>12.2f} us/call'.format(title, 1e6 * t / number))
+
+
+def run(ncells, number):
+    path = tmp_dir()
+    try:
+        W = make_worksheet(path, ncells)
+        ids = W.cell_id_list
+        compute = W.compute_cells
+        print('{} cells ({} compute cells)'.format(len(ids), len(compute)))
+
+        bench('get_cell_with_id',
+              lambda: W.get_cell_with_id(random.choice(ids)), number)
+        bench('get_cell_with_id (linear scan)',
+              lambda: linear_get_cell_with_id(W, random.choice(ids)), number)
+        bench('next_compute_id',
+              lambda: W.next_compute_id(random.choice(compute)), number)
+        bench('next_compute_id (linear scan)',
+              lambda: linear_next_compute_id(W, random.choice(compute)),
+              number)
+
+        def insert_delete():
+            C = W.new_cell_after(random.choice(ids))
+            W.delete_cell_with_id(C.id)
+        bench('new_cell_after + delete_cell_with_id', insert_delete, number)
+
+        sparse = random.sample(range(100 * ncells), ncells)
+        bench('id_generator (sparse ids)',
+              lambda: next(id_generator(sparse)), max(1, number // 100))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--cells', dest='cells', type=int, nargs='+',
+                        default=[1000, 5000, 10000],
+                        help='number of cells of the benchmarked worksheets')
+    parser.add_argument('--number', dest='number', type=int, default=1000,
+                        help='number of calls per timing')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    benchconf.set_sage_conf()
+    for ncells in args.cells:
+        run(ncells, args.number)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Benchmark of the serialization formats of the datastore.
+
+Reproduces the measurements of the comment at the bottom of
+sagewui/storage/filesystem_storage.py on the running Python: the time to
+dump and load the basic data structure of a worksheet (and of a user)
+with each pickle protocol, json, and yaml if it is installed, and the
+size of the output. The serializers of sagewui.storage.serializers are
+measured with their header.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import pickle
+import timeit
+
+from sagewui.gui.worksheet import Worksheet
+from sagewui.controllers import User
+from sagewui.storage import serializers
+from sagewui.util import tmp_dir
+
+
+description = 'Benchmark the serialization of datastore objects'
+
+
+def worksheet_basic():
+    W = Worksheet('bench', 0, name='A benchmark worksheet', system='sage',
+                  notebook_worksheet_directory=tmp_dir())
+    b = W.basic
+    b['collaborators'] = ['user{}'.format(i) for i in range(5)]
+    b['saved_by_info'] = dict(
+        ('{}'.format(1500000000 + 100 * i), 'bench') for i in range(30))
+    b['tags'] = {'bench': [1], 'user0': [0]}
+    return b
+
+
+def user_basic():
+    U = User.new('bench', 'password', 'bench@example.org')
+    U.viewable_worksheets.update(('user{}'.format(i), i) for i in range(20))
+    return U.basic
+
+
+def formats():
+    yield 'pickle protocol 0 (legacy)', (
+        lambda b: pickle.dumps(b, protocol=0), pickle.loads)
+    for protocol in range(1, pickle.HIGHEST_PROTOCOL + 1):
+        yield 'pickle protocol {}'.format(protocol), (
+            lambda b, p=protocol: pickle.dumps(b, protocol=p), pickle.loads)
+    for name in sorted(serializers.serializers):
+        yield 'serializers {!r}'.format(name), (
+            lambda b, n=name: serializers.dumps(b, n), serializers.loads)
+    yield 'json', (lambda b: json.dumps(b).encode('utf-8'),
+                   lambda s: json.loads(s.decode('utf-8')))
+    yield 'json (indent=4)', (
+        lambda b: json.dumps(b, indent=4).encode('utf-8'),
+        lambda s: json.loads(s.decode('utf-8')))
+    try:
+        import yaml
+    except ImportError:
+        return
+    yield 'yaml', (lambda b: yaml.dump(b).encode('utf-8'),
+                   lambda s: yaml.load(s, Loader=yaml.Loader))
+    if hasattr(yaml, 'CDumper'):
+        yield 'yaml + C', (
+            lambda b: yaml.dump(b, Dumper=yaml.CDumper).encode('utf-8'),
+            lambda s: yaml.load(s, Loader=yaml.CLoader))
+
+
+def run(title, basic, number, repeat):
+    print(title)
+    for name, (dumps, loads) in formats():
+        try:
+            size = len(dumps(basic))
+        except TypeError:
+            # e.g., json can't serialize sets
+            print('{:<32} {:>12}'.format(name, 'unsupported'))
+            continue
+        t = min(timeit.repeat(lambda: loads(dumps(basic)),
+                              number=number, repeat=repeat))
+        print('{:<32} {:>10.1f} us {:>8} bytes'.format(
+            name, 1e6 * t / number, size))
+    print()
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--number', dest='number', type=int, default=625,
+                        help='number of loops per timing')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3,
+                        help='number of timings (the best one is reported)')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    run('Worksheet basic (loads(dumps(b)))', worksheet_basic(),
+        args.number, args.repeat)
+    run('User basic (loads(dumps(b)))', user_basic(),
+        args.number, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
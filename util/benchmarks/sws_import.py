@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Benchmark of the import of sws files.
+
+Exports a worksheet with large data and cell files, then times
+FilesystemDatastore.import_worksheet, which reads the archive in a single
+pass, next to the previous implementation, which read the member list
+and extracted the data and cells directories in separate passes (each
+one decompressing the archive again) and then moved them into place.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import random
+import shutil
+import tarfile
+import time
+
+from sagewui.storage.filesystem_storage import FilesystemDatastore
+from sagewui.storage.filesystem_storage import is_safe
+from sagewui.util import tmp_dir
+
+
+description = 'Benchmark the import of sws files'
+
+
+def random_data(rnd, size):
+    # Somewhat compressible, like most plots and data files
+    words = [bytes(bytearray(rnd.getrandbits(8) for i in range(8)))
+             for j in range(256)]
+    return b''.join(rnd.choice(words) for i in range(size // 8))
+
+
+def make_sws(S, path, size, nfiles, compression):
+    rnd = random.Random(0)
+    W = S.create_worksheet('bench', 0, name='bench', system='sage')
+    W.cells
+    S.save_worksheet(W)
+    ws_path = S._abspath(S._worksheet_pathname('bench', 0))
+    chunk = random_data(rnd, 1 << 20)
+    for i in range(nfiles):
+        dirname = os.path.join(ws_path, 'data') if i % 2 else os.path.join(
+            ws_path, 'cells', str(i))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, 'file{}.bin'.format(i)), 'wb') as f:
+            for j in range(size // nfiles):
+                f.write(chunk)
+    filename = os.path.join(path, 'bench.sws')
+    S.export_worksheet('bench', 0, filename, None, compression)
+    return filename
+
+
+def multipass_import(S, username, id_number, filename):
+    path = S._abspath(S._worksheet_pathname(username, id_number))
+    if os.path.exists(path):
+        shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    T = tarfile.open(filename, 'r:*')
+    with open(S._abspath(S._worksheet_conf_filename(
+            username, id_number)), 'wb') as f:
+        f.write(T.extractfile(os.path.join(
+            'sage_worksheet', 'worksheet_conf.pickle')).read())
+    with open(S._abspath(S._worksheet_html_filename(
+            username, id_number)), 'wb') as f:
+        f.write(T.extractfile(os.path.join(
+            'sage_worksheet', 'worksheet.html')).read())
+    for base in ('data', 'cells'):
+        base = os.path.join('sage_worksheet', base)
+        members = [a for a in T.getmembers() if a.name.startswith(base) and
+                   is_safe(a.name)]
+        if len(members) > 0:
+            T.extractall(path, members)
+            shutil.move(os.path.join(path, base), path)
+    shutil.rmtree(os.path.join(path, 'sage_worksheet'), ignore_errors=True)
+    T.close()
+    return S.load_worksheet(username, id_number)
+
+
+def bench(title, f, number):
+    times = []
+    for i in range(number):
+        t = time.time()
+        f()
+        times.append(time.time() - t)
+    print('{:<40} {:>8.2f} s'.format(title, min(times)))
+
+
+def run(size, nfiles, compression, number):
+    path = tmp_dir()
+    try:
+        S = FilesystemDatastore(path)
+        filename = make_sws(S, path, size, nfiles, compression)
+        print('{} MiB in {} files, {}: {:.1f} MiB sws'.format(
+            size, nfiles, compression,
+            os.path.getsize(filename) / (1 << 20)))
+        bench('import_worksheet (single pass)',
+              lambda: S.import_worksheet('bench', 1, filename), number)
+        bench('import (multiple passes)',
+              lambda: multipass_import(S, 'bench', 2, filename), number)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--size', dest='size', type=int, nargs='+',
+                        default=[100, 300],
+                        help='size (MiB) of the worksheet files')
+    parser.add_argument('--files', dest='files', type=int, default=20,
+                        help='number of data and cell files')
+    parser.add_argument('--compression', dest='compression', default='bz2',
+                        choices=['bz2', 'gz', 'xz'],
+                        help='compression of the sws file')
+    parser.add_argument('--number', dest='number', type=int, default=1,
+                        help='number of timings (the best one is reported)')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    for size in args.size:
+        run(size, args.files, args.compression, args.number)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Benchmark of the copy of the files of a worksheet, as done when it is
+copied or published (Notebook.initialize_wst).
+
+Times the first and a repeated copy of a cells and a data directory with
+shutil.copytree (after removing the target, as initialize_wst did) and
+with sagewui.util.sync_tree, which hard links the cell files, reflinks
+or copies the data files, and skips the files which didn't change.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import shutil
+import time
+
+from sagewui.util import sync_tree
+from sagewui.util import tmp_dir
+
+
+description = 'Benchmark the copy of worksheet files'
+
+
+def make_tree(path, size, nfiles):
+    data = os.urandom(1 << 20)
+    for base in ('cells', 'data'):
+        for i in range(nfiles):
+            dirname = os.path.join(path, base, str(i)) if base == 'cells' \
+                else os.path.join(path, base)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with open(os.path.join(dirname, 'file{}'.format(i)), 'wb') as f:
+                for j in range(size // nfiles):
+                    f.write(data)
+
+
+def copytree(src, dst):
+    for base in ('cells', 'data'):
+        shutil.rmtree(os.path.join(dst, base), ignore_errors=True)
+        shutil.copytree(os.path.join(src, base), os.path.join(dst, base))
+
+
+def synctree(src, dst):
+    sync_tree(os.path.join(src, 'cells'), os.path.join(dst, 'cells'))
+    sync_tree(os.path.join(src, 'data'), os.path.join(dst, 'data'),
+              link=False)
+
+
+def bench(title, f):
+    t = time.time()
+    f()
+    print('{:<40} {:>8.3f} s'.format(title, time.time() - t))
+
+
+def run(size, nfiles):
+    path = tmp_dir()
+    try:
+        src = os.path.join(path, 'src')
+        make_tree(src, size, nfiles)
+        print('{} MiB in {} cell files and {} data files'.format(
+            2 * size, nfiles, nfiles))
+        for title, f in (('copytree', copytree), ('sync_tree', synctree)):
+            dst = os.path.join(path, title)
+            bench('{} (first copy)'.format(title), lambda: f(src, dst))
+            bench('{} (repeated copy)'.format(title), lambda: f(src, dst))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--size', dest='size', type=int, nargs='+',
+                        default=[50, 200],
+                        help='size (MiB) of the cells and data directories')
+    parser.add_argument('--files', dest='files', type=int, default=50,
+                        help='number of cell files and data files')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    for size in args.size:
+        run(size, args.files)
+        print()
+
+
+if __name__ == '__main__':
+    main()